@@ -0,0 +1,166 @@
+"""
+Conditional GETs validated without rendering the response.
+
+The validator of a response is derived from the rows it is rendered from:
+the row count and latest `modified_at` of the queryset and of every relation
+its serializer walks, plus the version counters of the related models that
+have no `modified_at` (see `accounts.versions`). To-one relations are
+aggregated in the same query as the rows, each to-many relation in its own.
+Paginated lists only aggregate the rows of the requested page.
+"""
+import calendar
+import hashlib
+
+from django.db.models import Count, Max, Sum
+from django.utils.cache import (
+    get_conditional_response, patch_cache_control, patch_vary_headers,
+)
+from django.utils.http import http_date, quote_etag
+
+from .. import versions
+from .eager_loading import _follow_relations, get_loading_plan
+
+
+MODIFIED_FIELD = 'modified_at'
+
+_dependencies = {}
+
+
+def _has_modified_field(model):
+    return any(field.name == MODIFIED_FIELD for field in model._meta.concrete_fields)
+
+
+def get_dependencies(serializer_class):
+    """
+    Return the groups of paths aggregated together, as (path, has modified
+    field) pairs, and the models read through their versions.
+    """
+    if serializer_class not in _dependencies:
+        model = serializer_class.Meta.model
+        joined, separate, versioned = [('', _has_modified_field(model))], [], set()
+        if not joined[0][1]:
+            versioned.add(model)
+
+        select, prefetch = get_loading_plan(serializer_class)
+        for path in sorted(set(select) | set(prefetch)):
+            _, many, related_model = _follow_relations(model, path.split('__'))
+            if not _has_modified_field(related_model):
+                versioned.add(related_model)
+            elif many:
+                separate.append([(path, True)])
+            else:
+                joined.append((path, True))
+
+        _dependencies[serializer_class] = ([joined] + separate, versioned)
+
+    return _dependencies[serializer_class]
+
+
+def get_validators(serializer_class, queryset):
+    """
+    Return the ETag and the Last-Modified timestamp, when every dependency
+    has a modified_at, of `queryset` rendered by `serializer_class`.
+    """
+    groups, versioned = get_dependencies(serializer_class)
+    queryset = queryset.order_by()
+
+    parts, modified = [], []
+    for group in groups:
+        aggregates = {}
+        for index, (path, has_modified) in enumerate(group):
+            aggregates['count_%d' % index] = Count(path or 'pk', distinct=True)
+            if not path:
+                # a row replacing a deleted one keeps the count, not the ids
+                aggregates['ids_%d' % index] = Sum('pk')
+            if has_modified:
+                field = path + '__' + MODIFIED_FIELD if path else MODIFIED_FIELD
+                aggregates['modified_%d' % index] = Max(field)
+
+        values = queryset.aggregate(**aggregates)
+        parts.extend(sorted(values.items()))
+        modified.extend(
+            value for name, value in values.items()
+            if name.startswith('modified_') and value is not None
+        )
+
+    model_versions = versions.get_versions(versioned)
+    parts.extend(sorted(
+        (model._meta.label_lower, version) for model, version in model_versions.items()
+    ))
+
+    etag = quote_etag(hashlib.md5(repr(parts).encode()).hexdigest())
+
+    # changes of versioned models have no date to compare with
+    last_modified = None
+    if modified and not versioned:
+        last_modified = calendar.timegm(max(modified).utctimetuple())
+
+    return etag, last_modified
+
+
+class NotModified(Exception):
+
+    def __init__(self, response):
+        self.response = response
+
+
+class ConditionalGetMixin:
+    """
+    Answer GETs with ETag and Last-Modified validators and with 304 Not
+    Modified when the client's copy is current, before any serialization.
+    """
+    conditional_actions = ('list', 'retrieve')
+
+    def get_validator_queryset(self):
+        queryset = self.filter_queryset(self.get_queryset())
+
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        if lookup_url_kwarg in self.kwargs:
+            queryset = queryset.filter(**{self.lookup_field: self.kwargs[lookup_url_kwarg]})
+        elif getattr(self, 'action', None) == 'list' and hasattr(self.paginator, 'get_window'):
+            # only the rows of the requested page, instead of all of them
+            window = self.paginator.get_window(queryset, self.request)
+            if window is not None:
+                queryset = queryset.filter(pk__in=window.values('pk'))
+
+        return queryset
+
+    def get_validators(self):
+        return get_validators(self.get_serializer_class(), self.get_validator_queryset())
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+
+        self.etag = self.last_modified = None
+        action = getattr(self, 'action', None)
+        if request.method not in ('GET', 'HEAD'):
+            return
+        if action is not None and action not in self.conditional_actions:
+            return
+
+        self.etag, self.last_modified = self.get_validators()
+        response = get_conditional_response(
+            request, etag=self.etag, last_modified=self.last_modified
+        )
+        if response is not None:
+            raise NotModified(response)
+
+    def handle_exception(self, exc):
+        if isinstance(exc, NotModified):
+            return exc.response
+        return super().handle_exception(exc)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+
+        etag = getattr(self, 'etag', None)
+        if etag is not None and response.status_code in (200, 304):
+            response['ETag'] = etag
+            if self.last_modified is not None:
+                response['Last-Modified'] = http_date(self.last_modified)
+
+            # responses depend on the user, clients must revalidate them
+            patch_cache_control(response, private=True, no_cache=True)
+            patch_vary_headers(response, ('Authorization',))
+
+        return response
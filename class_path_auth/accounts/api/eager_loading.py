@@ -0,0 +1,116 @@
+"""
+Derive select_related/prefetch_related plans from serializers.
+
+Nested serializers, related fields and dotted sources are discovered by
+walking the serializer fields. Relations read inside SerializerMethodFields
+cannot be discovered, so serializers declare them with:
+
+    select_related_fields   -- paths to join
+    prefetch_related_fields -- paths to prefetch
+    related_serializers     -- {path: serializer class} used by method fields,
+                               whose own plan is merged under `path`
+"""
+from django.core.exceptions import FieldDoesNotExist
+
+from rest_framework import serializers
+
+
+_plans = {}
+
+
+def _follow_relations(model, attrs):
+    """
+    Return the relation prefix of `attrs`, whether it crosses a to-many
+    relation and the model it ends on.
+    """
+    path, many = [], False
+
+    for attr in attrs:
+        try:
+            field = model._meta.get_field(attr)
+        except FieldDoesNotExist:
+            break
+
+        if not field.is_relation:
+            break
+
+        path.append(attr)
+        many = many or field.many_to_many or field.one_to_many
+        model = field.related_model
+
+    return path, many, model
+
+
+def _collect(serializer, model, prefix, prefetching, select, prefetch):
+
+    def add(path, many):
+        if prefetching or many:
+            prefetch.add(prefix + path)
+        else:
+            select.add(prefix + path)
+
+    for path in getattr(serializer, 'select_related_fields', ()):
+        add(path, False)
+
+    for path in getattr(serializer, 'prefetch_related_fields', ()):
+        add(path, True)
+
+    related_serializers = getattr(serializer, 'related_serializers', {})
+    for path, serializer_class in related_serializers.items():
+        _, many, related_model = _follow_relations(model, path.split('__'))
+        add(path, many)
+        _collect(
+            serializer_class(), related_model, prefix + path + '__',
+            prefetching or many, select, prefetch
+        )
+
+    for field in serializer.fields.values():
+        if field.write_only or not field.source_attrs:
+            continue
+
+        attrs, many, related_model = _follow_relations(model, field.source_attrs)
+        if not attrs:
+            continue
+
+        path = '__'.join(attrs)
+
+        if isinstance(field, serializers.BaseSerializer):
+            add(path, many)
+            nested = getattr(field, 'child', field)
+            _collect(
+                nested, related_model, prefix + path + '__',
+                prefetching or many, select, prefetch
+            )
+        elif (isinstance(field, serializers.RelatedField) and not many
+                and len(attrs) == len(field.source_attrs)
+                and field.use_pk_only_optimization()):
+            # primary key fields read the local `<field>_id` column
+            continue
+        else:
+            add(path, many)
+
+
+def get_loading_plan(serializer_class):
+    """
+    Return the (select_related, prefetch_related) lookups the serializer needs.
+    """
+    if serializer_class not in _plans:
+        select, prefetch = set(), set()
+        _collect(
+            serializer_class(), serializer_class.Meta.model, '',
+            False, select, prefetch
+        )
+        _plans[serializer_class] = (tuple(sorted(select)), tuple(sorted(prefetch)))
+
+    return _plans[serializer_class]
+
+
+def setup_eager_loading(serializer_class, queryset):
+    select, prefetch = get_loading_plan(serializer_class)
+
+    if select:
+        queryset = queryset.select_related(*select)
+    if prefetch:
+        queryset = queryset.prefetch_related(*prefetch)
+
+    return queryset
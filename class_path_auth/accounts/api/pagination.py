@@ -0,0 +1,140 @@
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+from urllib import parse
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from django.utils.translation import gettext_lazy as _
+
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, _positive_int
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Keyset pagination over (creation date, id).
+
+    The creation date field is the model's `get_latest_by`, falling back to
+    `created_at`. A cursor holds the position of the first or last row of a
+    page, so every page is a single range query on the ordering columns,
+    without OFFSET or COUNT(*).
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    page_size = api_settings.PAGE_SIZE
+    max_page_size = settings.API_MAX_PAGE_SIZE
+    invalid_cursor_message = _('Invalid cursor')
+
+    def paginate_queryset(self, queryset, request, view=None):
+        window = self.get_window(queryset, request)
+        if window is None:
+            return None
+
+        results = list(window)
+
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+        if self.reverse:
+            results.reverse()
+
+        self.has_next = has_more if not self.reverse else self.position is not None
+        self.has_previous = self.position is not None if not self.reverse else has_more
+        self.page = results
+        return results
+
+    def get_window(self, queryset, request):
+        """
+        Return the rows of the requested page, plus the first row past it
+        that tells whether there are more, as a sliced queryset.
+        """
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.ordering_field = queryset.model._meta.get_field(
+            self.get_ordering_field(queryset)
+        )
+
+        self.reverse, self.position = self.decode_cursor(request)
+        operator = 'lt' if self.reverse else 'gt'
+        name = self.ordering_field.name
+
+        if self.position is not None:
+            value, pk = self.position
+            queryset = queryset.filter(
+                Q(**{name + '__' + operator: value}) |
+                Q(**{name: value, 'pk__' + operator: pk})
+            )
+
+        ordering = ('-' + name, '-pk') if self.reverse else (name, 'pk')
+        return queryset.order_by(*ordering)[:self.page_size + 1]
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ]))
+
+    def get_ordering_field(self, queryset):
+        return queryset.model._meta.get_latest_by or 'created_at'
+
+    def get_page_size(self, request):
+        if self.page_size_query_param:
+            try:
+                return _positive_int(
+                    request.query_params[self.page_size_query_param],
+                    strict=True,
+                    cutoff=self.max_page_size
+                )
+            except (KeyError, ValueError):
+                pass
+
+        return self.page_size
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        return self.encode_cursor(False, self.page[-1])
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        return self.encode_cursor(True, self.page[0])
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return False, None
+
+        try:
+            querystring = b64decode(encoded.encode('ascii')).decode('ascii')
+            tokens = parse.parse_qs(querystring, keep_blank_values=True)
+            reverse = bool(int(tokens['r'][0]))
+            value = self.ordering_field.to_python(tokens['p'][0])
+            pk = int(tokens['i'][0])
+        except (TypeError, ValueError, KeyError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+        return reverse, (value, pk)
+
+    def encode_cursor(self, reverse, obj):
+        # pages of values() rows hold dicts instead of model instances
+        if isinstance(obj, dict):
+            value, pk = obj[self.ordering_field.name], obj['pk']
+        else:
+            value, pk = getattr(obj, self.ordering_field.attname), obj.pk
+
+        tokens = {
+            'r': int(reverse),
+            'p': value.isoformat() if hasattr(value, 'isoformat') else value,
+            'i': pk,
+        }
+        querystring = parse.urlencode(tokens, doseq=True)
+        encoded = b64encode(querystring.encode('ascii')).decode('ascii')
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
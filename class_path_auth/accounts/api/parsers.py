@@ -0,0 +1,31 @@
+import csv
+import io
+
+from django.conf import settings
+
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+
+
+def read_csv(stream, encoding=None):
+    """
+    Read a CSV file with a header row into a list of dicts, dropping empty
+    cells so that optional columns can be left blank.
+    """
+    encoding = encoding or settings.DEFAULT_CHARSET
+    try:
+        text = io.StringIO(stream.read().decode(encoding), newline='')
+        return [
+            {key: value for key, value in row.items() if key and value != ''}
+            for row in csv.DictReader(text)
+        ]
+    except (csv.Error, UnicodeDecodeError) as exc:
+        raise ParseError('CSV parse error - %s' % exc)
+
+
+class CSVParser(BaseParser):
+    media_type = 'text/csv'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        return read_csv(stream, parser_context.get('encoding'))
@@ -1,5 +1,7 @@
 from rest_framework import permissions
 
+from .. import hierarchy
+
 
 class OnlyStudents(permissions.BasePermission):
     message = 'Only students are allowed.'
@@ -26,3 +28,15 @@ class OnlyAdmin(permissions.BasePermission):
 
     def has_permission(self, request, view):
         return request.user.is_admin
+
+
+class CanViewObject(permissions.BasePermission):
+    """
+    Object level check of institutions, programs, classes and courses
+    against the hierarchy graph of the user's institution, without queries
+    once the graph is built.
+    """
+    message = 'You are not allowed to see this object.'
+
+    def has_object_permission(self, request, view, obj):
+        return hierarchy.can_view(request.user, obj)
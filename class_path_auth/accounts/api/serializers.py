@@ -1,17 +1,36 @@
+from django.conf import settings
 from django.core import exceptions
 from django.contrib.auth import password_validation as validators
+from django.db import router, transaction
+from django.db.models import Q
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
 from rest_framework import serializers
 from rest_framework.authtoken.models import Token
 
+from .. import memberships, sharding, tokens
+from ..instrumentation import timer
+from . import compiled
+from ..gradebook import SCORE_FIELDS
 from ..models import (
     Admin, Address, Class, Course, Institution,
-    Profile, Program, Student, User, Teacher,
+    Profile, Program, Scores, Student, User, Teacher,
 )
 
 
-class AddressSerializer(serializers.ModelSerializer):
+class ModelSerializer(serializers.ModelSerializer):
+    """
+    ModelSerializer accounting rendering time to the request's `serialize`
+    timing.
+    """
+
+    def to_representation(self, instance):
+        with timer('serialize'):
+            return super().to_representation(instance)
+
+
+class AddressSerializer(ModelSerializer):
     class Meta:
         model = Address
         fields = (
@@ -21,7 +40,7 @@ class AddressSerializer(serializers.ModelSerializer):
         )
 
 
-class StudentSerializer(serializers.ModelSerializer):
+class StudentSerializer(ModelSerializer):
     student_id = serializers.ReadOnlyField(source='id')
 
     class Meta:
@@ -33,7 +52,7 @@ class StudentSerializer(serializers.ModelSerializer):
         )
 
 
-class TeacherSerializer(serializers.ModelSerializer):
+class TeacherSerializer(ModelSerializer):
     teacher_id = serializers.ReadOnlyField(source='id')
 
     class Meta:
@@ -44,7 +63,7 @@ class TeacherSerializer(serializers.ModelSerializer):
         )
 
 
-class AdminSerializer(serializers.ModelSerializer):
+class AdminSerializer(ModelSerializer):
 
     class Meta:
         model = Admin
@@ -53,7 +72,7 @@ class AdminSerializer(serializers.ModelSerializer):
         )
 
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(ModelSerializer):
     user_id = serializers.ReadOnlyField(source='id')
     profile = serializers.SerializerMethodField(read_only=True)
     addresses = AddressSerializer(many=True, read_only=True)
@@ -63,6 +82,21 @@ class UserSerializer(serializers.ModelSerializer):
         read_only=True
     )
 
+    # relations walked by get_profile
+    related_serializers = {
+        'student': StudentSerializer,
+        'teacher': TeacherSerializer,
+        'admin': AdminSerializer,
+    }
+    compiled_fields = {
+        'profile': compiled.Switch(
+            ('is_student', 'student', StudentSerializer),
+            ('is_teacher', 'teacher', TeacherSerializer),
+            ('is_admin', 'admin', AdminSerializer),
+            default={},
+        ),
+    }
+
     class Meta:
         model = User
         depth = 2
@@ -98,7 +132,7 @@ class UserSerializer(serializers.ModelSerializer):
         return profile.data if profile else {}
 
 
-class ClassSerializer(serializers.ModelSerializer):
+class ClassSerializer(ModelSerializer):
     program_name = serializers.CharField(source='program.name', read_only=True)
 
     class Meta:
@@ -110,8 +144,10 @@ class ClassSerializer(serializers.ModelSerializer):
         )
 
 
-class CourseSerializer(serializers.ModelSerializer):
+class CourseSerializer(ModelSerializer):
     program = serializers.SerializerMethodField(read_only=True)
+    select_related_fields = ('class_id__program',)
+    compiled_fields = {'program': 'class_id__program__name'}
 
     def get_program(self, obj):
         return obj.class_id.program.name
@@ -142,7 +178,7 @@ class ClassSerializerReadOnly(ClassSerializer):
         )
 
 
-class ProgramSerializer(serializers.ModelSerializer):
+class ProgramSerializer(ModelSerializer):
     classes = ClassSerializerReadOnly(many=True, read_only=True)
 
     class Meta:
@@ -153,7 +189,7 @@ class ProgramSerializer(serializers.ModelSerializer):
         )
 
 
-class InstitutionSerializer(serializers.ModelSerializer):
+class InstitutionSerializer(ModelSerializer):
     programs = ProgramSerializer(many=True, read_only=True)
 
     class Meta:
@@ -164,11 +200,253 @@ class InstitutionSerializer(serializers.ModelSerializer):
         )
 
     def create(self, validated_data):
-        institution = super(InstitutionSerializer, self).create(validated_data)
+        using = router.db_for_write(Institution)
+
+        # the directory routes by institution id, every database takes its
+        # ids from there
+        if settings.DATABASE_SHARDS:
+            validated_data['id'] = sharding.allocate_institution_id(using)
+
+        with transaction.atomic(using=using):
+            institution = super(InstitutionSerializer, self).create(validated_data)
+
+            # define the created institution instance as institution of admin
+            admin = self.context['request'].user.admin
+            admin.institution = institution
+            admin.save()
 
-        # define the created institution instance as institution of admin
-        admin = self.context['request'].user.admin
-        admin.institution = institution
-        admin.save()
+            # institutions created in a shard are listed in the directory,
+            # with their admin
+            sharding.register_institution(institution, [admin.user_id])
 
         return institution
+
+
+class RefreshTokenSerializer(serializers.Serializer):
+    refresh = serializers.CharField()
+
+    def validate(self, attrs):
+        try:
+            claims = tokens.decode(attrs['refresh'], tokens.REFRESH)
+        except tokens.TokenError as exc:
+            raise serializers.ValidationError(str(exc))
+
+        user = User.objects.filter(pk=claims['sub'], is_active=True).first()
+        if user is None or not tokens.check_refresh_claims(user, claims):
+            raise serializers.ValidationError(_('Refresh token is no longer valid.'))
+
+        # every refresh token is exchanged for a new pair only once
+        if not tokens.redeem_refresh_token(claims):
+            raise serializers.ValidationError(_('Refresh token has already been used.'))
+
+        attrs['user'] = user
+        return attrs
+
+
+class EnrollmentListSerializer(serializers.ListSerializer):
+    """
+    Validate and create a batch of enrollments with set based queries.
+    """
+
+    def to_internal_value(self, data):
+        # errors raised by validate() would be wrapped as non field errors
+        attrs = super().to_internal_value(data)
+        institution = self.context['institution']
+        errors = [{} for row in attrs]
+
+        registration_numbers = [row['registration_number'] for row in attrs]
+        emails = [User.objects.normalize_email(row['email']) for row in attrs]
+        class_ids = {row['class_id'] for row in attrs if row.get('class_id')}
+
+        existing = User.objects.filter(
+            Q(registration_number__in=registration_numbers) | Q(email__in=emails)
+        ).values_list('registration_number', 'email')
+        taken_registration_numbers = {number for number, email in existing}
+        taken_emails = {email for number, email in existing}
+
+        valid_class_ids = set(
+            Class.objects.for_institution(institution)
+            .filter(id__in=class_ids)
+            .values_list('id', flat=True)
+        )
+
+        seen_registration_numbers, seen_emails = set(), set()
+        for row, email, row_errors in zip(attrs, emails, errors):
+            number = row['registration_number']
+            if number in taken_registration_numbers or number in seen_registration_numbers:
+                row_errors['registration_number'] = [
+                    _('A user with this registration number already exists.')
+                ]
+            if email in taken_emails or email in seen_emails:
+                row_errors['email'] = [_('A user with this email already exists.')]
+
+            if row['role'] == 'student' and row.get('class_id') not in valid_class_ids:
+                row_errors['class_id'] = [_('Unknown class for this institution.')]
+
+            seen_registration_numbers.add(number)
+            seen_emails.add(email)
+
+        if any(errors):
+            raise serializers.ValidationError(errors)
+
+        return attrs
+
+    def create(self, validated_data):
+        # users are created in the directory, profiles in the institution's shard
+        using = router.db_for_write(Student)
+        with transaction.atomic(), transaction.atomic(using=using):
+            return self.create_enrollments(validated_data, using)
+
+    def create_enrollments(self, validated_data, using):
+        institution = self.context['institution']
+        profile_fields = ('cpf', 'description')
+
+        users = User.objects.bulk_create_users([
+            {
+                'registration_number': row['registration_number'],
+                'email': row['email'],
+                'password': row['password'],
+                'first_name': row.get('first_name', ''),
+                'last_name': row.get('last_name', ''),
+                'is_student': row['role'] == 'student',
+                'is_teacher': row['role'] == 'teacher',
+            }
+            for row in validated_data
+        ])
+        sharding.add_members(institution, users, using)
+
+        students, teachers = [], []
+        for user, row in zip(users, validated_data):
+            profile = {field: row.get(field) for field in profile_fields}
+            if user.is_student:
+                students.append(Student(user=user, class_id_id=row['class_id'], **profile))
+            else:
+                teachers.append(Teacher(user=user, institution_id=institution, **profile))
+
+        Student.objects.bulk_create(students, batch_size=500)
+        Teacher.objects.bulk_create(teachers, batch_size=500)
+        # bulk inserts don't send the signals keeping the memberships
+        memberships.refresh([user.pk for user in users], using)
+
+        return users
+
+
+class EnrollmentSerializer(serializers.Serializer):
+    ROLE_CHOICES = ('student', 'teacher')
+
+    registration_number = serializers.CharField(max_length=25)
+    email = serializers.EmailField()
+    password = serializers.CharField(write_only=True)
+    first_name = serializers.CharField(max_length=30, required=False, allow_blank=True)
+    last_name = serializers.CharField(max_length=150, required=False, allow_blank=True)
+    role = serializers.ChoiceField(choices=ROLE_CHOICES)
+    class_id = serializers.IntegerField(required=False, allow_null=True)
+    cpf = serializers.CharField(max_length=100, required=False, allow_null=True)
+    description = serializers.CharField(required=False, allow_null=True, allow_blank=True)
+
+    class Meta:
+        list_serializer_class = EnrollmentListSerializer
+
+    def validate_password(self, value):
+        try:
+            validators.validate_password(value)
+        except exceptions.ValidationError as exc:
+            raise serializers.ValidationError(list(exc.messages))
+        return value
+
+    def validate(self, attrs):
+        if attrs['role'] == 'student' and not attrs.get('class_id'):
+            raise serializers.ValidationError({
+                'class_id': [_('Students must be enrolled in a class.')]
+            })
+        return attrs
+
+    def to_representation(self, instance):
+        return {
+            'user_id': instance.pk,
+            'registration_number': instance.registration_number,
+            'token': instance.auth_token.key,
+        }
+
+
+class ScoreListSerializer(serializers.ListSerializer):
+    """
+    Validate and upsert the scores of a whole course with set based queries.
+    """
+
+    def to_internal_value(self, data):
+        attrs = super().to_internal_value(data)
+        course = self.context['course']
+        student_ids = [row['student_id'] for row in attrs]
+
+        enrolled = set(
+            Student.objects.filter(class_id=course.class_id_id, pk__in=student_ids)
+            .values_list('pk', flat=True)
+        )
+
+        errors, seen = [{} for row in attrs], set()
+        for student_id, row_errors in zip(student_ids, errors):
+            if student_id not in enrolled:
+                row_errors['student_id'] = [_('Student is not enrolled in this course\'s class.')]
+            elif student_id in seen:
+                row_errors['student_id'] = [_('Student is repeated.')]
+            seen.add(student_id)
+
+        if any(errors):
+            raise serializers.ValidationError(errors)
+
+        return attrs
+
+    def create(self, validated_data):
+        with transaction.atomic(using=router.db_for_write(Scores)):
+            return self.upsert(validated_data)
+
+    def upsert(self, validated_data):
+        course = self.context['course']
+        rows = {row['student_id']: row for row in validated_data}
+
+        # writers of the same course wait for each other, or two of them
+        # could both find no scores for a student and insert them twice
+        Course.objects.select_for_update().only('pk').get(pk=course.pk)
+
+        existing = Scores.objects.select_for_update().filter(
+            course=course, student__in=list(rows)
+        )
+
+        now = timezone.now()
+        updated, updated_students = [], set()
+        for scores in existing:
+            row = rows[scores.student_id]
+            for field in SCORE_FIELDS:
+                if field in row:
+                    setattr(scores, field, row[field])
+            # bulk_update skips auto_now
+            scores.modified_at = now
+            updated.append(scores)
+            updated_students.add(scores.student_id)
+
+        created = [
+            Scores(course=course, student_id=student_id, **{
+                field: row.get(field) for field in SCORE_FIELDS
+            })
+            for student_id, row in rows.items()
+            if student_id not in updated_students
+        ]
+
+        batch_size = settings.SCORES_BATCH_SIZE
+        Scores.objects.bulk_create(created, batch_size=batch_size)
+        Scores.objects.bulk_update(
+            updated, SCORE_FIELDS + ('modified_at',), batch_size=batch_size
+        )
+
+        return {'created': len(created), 'updated': len(updated)}
+
+
+class ScoreSerializer(serializers.Serializer):
+    student_id = serializers.IntegerField()
+    first_score = serializers.FloatField(min_value=0, required=False, allow_null=True)
+    second_score = serializers.FloatField(min_value=0, required=False, allow_null=True)
+    third_score = serializers.FloatField(min_value=0, required=False, allow_null=True)
+
+    class Meta:
+        list_serializer_class = ScoreListSerializer
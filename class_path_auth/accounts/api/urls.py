@@ -1,7 +1,6 @@
-from django.urls import path, include
+from django.urls import path, include, re_path
 
 from rest_framework import routers
-from rest_framework.authtoken import views as auth_views
 
 from . import viewsets, views
 
@@ -20,17 +19,17 @@ router.register(
 router.register(
     r'my-classes',
     viewsets.MyClassesViewSet,
-    basename='Class'
+    basename='MyClass'
 )
 router.register(
     r'my-courses',
     viewsets.MyCoursesViewSet,
-    basename='Course'
+    basename='MyCourse'
 )
 router.register(
     r'my-programs',
     viewsets.MyProgramsViewSet,
-    basename='Program'
+    basename='MyProgram'
 )
 router.register(
     r'programs',
@@ -55,9 +54,19 @@ router.register(
 
 urlpatterns = [
     path('', include(router.urls)),
-    path('login/', auth_views.obtain_auth_token),
-    path('my-account/', views.my_user_view),
-    path('my-profile/', views.my_profile_view),
-    path('my-class/', views.my_class_view),
-    path('my-institution/', views.my_institution_view)
+    path('login/', views.login_view, name='login'),
+    path('login/refresh/', views.refresh_token_view, name='login-refresh'),
+    path('login/keys/', views.verification_keys_view, name='login-keys'),
+    path('my-account/', views.my_user_view, name='my-account'),
+    path('my-profile/', views.my_profile_view, name='my-profile'),
+    path('my-class/', views.my_class_view, name='my-class'),
+    path('my-institution/', views.my_institution_view, name='my-institution'),
+    path('metrics/caches/', views.cache_stats_view, name='cache-metrics'),
+    path('metrics/pools/', views.pool_stats_view, name='pool-metrics'),
+    path('enrollments/', views.enrollment_view, name='enrollments'),
+    re_path(
+        r'^exports/(?P<resource>users|students|courses|scores)\.(?P<file_format>csv|ndjson)$',
+        views.export_view,
+        name='exports'
+    ),
 ]
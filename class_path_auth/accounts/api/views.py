@@ -1,21 +1,109 @@
-from rest_framework import permissions, generics
+from django.conf import settings
+from django.http import Http404, StreamingHttpResponse
+from django.utils.http import quote_etag
+from django.utils.translation import gettext_lazy as _
 
-from ..models import Class
+from rest_framework import permissions, generics, parsers, status
+from rest_framework.authtoken.views import ObtainAuthToken
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from ...db import pool
+from .. import exports, institution_tree, tokens
+from ..cache import registry as cache_registry
+from ..models import Class, User
+from ..response_cache import CachedResponseMixin, get_user_tags
 
 from . import serializers, permissions as custom_permissions
+from .conditional import ConditionalGetMixin
+from .parsers import CSVParser, read_csv
+
+
+class LoginView(ObtainAuthToken):
+    """
+    Exchange credentials for the opaque API token or, when LOGIN_TOKEN_MODE
+    is 'signed', for a signed access/refresh token pair.
+    """
+
+    def post(self, request, *args, **kwargs):
+        if settings.LOGIN_TOKEN_MODE != 'signed':
+            return super().post(request, *args, **kwargs)
+
+        serializer = self.serializer_class(
+            data=request.data,
+            context={'request': request}
+        )
+        serializer.is_valid(raise_exception=True)
+        return Response(tokens.issue_tokens(serializer.validated_data['user']))
+
+
+class RefreshTokenView(APIView):
+    authentication_classes = ()
+    permission_classes = permissions.AllowAny,
+
+    def post(self, request, *args, **kwargs):
+        serializer = serializers.RefreshTokenSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return Response(tokens.issue_tokens(serializer.validated_data['user']))
+
+
+class VerificationKeysView(APIView):
+    authentication_classes = ()
+    permission_classes = permissions.AllowAny,
+
+    def get(self, request, *args, **kwargs):
+        return Response({'keys': [tokens.get_public_jwk()]})
+
 
+class CacheStatsView(APIView):
+    permission_classes = permissions.IsAdminUser,
 
-class MyAccountView(generics.RetrieveAPIView, generics.UpdateAPIView):
+    def get(self, request, *args, **kwargs):
+        return Response({
+            name: cache.stats() for name, cache in cache_registry.items()
+        })
+
+
+class PoolStatsView(APIView):
+    permission_classes = permissions.IsAdminUser,
+
+    def get(self, request, *args, **kwargs):
+        return Response(pool.get_stats())
+
+
+class MyAccountView(ConditionalGetMixin, CachedResponseMixin,
+                    generics.RetrieveAPIView, generics.UpdateAPIView):
     serializer_class = serializers.UserSerializer
     permission_classes = permissions.IsAuthenticated,
 
+    def get_cache_tags(self):
+        return get_user_tags(self.request.user)
+
+    def get_validator_queryset(self):
+        return User.objects.filter(pk=self.request.user.pk)
+
     def get_object(self):
-        return self.request.user
+        user = self.request.user
+
+        # users authenticated by a signed token only carry their claims
+        if user.get_deferred_fields():
+            user.load_deferred_fields()
+
+        return user
 
 
-class MyProfileView(generics.RetrieveAPIView, generics.UpdateAPIView):
+class MyProfileView(ConditionalGetMixin, CachedResponseMixin,
+                    generics.RetrieveAPIView, generics.UpdateAPIView):
     permission_classes = permissions.IsAuthenticated,
 
+    def get_cache_tags(self):
+        return get_user_tags(self.request.user)
+
+    def get_validator_queryset(self):
+        model = self.get_serializer_class().Meta.model
+        return model.objects.filter(user=self.request.user)
+
     def get_object(self):
         if self.request.user.is_student:
             return self.request.user.student
@@ -33,18 +121,36 @@ class MyProfileView(generics.RetrieveAPIView, generics.UpdateAPIView):
             return serializers.AdminSerializer
 
 
-class MyInstitutionView(generics.RetrieveAPIView):
+class MyInstitutionView(ConditionalGetMixin, generics.RetrieveAPIView):
     serializer_class = serializers.InstitutionSerializer
     permission_classes = permissions.IsAuthenticated,
 
-    def get_object(self):
-        if self.request.user.is_student:
-            student = self.request.user.student
-            return student.class_id.program.institution
-        elif self.request.user.is_teacher:
-            return self.request.user.teacher.institution
-        else:
-            return self.request.user.admin.institution
+    def get_institution_id(self):
+        if not hasattr(self, 'institution_id'):
+            # signed access tokens already carry the institution
+            if isinstance(self.request.auth, dict):
+                self.institution_id = self.request.auth.get('institution_id')
+            else:
+                self.institution_id = self.request.user.get_institution_id()
+
+        return self.institution_id
+
+    def get_validators(self):
+        institution_id = self.get_institution_id()
+        if not institution_id:
+            return None, None
+
+        # the cached tree changes exactly when its version is bumped
+        version = institution_tree.get_version(institution_id)
+        return quote_etag('%s-%s' % (institution_id, version)), None
+
+    def retrieve(self, request, *args, **kwargs):
+        institution_id = self.get_institution_id()
+        tree = institution_tree.get_tree(institution_id) if institution_id else None
+        if tree is None:
+            raise Http404
+
+        return Response(tree)
 
 
 class MyProgramView(generics.RetrieveAPIView):
@@ -55,15 +161,110 @@ class MyProgramView(generics.RetrieveAPIView):
         return self.request.user.student.class_id.program
 
 
-class MyClassView(generics.RetrieveAPIView):
+class MyClassView(ConditionalGetMixin, CachedResponseMixin, generics.RetrieveAPIView):
     serializer_class = serializers.ClassSerializer
     permission_classes = custom_permissions.OnlyStudents,
 
+    def get_cache_tags(self):
+        tags = [('user', self.request.user.pk)]
+
+        class_ = self.get_validator_queryset().values_list(
+            'pk', 'program', 'program__institution'
+        ).first()
+        if class_ is not None:
+            tags += [('class', class_[0]), ('program', class_[1]), ('institution', class_[2])]
+
+        return tags
+
+    def get_validator_queryset(self):
+        return Class.objects.filter(students__user=self.request.user)
+
     def get_object(self):
         return self.request.user.student.class_id
 
 
+class EnrollmentView(APIView):
+    """
+    Enroll a batch of students and teachers in the admin's institution.
+
+    Accepts a JSON array, a CSV body or a multipart upload with a CSV `file`.
+    The batch is created atomically only if every row is valid, otherwise the
+    errors of each invalid row are returned.
+    """
+    permission_classes = permissions.IsAuthenticated, custom_permissions.OnlyAdmin
+    parser_classes = parsers.JSONParser, CSVParser, parsers.MultiPartParser
+
+    def get_rows(self, request):
+        if 'file' in request.FILES:
+            return read_csv(request.FILES['file'].file)
+        if isinstance(request.data, list):
+            return request.data
+        raise ValidationError(_('Expected a list of users or a CSV file.'))
+
+    def post(self, request, *args, **kwargs):
+        institution = request.user.admin.institution_id
+        if institution is None:
+            raise Http404
+
+        rows = self.get_rows(request)
+        if len(rows) > settings.ENROLLMENT_MAX_ROWS:
+            raise ValidationError(
+                _('At most %d users can be enrolled at once.') % settings.ENROLLMENT_MAX_ROWS
+            )
+
+        serializer = serializers.EnrollmentSerializer(
+            data=rows,
+            many=True,
+            context={
+                'request': request,
+                'institution': institution,
+            }
+        )
+        if not serializer.is_valid():
+            errors = [
+                {'row': number, 'errors': row_errors}
+                for number, row_errors in enumerate(serializer.errors, 1)
+                if row_errors
+            ]
+            return Response({'errors': errors}, status=status.HTTP_400_BAD_REQUEST)
+
+        serializer.save()
+        return Response(
+            {'created': len(serializer.data), 'users': serializer.data},
+            status=status.HTTP_201_CREATED
+        )
+
+
+class ExportView(APIView):
+    """
+    Stream the users, students, courses or scores of the admin's institution
+    as CSV or NDJSON.
+    """
+    permission_classes = permissions.IsAuthenticated, custom_permissions.OnlyAdmin
+
+    def get(self, request, resource, file_format, *args, **kwargs):
+        institution = request.user.admin.institution_id
+        if institution is None:
+            raise Http404
+
+        response = StreamingHttpResponse(
+            exports.STREAMS[file_format](resource, institution),
+            content_type=exports.CONTENT_TYPES[file_format]
+        )
+        response['Content-Disposition'] = 'attachment; filename="%s.%s"' % (
+            resource, file_format
+        )
+        return response
+
+
 # Generics as views
+login_view = LoginView.as_view()
+refresh_token_view = RefreshTokenView.as_view()
+verification_keys_view = VerificationKeysView.as_view()
+cache_stats_view = CacheStatsView.as_view()
+pool_stats_view = PoolStatsView.as_view()
+enrollment_view = EnrollmentView.as_view()
+export_view = ExportView.as_view()
 my_class_view = MyClassView.as_view()
 my_user_view = MyAccountView.as_view()
 my_profile_view = MyProfileView.as_view()
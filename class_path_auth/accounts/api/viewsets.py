@@ -1,18 +1,70 @@
+from django.conf import settings
 from django.shortcuts import get_object_or_404
+from django.utils.translation import gettext_lazy as _
 
 from rest_framework import viewsets, permissions, generics, status
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 
 from ..models import (
     Address, Class, Course, Profile,
-    Institution, Program, Student, User, Teacher
+    Institution, Membership, Program, Student, User, Teacher
 )
 
+from .. import gradebook
+from ..response_cache import CachedResponseMixin
 from . import serializers, permissions as custom_permissions
+from .compiled import get_compiled_serializer
+from .conditional import ConditionalGetMixin
+from .eager_loading import setup_eager_loading
 
 
-class BaseProfileView(viewsets.ModelViewSet):
+class EagerLoadingMixin:
+    """
+    Load every relation the serializer walks along with the queryset, so
+    list endpoints run a constant number of queries.
+    """
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        return setup_eager_loading(self.get_serializer_class(), queryset)
+
+
+class CompiledListMixin:
+    """
+    List with the compiled form of the serializer, which renders values()
+    rows instead of model instances.
+    """
+
+    def list(self, request, *args, **kwargs):
+        if not settings.COMPILED_SERIALIZERS:
+            return super().list(request, *args, **kwargs)
+
+        compiled = get_compiled_serializer(self.get_serializer_class())
+        queryset = self.filter_queryset(self.get_queryset())
+
+        # keyset cursors are built from the ordering column of the last row
+        extra_paths = ()
+        if hasattr(self.paginator, 'get_ordering_field'):
+            extra_paths = (self.paginator.get_ordering_field(queryset),)
+        rows = compiled.values(queryset, *extra_paths)
+
+        page = self.paginate_queryset(rows)
+        if page is not None:
+            return self.get_paginated_response(compiled.to_representation(page))
+
+        return Response(compiled.to_representation(rows))
+
+
+class InstitutionScopedMixin:
+
+    def get_institution(self):
+        return self.request.user.admin.institution_id
+
+
+class BaseProfileView(InstitutionScopedMixin, ConditionalGetMixin, EagerLoadingMixin,
+                      viewsets.ModelViewSet):
     user_actions = ['list', 'retrieve']
 
     def get_serializer_class(self):
@@ -21,109 +73,103 @@ class BaseProfileView(viewsets.ModelViewSet):
         return self.serializer_class
 
 
-class ProgramViewSet(viewsets.ReadOnlyModelViewSet):
+class ProgramViewSet(InstitutionScopedMixin, ConditionalGetMixin, EagerLoadingMixin,
+                     viewsets.ReadOnlyModelViewSet):
     serializer_class = serializers.ProgramSerializer
     permission_classes = permissions.IsAuthenticated, custom_permissions.OnlyAdmin
 
     def get_queryset(self):
-        institution = self.request.user.admin.institution
-        return institution.programs.all()
+        return Program.objects.filter(institution=self.get_institution())
 
 
-class ClassViewSet(viewsets.ReadOnlyModelViewSet):
+class ClassViewSet(InstitutionScopedMixin, ConditionalGetMixin, CompiledListMixin,
+                   EagerLoadingMixin, viewsets.ReadOnlyModelViewSet):
     serializer_class = serializers.ClassSerializer
     permission_classes = permissions.IsAuthenticated, custom_permissions.OnlyAdmin
 
     def get_queryset(self):
-        institution = self.request.user.admin.institution
-        programs = institution.programs.values_list('id', flat=True)
-        return Class.objects.filter(program__id__in=programs)
+        return Class.objects.for_institution(self.get_institution())
 
 
-class CourseViewSet(viewsets.ReadOnlyModelViewSet):
+class CourseViewSet(InstitutionScopedMixin, ConditionalGetMixin, CompiledListMixin,
+                    EagerLoadingMixin, viewsets.ReadOnlyModelViewSet):
     serializer_class = serializers.CourseSerializer
     permission_classes = permissions.IsAuthenticated, custom_permissions.OnlyAdmin,
 
     def get_queryset(self):
-        institution = self.request.user.admin.institution
-        teachers = institution.teachers.values_list('id')
-        return Course.objects.filter(teacher__id__in=teachers)
+        return Course.objects.for_institution(self.get_institution())
 
 
-class UserViewSet(viewsets.ReadOnlyModelViewSet):
+class UserViewSet(InstitutionScopedMixin, ConditionalGetMixin, CompiledListMixin,
+                  EagerLoadingMixin, viewsets.ReadOnlyModelViewSet):
     serializer_class = serializers.UserSerializer
     permission_classes = permissions.IsAuthenticated, custom_permissions.OnlyAdmin
 
     def get_queryset(self):
-        institution = self.request.user.admin.institution
-        teacher_users_ids = institution.teachers.values_list('user__id', flat=True)
-
-        programs = institution.programs.values_list('id', flat=True)
-        classes = Class.objects.filter(program__id__in=programs)
-        students = Student.objects.filter(class_id__in=classes)
-        student_users_ids = students.values_list('user__id', flat=True)
-
-        return User.objects.filter(id__in=list(teacher_users_ids) + list(student_users_ids))
+        return User.objects.for_institution(self.get_institution())
 
 
-class TeacherViewSet(BaseProfileView, viewsets.ReadOnlyModelViewSet):
+class TeacherViewSet(CompiledListMixin, BaseProfileView, viewsets.ReadOnlyModelViewSet):
     lookup_field = 'teacher__id'
     serializer_class = serializers.TeacherSerializer
     permission_classes = permissions.IsAuthenticated, custom_permissions.OnlyAdmin
 
     def get_queryset(self):
-        institution = self.request.user.admin.institution
-        teachers = institution.teachers.all()
+        institution = self.get_institution()
 
         if self.action in self.user_actions:
-            users = teachers.values_list('user__id', flat=True)
-            return User.objects.filter(id__in=users)
+            return User.objects.teachers_of(institution)
 
-        return teachers
+        return Teacher.objects.filter(institution=institution)
 
 
-class StudentViewSet(BaseProfileView, viewsets.ReadOnlyModelViewSet):
+class StudentViewSet(CompiledListMixin, BaseProfileView, viewsets.ReadOnlyModelViewSet):
     lookup_field = 'student__id'
     serializer_class = serializers.StudentSerializer
     permission_classes = permissions.IsAuthenticated, custom_permissions.OnlyAdmin
 
     def get_queryset(self):
-        institution = self.request.user.admin.institution
-        programs = institution.programs.values_list('id', flat=True)
-        classes = Class.objects.filter(program__id__in=programs)
-        students = Student.objects.filter(class_id__in=classes)
+        institution = self.get_institution()
 
         if self.action in self.user_actions:
-            users = students.values_list('user__id', flat=True)
-            return User.objects.filter(id__in=users)
+            return User.objects.students_of(institution)
 
-        return students
+        return Student.objects.for_institution(institution)
 
 
-class MyClassesViewSet(viewsets.ReadOnlyModelViewSet):
+class MyClassesViewSet(ConditionalGetMixin, CompiledListMixin, EagerLoadingMixin,
+                       viewsets.ReadOnlyModelViewSet):
     serializer_class = serializers.ClassSerializer
     permission_classes = permissions.IsAuthenticated, custom_permissions.OnlyTeachers
 
     def get_queryset(self):
-        courses = self.request.user.teacher.courses.all()
-        classes_id = courses.values_list('class_id', flat=True)
-        return Class.objects.filter(id__in=classes_id)
+        courses = Membership.objects.filter(user=self.request.user, role=Membership.TEACHER)
+        return Class.objects.filter(id__in=courses.ids('class_id'))
 
 
-class MyProgramsViewSet(viewsets.ReadOnlyModelViewSet):
+class MyProgramsViewSet(ConditionalGetMixin, EagerLoadingMixin, viewsets.ReadOnlyModelViewSet):
     serializer_class = serializers.ProgramSerializer
     permission_classes = custom_permissions.OnlyTeachers,
 
     def get_queryset(self):
-        teacher = self.request.user.teacher
-        program_ids = teacher.courses.values_list('class_id__program', flat=True)
-        return Program.objects.filter(institution__in=program_ids)
+        courses = Membership.objects.filter(user=self.request.user, role=Membership.TEACHER)
+        return Program.objects.filter(id__in=courses.ids('program_id'))
 
 
-class MyCoursesViewSet(viewsets.ReadOnlyModelViewSet):
+class MyCoursesViewSet(ConditionalGetMixin, CachedResponseMixin, CompiledListMixin,
+                       EagerLoadingMixin, viewsets.ReadOnlyModelViewSet):
     serializer_class = serializers.CourseSerializer
     permission_classes = permissions.IsAuthenticated, custom_permissions.OnlyTeachersOrStudents
 
+    def get_cache_tags(self):
+        user = self.request.user
+
+        # course changes, and changes of the rows nested in courses, are
+        # announced on their teacher and class, see get_course_anchor_tags
+        if user.is_teacher:
+            return [('user', user.pk), ('teacher', user.teacher.pk)]
+        return [('user', user.pk), ('class', user.student.class_id_id)]
+
     def get_queryset(self):
         user = self.request.user
 
@@ -133,3 +179,34 @@ class MyCoursesViewSet(viewsets.ReadOnlyModelViewSet):
         elif user.is_student:
             courses = user.student.class_id.courses.all()
             return courses
+
+    @action(
+        detail=False,
+        permission_classes=(permissions.IsAuthenticated, custom_permissions.OnlyTeachers)
+    )
+    def gradebook(self, request, *args, **kwargs):
+        courses = self.get_queryset().order_by('name', 'pk').values('id', 'name', 'class_id')
+        return Response(gradebook.build_gradebooks(courses))
+
+    @action(
+        detail=True,
+        methods=['put'],
+        permission_classes=(permissions.IsAuthenticated, custom_permissions.OnlyTeachers)
+    )
+    def scores(self, request, *args, **kwargs):
+        course = get_object_or_404(self.get_queryset(), pk=kwargs['pk'])
+
+        if not isinstance(request.data, list):
+            raise ValidationError(_('Expected a list of scores.'))
+        if len(request.data) > settings.SCORES_MAX_ROWS:
+            raise ValidationError(
+                _('At most %d scores can be sent at once.') % settings.SCORES_MAX_ROWS
+            )
+
+        serializer = serializers.ScoreSerializer(
+            data=request.data,
+            many=True,
+            context={'request': request, 'course': course}
+        )
+        serializer.is_valid(raise_exception=True)
+        return Response(serializer.save())
@@ -0,0 +1,225 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.crypto import salted_hmac
+from django.utils.translation import gettext_lazy as _
+
+from rest_framework import authentication, exceptions
+from rest_framework.authtoken.models import Token
+
+from . import tokens
+from .cache import LRUCache
+from .instrumentation import timer
+from .models import User
+
+
+token_cache = LRUCache(
+    name='token',
+    maxsize=settings.TOKEN_CACHE_SIZE,
+    ttl=settings.TOKEN_CACHE_TTL,
+)
+
+credentials_cache = LRUCache(
+    name='basic-auth',
+    maxsize=settings.BASIC_AUTH_CACHE_SIZE,
+    ttl=settings.BASIC_AUTH_CACHE_TTL,
+)
+
+
+def snapshot_user(user):
+    """
+    Return a plain, picklable copy of the user's concrete fields.
+    """
+    fields = User._meta.concrete_fields
+    return (user._state.db, tuple(getattr(user, f.attname) for f in fields))
+
+
+def restore_user(snapshot):
+    """
+    Rebuild a User instance from `snapshot_user` without touching the database.
+    """
+    db, values = snapshot
+    field_names = [f.attname for f in User._meta.concrete_fields]
+    return User.from_db(db, field_names, values)
+
+
+def get_shared_token_cache():
+    alias = settings.TOKEN_CACHE_ALIAS
+    return caches[alias] if alias else None
+
+
+def get_revocation_cache():
+    return caches[settings.TOKEN_REVOCATION_CACHE_ALIAS]
+
+
+def _cache_key(key):
+    return 'token-auth:' + hashlib.sha256(key.encode()).hexdigest()
+
+
+def _version_key(user_id):
+    return 'token-auth:user:%s:version' % user_id
+
+
+def get_user_version(user_id):
+    cache = get_revocation_cache()
+    key = _version_key(user_id)
+
+    version = cache.get(key)
+    if version is None:
+        # start from the clock so a lost version never matches an old entry
+        cache.add(key, int(time.time() * 1000000), None)
+        version = cache.get(key)
+
+    return version
+
+
+def invalidate_token(key):
+    cache_key = _cache_key(key)
+    token_cache.delete(cache_key)
+
+    shared = get_shared_token_cache()
+    if shared is not None:
+        shared.delete(cache_key)
+
+
+def invalidate_user_tokens(user_id):
+    token_cache.delete_tag(('user', user_id))
+
+    # the entries of the other processes no longer match the version
+    cache = get_revocation_cache()
+    try:
+        cache.incr(_version_key(user_id))
+    except ValueError:
+        cache.set(_version_key(user_id), int(time.time() * 1000000), None)
+
+
+def invalidate_user_credentials(user_id):
+    credentials_cache.delete_tag(('user', user_id))
+
+
+class TimedAuthenticationMixin:
+    """
+    Account authentication time to the request's `auth` timing.
+    """
+
+    def authenticate(self, request):
+        with timer('auth'):
+            return super().authenticate(request)
+
+
+class CachedBasicAuthentication(TimedAuthenticationMixin, authentication.BasicAuthentication):
+    """
+    BasicAuthentication that remembers successfully verified credentials.
+
+    Entries are keyed by an HMAC of the user id and password, so neither is
+    kept in memory, and live for BASIC_AUTH_CACHE_TTL seconds or until the
+    user row is saved (e.g. on password change), sparing the password hasher
+    on repeated calls.
+    """
+
+    def authenticate_credentials(self, userid, password, request=None):
+        cache_key = salted_hmac(
+            'basic-auth', userid + '\0' + password
+        ).hexdigest()
+
+        snapshot = credentials_cache.get(cache_key)
+        if snapshot is not None:
+            return restore_user(snapshot), None
+
+        user, auth = super().authenticate_credentials(userid, password, request)
+        credentials_cache.set(
+            cache_key,
+            snapshot_user(user),
+            tags=[('user', user.pk)]
+        )
+        return user, auth
+
+
+class CachedTokenAuthentication(TimedAuthenticationMixin, authentication.TokenAuthentication):
+    """
+    TokenAuthentication that keeps token -> user snapshots in memory.
+
+    Lookups are served from a bounded in-process LRU first and then from the
+    optional shared cache tier (`TOKEN_CACHE_ALIAS`), so only a cold token
+    costs the Token + User query. Entries carry the version of their user
+    in TOKEN_REVOCATION_CACHE_ALIAS, bumped by the signal handlers whenever
+    a token of the user or the user changes, and are only served while it
+    is current, so every process stops accepting a revoked token at once.
+    """
+
+    def get_entry(self, cache_key, shared):
+        entry = token_cache.get(cache_key)
+        if entry is None and shared is not None:
+            entry = shared.get(cache_key)
+            if entry is not None:
+                token_cache.set(cache_key, entry, tags=[('user', entry[0])])
+
+        if entry is not None and entry[1] == get_user_version(entry[0]):
+            return entry
+        return None
+
+    def authenticate_credentials(self, key):
+        cache_key = _cache_key(key)
+        shared = get_shared_token_cache()
+
+        entry = self.get_entry(cache_key, shared)
+        if entry is not None:
+            user = restore_user(entry[2])
+        else:
+            user, token = super().authenticate_credentials(key)
+            entry = user.pk, get_user_version(user.pk), snapshot_user(user)
+            if shared is not None:
+                shared.set(cache_key, entry, settings.TOKEN_CACHE_TTL)
+            token_cache.set(cache_key, entry, tags=[('user', user.pk)])
+
+        token = Token(key=key, user=user)
+        token._state.adding = False
+        return user, token
+
+
+class SignedTokenAuthentication(authentication.BaseAuthentication):
+    """
+    Authenticate `Authorization: Bearer <access token>` headers offline.
+
+    The returned user only has the fields carried by the token claims loaded;
+    the other fields are deferred and fetched together, in one query, the
+    first time any of them is accessed.
+    """
+    keyword = 'Bearer'
+    claim_fields = ('is_teacher', 'is_student', 'is_admin')
+
+    def authenticate(self, request):
+        with timer('auth'):
+            return self.authenticate_claims(request)
+
+    def authenticate_claims(self, request):
+        auth = authentication.get_authorization_header(request).split()
+
+        if not auth or auth[0].lower() != self.keyword.lower().encode():
+            return None
+
+        if len(auth) != 2:
+            msg = _('Invalid token header. Token string should not contain spaces.')
+            raise exceptions.AuthenticationFailed(msg)
+
+        try:
+            claims = tokens.decode(auth[1].decode(), tokens.ACCESS)
+        except (UnicodeError, tokens.TokenError) as exc:
+            raise exceptions.AuthenticationFailed(str(exc))
+
+        known = {'id': int(claims['sub']), 'is_active': True}
+        known.update((f, bool(claims.get(f))) for f in self.claim_fields)
+
+        # from_db expects the values in the model's field order
+        field_names = [
+            f.attname for f in User._meta.concrete_fields if f.attname in known
+        ]
+        user = User.from_db('default', field_names, [known[f] for f in field_names])
+        user._load_deferred_together = True
+
+        return user, claims
+
+    def authenticate_header(self, request):
+        return self.keyword
@@ -0,0 +1,53 @@
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+
+from .cache import LRUCache
+
+
+# role flag -> permission granted to every user holding it
+ROLE_PERMISSIONS = {
+    'is_student': 'accounts.is_student',
+    'is_teacher': 'accounts.is_teacher',
+    'is_admin': 'accounts.is_admin',
+}
+
+permission_cache = LRUCache(
+    name='permissions',
+    maxsize=settings.PERMISSION_CACHE_SIZE,
+    ttl=settings.PERMISSION_CACHE_TTL,
+)
+
+
+def invalidate_user_permissions(user_id=None):
+    if user_id is None:
+        permission_cache.clear()
+    else:
+        permission_cache.delete(user_id)
+
+
+class RolePermissionBackend(ModelBackend):
+    """
+    ModelBackend that grants role permissions from the role flags and keeps
+    the permissions stored in the database in a per-user cache, so neither
+    user creation nor `has_perm` checks need permission queries.
+    """
+
+    def get_role_permissions(self, user_obj):
+        return {
+            permission for flag, permission in ROLE_PERMISSIONS.items()
+            if getattr(user_obj, flag, False)
+        }
+
+    def get_all_permissions(self, user_obj, obj=None):
+        if not user_obj.is_active or user_obj.is_anonymous or obj is not None:
+            return set()
+
+        if not hasattr(user_obj, '_role_perm_cache'):
+            permissions = permission_cache.get(user_obj.pk)
+            if permissions is None:
+                permissions = super().get_all_permissions(user_obj)
+                permission_cache.set(user_obj.pk, permissions)
+
+            user_obj._role_perm_cache = permissions | self.get_role_permissions(user_obj)
+
+        return user_obj._role_perm_cache
@@ -0,0 +1,439 @@
+"""
+Load benchmark of the API routes.
+
+Each scenario drives one route with concurrent clients, authenticated as
+users of the role the route is meant for, and records the latency, status
+and number of queries of every request. The queries are read from the
+`Server-Timing` header set by InstrumentationMiddleware, so they are also
+reported when benchmarking a server over HTTP.
+
+The requests are sent in process through Django's test client, or to a
+running server when a base url is given. Either way the actors are loaded
+from the configured database, usually seeded by `seed_benchmark_data`.
+"""
+import http.client
+import itertools
+import json
+import math
+import re
+import threading
+import time
+import uuid
+
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.db import connections
+from django.test import Client
+from django.urls import reverse
+
+from .gradebook import SCORE_FIELDS
+from .models import Admin, Course, Student, Teacher, User
+from .stats import percentile
+
+
+QUERIES = re.compile(r'(?:^|,)\s*db;[^,]*desc="(\d+) queries"')
+PERCENTILES = (50, 95, 99)
+# scores sent per request by the score upsert scenario
+SCORES_PER_REQUEST = 50
+
+
+class Scenario:
+
+    def __init__(self, name, url_name, role, method='GET', kwargs=None, body=None,
+                 authenticated=True, write=False):
+        self.name = name
+        self.url_name = url_name
+        self.role = role
+        self.method = method
+        # functions of the actor's ids
+        self.kwargs = kwargs
+        self.body = body
+        self.authenticated = authenticated
+        self.write = write
+
+    def get_path(self, actor):
+        kwargs = self.kwargs(actor['ids']) if self.kwargs else None
+        return reverse(self.url_name, kwargs=kwargs)
+
+
+def credentials_body(actor, number):
+    return {'username': actor['registration_number'], 'password': actor['password']}
+
+
+def refresh_body(actor, number):
+    return {'refresh': actor['refresh']}
+
+
+def scores_body(actor, number):
+    return [
+        dict(
+            zip(SCORE_FIELDS, ((number + index + offset) % 101 / 10 for offset in range(3))),
+            student_id=student_id,
+        )
+        for index, student_id in enumerate(actor['ids']['students'])
+    ]
+
+
+_enrollment_run = uuid.uuid4().hex[:8]
+_enrollments = itertools.count(1)
+
+
+def enrollment_body(actor, number):
+    registration = 'w%s-%07d' % (_enrollment_run, next(_enrollments))
+    return [{
+        'registration_number': registration,
+        'email': '%s@enrollments.example.com' % registration,
+        'password': 'benchmark-%s' % _enrollment_run,
+        'role': 'student',
+        'class_id': actor['ids']['class'],
+    }]
+
+
+SCENARIOS = (
+    Scenario('login', 'login', 'student', 'POST', body=credentials_body, authenticated=False),
+    Scenario(
+        'login-refresh', 'login-refresh', 'student', 'POST',
+        body=refresh_body, authenticated=False
+    ),
+    Scenario('login-keys', 'login-keys', None, authenticated=False),
+    Scenario('users-list', 'User-list', 'admin'),
+    Scenario('users-detail', 'User-detail', 'admin', kwargs=lambda ids: {'pk': ids['user']}),
+    Scenario('students-list', 'Student-list', 'admin'),
+    Scenario(
+        'students-detail', 'Student-detail', 'admin',
+        kwargs=lambda ids: {'student__id': ids['student']}
+    ),
+    Scenario('teachers-list', 'Teacher-list', 'admin'),
+    Scenario(
+        'teachers-detail', 'Teacher-detail', 'admin',
+        kwargs=lambda ids: {'teacher__id': ids['teacher']}
+    ),
+    Scenario('classes-list', 'Class-list', 'admin'),
+    Scenario('classes-detail', 'Class-detail', 'admin', kwargs=lambda ids: {'pk': ids['class']}),
+    Scenario('courses-list', 'Course-list', 'admin'),
+    Scenario('courses-detail', 'Course-detail', 'admin', kwargs=lambda ids: {'pk': ids['course']}),
+    Scenario('programs-list', 'Program-list', 'admin'),
+    Scenario(
+        'programs-detail', 'Program-detail', 'admin', kwargs=lambda ids: {'pk': ids['program']}
+    ),
+    Scenario('my-classes-list', 'MyClass-list', 'teacher'),
+    Scenario(
+        'my-classes-detail', 'MyClass-detail', 'teacher', kwargs=lambda ids: {'pk': ids['class']}
+    ),
+    Scenario('my-courses-list-teacher', 'MyCourse-list', 'teacher'),
+    Scenario('my-courses-list-student', 'MyCourse-list', 'student'),
+    Scenario(
+        'my-courses-detail', 'MyCourse-detail', 'teacher', kwargs=lambda ids: {'pk': ids['course']}
+    ),
+    Scenario('my-courses-gradebook', 'MyCourse-gradebook', 'teacher'),
+    Scenario(
+        'my-courses-scores', 'MyCourse-scores', 'teacher', 'PUT',
+        kwargs=lambda ids: {'pk': ids['course']}, body=scores_body, write=True
+    ),
+    Scenario('my-programs-list', 'MyProgram-list', 'teacher'),
+    Scenario(
+        'my-programs-detail', 'MyProgram-detail', 'teacher',
+        kwargs=lambda ids: {'pk': ids['program']}
+    ),
+    Scenario('my-account', 'my-account', 'student'),
+    Scenario('my-profile', 'my-profile', 'student'),
+    Scenario('my-class', 'my-class', 'student'),
+    Scenario('my-institution', 'my-institution', 'admin'),
+    Scenario('cache-metrics', 'cache-metrics', 'staff'),
+    Scenario('pool-metrics', 'pool-metrics', 'staff'),
+    Scenario('enrollments', 'enrollments', 'admin', 'POST', body=enrollment_body, write=True),
+    Scenario(
+        'exports', 'exports', 'admin',
+        kwargs=lambda ids: {'resource': 'courses', 'file_format': 'csv'}
+    ),
+)
+
+
+def get_uncovered_routes(scenarios=SCENARIOS):
+    """
+    Return the names of the api routes no scenario drives.
+    """
+    from .api.urls import urlpatterns, router
+
+    names = {getattr(pattern, 'name', None) for pattern in urlpatterns} - {None}
+    names.update(url.name for url in router.urls)
+    return sorted(names - {scenario.url_name for scenario in scenarios})
+
+
+def _actor(user, role, password, ids=None):
+    return {
+        'role': role,
+        'user_id': user.pk,
+        'registration_number': user.registration_number,
+        'password': password,
+        'token': user.auth_token.key,
+        'ids': ids or {},
+    }
+
+
+def load_actors(count, password, prefix=None):
+    """
+    Return up to `count` users of each role, along with the ids of the rows
+    their routes are requested for.
+    """
+    users = User.objects.filter(is_active=True, auth_token__isnull=False).select_related(
+        'auth_token'
+    )
+    if prefix:
+        users = users.filter(registration_number__startswith='%s-' % prefix)
+
+    actors = {'admin': [], 'teacher': [], 'student': [], 'staff': []}
+
+    for user in users.filter(is_staff=True).order_by('pk')[:count]:
+        actors['staff'].append(_actor(user, 'staff', password))
+
+    admins = Admin.objects.filter(user__in=users).select_related('user__auth_token')
+    for admin in admins.order_by('pk')[:count]:
+        institution = admin.institution_id
+        student = Student.objects.for_institution(institution).order_by('pk').first()
+        teacher = Teacher.objects.filter(institution=institution).order_by('pk').first()
+        course = Course.objects.for_institution(institution).select_related(
+            'class_id'
+        ).order_by('pk').first()
+        if student is None or teacher is None or course is None:
+            continue
+
+        actors['admin'].append(_actor(admin.user, 'admin', password, {
+            'user': student.user_id,
+            'student': student.pk,
+            'teacher': teacher.pk,
+            'class': course.class_id_id,
+            'course': course.pk,
+            'program': course.class_id.program_id,
+        }))
+
+    teachers = Teacher.objects.filter(user__in=users, courses__isnull=False).distinct()
+    for teacher in teachers.select_related('user__auth_token').order_by('pk')[:count]:
+        course = teacher.courses.select_related('class_id').order_by('pk').first()
+        students = Student.objects.filter(class_id=course.class_id_id).order_by('pk')
+        actors['teacher'].append(_actor(teacher.user, 'teacher', password, {
+            'class': course.class_id_id,
+            'course': course.pk,
+            'program': course.class_id.program_id,
+            'students': list(students.values_list('pk', flat=True)[:SCORES_PER_REQUEST]),
+        }))
+
+    students = Student.objects.filter(user__in=users).select_related('user__auth_token')
+    for student in students.order_by('pk')[:count]:
+        actors['student'].append(_actor(student.user, 'student', password))
+
+    return actors
+
+
+class DjangoClient:
+    """
+    Send the requests in process through Django's test client.
+    """
+
+    def __init__(self):
+        host = 'testserver'
+        if '*' not in settings.ALLOWED_HOSTS and settings.ALLOWED_HOSTS:
+            host = settings.ALLOWED_HOSTS[0].lstrip('.')
+        self.client = Client(SERVER_NAME=host)
+
+    def request(self, method, path, body=None, token=None):
+        extra = {'HTTP_AUTHORIZATION': 'Token %s' % token} if token else {}
+        data = json.dumps(body) if body is not None else ''
+        response = self.client.generic(
+            method, path, data, content_type='application/json', **extra
+        )
+        if response.streaming:
+            content = b''.join(response.streaming_content)
+        else:
+            content = response.content
+        return response.status_code, response.get('Server-Timing'), content
+
+    def close(self):
+        # the test client runs the views in the calling thread
+        connections.close_all()
+
+
+class HttpClient:
+    """
+    Send the requests to a running server, over one keep-alive connection.
+    """
+
+    def __init__(self, base_url):
+        url = urlsplit(base_url)
+        connection_class = (
+            http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+        )
+        self.prefix = url.path.rstrip('/')
+        self.connection = connection_class(url.netloc, timeout=60)
+
+    def request(self, method, path, body=None, token=None):
+        headers = {'Accept': 'application/json'}
+        if token:
+            headers['Authorization'] = 'Token %s' % token
+        if body is not None:
+            body = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+
+        try:
+            self.connection.request(method, self.prefix + path, body, headers)
+            response = self.connection.getresponse()
+            content = response.read()
+        except (http.client.HTTPException, OSError):
+            self.connection.close()
+            raise
+        return response.status, response.getheader('Server-Timing'), content
+
+    def close(self):
+        self.connection.close()
+
+
+def get_queries(server_timing):
+    match = QUERIES.search(server_timing or '')
+    return int(match.group(1)) if match else None
+
+
+def summarize(values):
+    if not values:
+        return None
+    values = sorted(values)
+    summary = OrderedDict([('mean', math.fsum(values) / len(values))])
+    for percent in PERCENTILES:
+        summary['p%d' % percent] = percentile(values, percent)
+    summary['max'] = values[-1]
+    return OrderedDict((key, round(value, 3)) for key, value in summary.items())
+
+
+class Benchmark:
+
+    def __init__(self, actors, client_factory, requests=200, concurrency=8, warmup=10):
+        self.actors = actors
+        self.client_factory = client_factory
+        self.requests = requests
+        self.concurrency = concurrency
+        self.warmup = warmup
+
+    def get_actors(self, scenario):
+        if scenario.role is None:
+            return [{'ids': {}, 'token': None}]
+        return self.actors.get(scenario.role, [])
+
+    def prepare(self, scenario, actors):
+        """
+        Return the actors that can run `scenario`, or a reason to skip it.
+        """
+        if scenario.body is not refresh_body:
+            return actors, None
+
+        # refresh tokens are only issued by logins in the signed token mode
+        prepared = []
+        client = self.client_factory()
+        try:
+            for actor in actors:
+                status, _, content = client.request(
+                    'POST', reverse('login'), credentials_body(actor, 0)
+                )
+                if status == 200:
+                    refresh = json.loads(content.decode()).get('refresh')
+                    if refresh:
+                        prepared.append(dict(actor, refresh=refresh))
+        finally:
+            client.close()
+
+        if not prepared:
+            return [], 'the login does not issue refresh tokens, see LOGIN_TOKEN_MODE'
+        return prepared, None
+
+    def send(self, client, scenario, actors, number):
+        actor = actors[number % len(actors)]
+        body = scenario.body(actor, number) if scenario.body else None
+        token = actor['token'] if scenario.authenticated else None
+
+        started = time.perf_counter()
+        try:
+            status, server_timing, _ = client.request(
+                scenario.method, scenario.get_path(actor), body, token
+            )
+        except Exception as exc:
+            # a view raising through the test client, or a dropped connection
+            status, server_timing = type(exc).__name__, None
+        return time.perf_counter() - started, status, get_queries(server_timing)
+
+    def run_worker(self, scenario, actors, worker, barrier):
+        client = None
+        try:
+            client = self.client_factory()
+            for number in range(worker, self.warmup, self.concurrency):
+                self.send(client, scenario, actors, number)
+            # every worker starts measuring at once
+            barrier.wait()
+            return [
+                self.send(client, scenario, actors, number)
+                for number in range(worker, self.requests, self.concurrency)
+            ]
+        except Exception:
+            # release the workers waiting for this one at the barrier
+            barrier.abort()
+            raise
+        finally:
+            if client is not None:
+                client.close()
+
+    def run_scenario(self, scenario):
+        actors, skipped = self.prepare(scenario, self.get_actors(scenario))
+        if not actors:
+            return None, skipped or 'no %s user to send the requests as' % scenario.role
+
+        started = []
+        barrier = threading.Barrier(
+            self.concurrency, action=lambda: started.append(time.perf_counter())
+        )
+        with ThreadPoolExecutor(self.concurrency) as pool:
+            futures = [
+                pool.submit(self.run_worker, scenario, actors, worker, barrier)
+                for worker in range(self.concurrency)
+            ]
+        errors = [future.exception() for future in futures if future.exception()]
+        if errors:
+            # the workers released by the aborted barrier did not cause it
+            raise next(
+                (exc for exc in errors if not isinstance(exc, threading.BrokenBarrierError)),
+                errors[0]
+            )
+        results = list(itertools.chain.from_iterable(future.result() for future in futures))
+        elapsed = time.perf_counter() - started[0]
+
+        statuses = Counter(str(status) for _, status, _ in results)
+        queries = [count for _, _, count in results if count is not None]
+        return OrderedDict([
+            ('name', scenario.name),
+            ('route', scenario.url_name),
+            ('method', scenario.method),
+            ('role', scenario.role),
+            ('path', scenario.get_path(actors[0])),
+            ('requests', len(results)),
+            ('errors', sum(
+                count for status, count in statuses.items()
+                if not status.isdigit() or int(status) >= 400
+            )),
+            ('statuses', OrderedDict(sorted(statuses.items()))),
+            ('throughput', round(len(results) / elapsed, 2)),
+            ('latency_ms', summarize([seconds * 1000 for seconds, _, _ in results])),
+            ('queries', summarize(queries)),
+        ]), None
+
+    def run(self, scenarios, log=None):
+        report = OrderedDict([('routes', []), ('skipped', [])])
+        for scenario in scenarios:
+            result, skipped = self.run_scenario(scenario)
+            if result is None:
+                report['skipped'].append(OrderedDict([
+                    ('name', scenario.name), ('reason', skipped)
+                ]))
+            else:
+                report['routes'].append(result)
+            if log is not None:
+                log(scenario, result, skipped)
+        return report
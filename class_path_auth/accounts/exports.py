@@ -0,0 +1,128 @@
+"""
+Streaming CSV and NDJSON exports of an institution's data.
+
+Rows are read with `values_list().iterator()`, which uses a server-side
+cursor where the backend supports it, and encoded in chunks, so memory use
+does not depend on the number of exported rows.
+"""
+import csv
+import io
+import json
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .models import Course, Scores, Student, User
+
+
+# resource -> (model, ((column, lookup), ...))
+EXPORTS = {
+    'users': (User, (
+        ('id', 'id'),
+        ('registration_number', 'registration_number'),
+        ('email', 'email'),
+        ('first_name', 'first_name'),
+        ('last_name', 'last_name'),
+        ('is_teacher', 'is_teacher'),
+        ('is_student', 'is_student'),
+        ('is_admin', 'is_admin'),
+        ('is_active', 'is_active'),
+        ('date_joined', 'date_joined'),
+    )),
+    'students': (Student, (
+        ('student_id', 'id'),
+        ('user_id', 'user_id'),
+        ('registration_number', 'user__registration_number'),
+        ('email', 'user__email'),
+        ('cpf', 'cpf'),
+        ('class_id', 'class_id_id'),
+        ('class_name', 'class_id__name'),
+        ('program_name', 'class_id__program__name'),
+        ('is_active', 'is_active'),
+        ('created_at', 'created_at'),
+        ('modified_at', 'modified_at'),
+    )),
+    'courses': (Course, (
+        ('id', 'id'),
+        ('name', 'name'),
+        ('description', 'description'),
+        ('class_id', 'class_id_id'),
+        ('class_name', 'class_id__name'),
+        ('teacher_id', 'teacher_id'),
+        ('teacher_email', 'teacher__user__email'),
+        ('created_at', 'created_at'),
+        ('modified_at', 'modified_at'),
+    )),
+    'scores': (Scores, (
+        ('id', 'id'),
+        ('course_id', 'course_id'),
+        ('course_name', 'course__name'),
+        ('student_id', 'student_id'),
+        ('registration_number', 'student__user__registration_number'),
+        ('first_score', 'first_score'),
+        ('second_score', 'second_score'),
+        ('third_score', 'third_score'),
+        ('modified_at', 'modified_at'),
+    )),
+}
+
+CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+def iter_rows(resource, institution):
+    model, columns = EXPORTS[resource]
+    queryset = model.objects.for_institution(institution).order_by('pk')
+    rows = queryset.values_list(*[lookup for _, lookup in columns])
+    return rows.iterator(chunk_size=settings.EXPORT_CHUNK_SIZE)
+
+
+def _chunked(rows, encode_row):
+    buffer = io.StringIO()
+    count = 0
+
+    for row in rows:
+        encode_row(buffer, row)
+        count += 1
+        if count == settings.EXPORT_CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            count = 0
+
+    if count:
+        yield buffer.getvalue()
+
+
+def stream_csv(resource, institution):
+    _, columns = EXPORTS[resource]
+    header = io.StringIO()
+    csv.writer(header).writerow([name for name, _ in columns])
+    yield header.getvalue()
+
+    def encode_row(buffer, row):
+        csv.writer(buffer).writerow([
+            value.isoformat() if hasattr(value, 'isoformat') else value
+            for value in row
+        ])
+
+    yield from _chunked(iter_rows(resource, institution), encode_row)
+
+
+def stream_ndjson(resource, institution):
+    _, columns = EXPORTS[resource]
+    names = [name for name, _ in columns]
+
+    def encode_row(buffer, row):
+        buffer.write(json.dumps(dict(zip(names, row)), cls=DjangoJSONEncoder))
+        buffer.write('\n')
+
+    yield from _chunked(iter_rows(resource, institution), encode_row)
+
+
+STREAMS = {
+    'csv': stream_csv,
+    'ndjson': stream_ndjson,
+}
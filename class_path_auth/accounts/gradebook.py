@@ -0,0 +1,109 @@
+"""
+Gradebooks of a teacher's courses.
+
+A gradebook lists the students of the course's class with their three
+scores and final score, the mean of the scores given so far, followed by
+statistics of every column. The students and scores of all the courses are
+loaded with one query each and the statistics computed in a single pass
+over the sorted columns, whatever the size of the classes.
+"""
+import bisect
+import math
+import statistics
+
+from django.conf import settings
+
+from .models import Scores, Student
+from .stats import percentile
+
+
+SCORE_FIELDS = ('first_score', 'second_score', 'third_score')
+PERCENTILES = (10, 25, 75, 90)
+
+
+def describe(values, passing_score=None):
+    values = sorted(value for value in values if value is not None)
+    if not values:
+        return {'count': 0}
+
+    stats = {
+        'count': len(values),
+        'mean': math.fsum(values) / len(values),
+        'median': statistics.median(values),
+        'stddev': statistics.pstdev(values),
+        'min': values[0],
+        'max': values[-1],
+        'percentiles': {
+            'p%d' % percent: percentile(values, percent) for percent in PERCENTILES
+        },
+    }
+    if passing_score is not None:
+        # values are sorted, so the failing scores are a prefix
+        failed = bisect.bisect_left(values, passing_score)
+        stats['pass_rate'] = (len(values) - failed) / len(values)
+
+    return stats
+
+
+def final_score(scores):
+    given = [score for score in scores if score is not None]
+    return math.fsum(given) / len(given) if given else None
+
+
+def build_gradebooks(courses, passing_score=None):
+    """
+    Return the gradebook of each course, given as dicts with `id`, `name`
+    and `class_id`.
+    """
+    if passing_score is None:
+        passing_score = settings.GRADEBOOK_PASSING_SCORE
+
+    courses = list(courses)
+    students = Student.objects.filter(
+        class_id__in={course['class_id'] for course in courses}
+    ).order_by('user__first_name', 'user__last_name', 'pk').values_list(
+        'pk', 'class_id', 'user__registration_number',
+        'user__first_name', 'user__last_name',
+    )
+    scores = Scores.objects.filter(
+        course__in=[course['id'] for course in courses]
+    ).values_list('course', 'student', *SCORE_FIELDS)
+
+    students_by_class = {}
+    for student in students:
+        students_by_class.setdefault(student[1], []).append(student)
+    scores_by_key = {(row[0], row[1]): row[2:] for row in scores}
+
+    empty = (None,) * len(SCORE_FIELDS)
+    gradebooks = []
+    for course in courses:
+        rows = []
+        for pk, _, registration_number, first_name, last_name in students_by_class.get(
+                course['class_id'], ()):
+            student_scores = scores_by_key.get((course['id'], pk), empty)
+            row = {
+                'student_id': pk,
+                'registration_number': registration_number,
+                'name': ('%s %s' % (first_name, last_name)).strip(),
+            }
+            row.update(zip(SCORE_FIELDS, student_scores))
+            row['final_score'] = final_score(student_scores)
+            rows.append(row)
+
+        column_stats = {
+            field: describe(row[field] for row in rows) for field in SCORE_FIELDS
+        }
+        column_stats['final_score'] = describe(
+            (row['final_score'] for row in rows), passing_score
+        )
+
+        gradebooks.append({
+            'id': course['id'],
+            'name': course['name'],
+            'class_id': course['class_id'],
+            'passing_score': passing_score,
+            'students': rows,
+            'statistics': column_stats,
+        })
+
+    return gradebooks
@@ -0,0 +1,65 @@
+"""
+Password hashing across a process pool, used by bulk user creation.
+"""
+import os
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+
+
+def get_hashing_workers():
+    if settings.PASSWORD_HASHING_WORKERS:
+        return settings.PASSWORD_HASHING_WORKERS
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def _make_password(password):
+    # spawned workers set Django up on their first password, pool
+    # initializers need Python 3.7
+    if not apps.ready:
+        django.setup()
+    return make_password(password)
+
+
+def _chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def hash_passwords(passwords, workers=None, batch_size=500):
+    """
+    Yield `make_password` hashes of `passwords`, in order.
+
+    Batches are hashed in a process pool sized to the available cores and
+    at most two batches are in flight, so callers can insert one batch
+    while the next one is being hashed without holding every hash at once.
+    Small inputs are hashed in process, where the pool start up would cost
+    more than it saves.
+    """
+    passwords = list(passwords)
+    workers = workers or get_hashing_workers()
+
+    if workers <= 1 or len(passwords) < settings.PASSWORD_HASHING_PARALLEL_THRESHOLD:
+        for password in passwords:
+            yield make_password(password)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+
+        for batch in _chunks(passwords, batch_size):
+            chunksize = max(1, len(batch) // workers)
+            pending.append(executor.map(_make_password, batch, chunksize=chunksize))
+
+            if len(pending) > 1:
+                yield from pending.popleft()
+
+        while pending:
+            yield from pending.popleft()
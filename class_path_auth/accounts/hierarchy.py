@@ -0,0 +1,287 @@
+"""
+In-process institution hierarchy graphs, for object level permissions.
+
+The graph of an institution holds its programs, classes and courses with
+their parents, and what each of its members can see:
+
+- admins, the whole institution,
+- teachers, the courses they teach with their classes and programs,
+- students, their class with its program and courses.
+
+so `can_view` and `filter_visible` answer without queries. A graph is built
+from the programs, classes and memberships of the institution in two
+queries, and kept by each process under a version in the
+HIERARCHY_CACHE_ALIAS cache. Signals bump the version on commit when a
+program, class or membership of the institution changes, and every process
+rebuilds the graph the next time it's used.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import router
+
+from .cache import LRUCache
+from .models import Class, Course, Institution, Membership, Program
+
+
+graphs = LRUCache(
+    name='hierarchy',
+    maxsize=settings.HIERARCHY_CACHE_SIZE,
+    ttl=settings.HIERARCHY_TTL,
+)
+
+# user id -> id of the institution whose graph holds the user
+user_institutions = LRUCache(
+    name='hierarchy-users',
+    maxsize=settings.HIERARCHY_USER_CACHE_SIZE,
+    ttl=settings.HIERARCHY_TTL,
+)
+
+# institutions sharing a stripe build their graphs one at a time
+LOCK_STRIPES = 64
+_locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+
+
+def get_cache():
+    return caches[settings.HIERARCHY_CACHE_ALIAS]
+
+
+def _version_key(institution_id):
+    return 'hierarchy:%s:version' % institution_id
+
+
+def get_version(institution_id):
+    cache = get_cache()
+    key = _version_key(institution_id)
+
+    version = cache.get(key)
+    if version is None:
+        # start from the clock so a lost version never reuses an old graph
+        cache.add(key, int(time.time() * 1000000), None)
+        version = cache.get(key)
+
+    return version
+
+
+def bump_versions(institution_ids):
+    cache = get_cache()
+    for institution_id in institution_ids:
+        try:
+            cache.incr(_version_key(institution_id))
+        except ValueError:
+            cache.set(_version_key(institution_id), int(time.time() * 1000000), None)
+
+
+class Scope:
+    """
+    The programs, classes and courses a member can see, or all of them.
+    """
+    __slots__ = ('everything', 'programs', 'classes', 'courses')
+
+    def __init__(self, everything=False, programs=(), classes=(), courses=()):
+        self.everything = everything
+        self.programs = frozenset(programs)
+        self.classes = frozenset(classes)
+        self.courses = frozenset(courses)
+
+    def merge(self, other):
+        return Scope(
+            self.everything or other.everything,
+            self.programs | other.programs,
+            self.classes | other.classes,
+            self.courses | other.courses,
+        )
+
+
+class InstitutionGraph:
+    """
+    The hierarchy of one institution at one version.
+    """
+
+    def __init__(self, institution_id, version, classes, memberships):
+        self.institution_id = institution_id
+        self.version = version
+
+        # class -> its program, course -> its class
+        self.programs = set()
+        self.classes = {}
+        self.courses = {}
+        for program_id, class_id in classes:
+            self.programs.add(program_id)
+            if class_id is not None:
+                self.classes[class_id] = program_id
+
+        teachers, students = {}, {}
+        admins = set()
+        for user_id, role, program_id, class_id, course_id in memberships:
+            if role == Membership.ADMIN:
+                admins.add(user_id)
+            elif role == Membership.STUDENT:
+                students.setdefault(user_id, set()).add((program_id, class_id))
+            else:
+                teachers.setdefault(user_id, set())
+                if course_id is not None:
+                    teachers[user_id].add((program_id, class_id, course_id))
+                    self.courses[course_id] = class_id
+
+        courses_of_class = {}
+        for course_id, class_id in self.courses.items():
+            courses_of_class.setdefault(class_id, []).append(course_id)
+
+        # the students of a class share its scope
+        class_scopes = {}
+
+        def class_scope(program_id, class_id):
+            if class_id not in class_scopes:
+                class_scopes[class_id] = Scope(
+                    programs=[program_id],
+                    classes=[class_id],
+                    courses=courses_of_class.get(class_id, ()),
+                )
+            return class_scopes[class_id]
+
+        self.members = {}
+        for user_id, taught in teachers.items():
+            self.members[user_id] = Scope(
+                programs=[program_id for program_id, _, _ in taught],
+                classes=[class_id for _, class_id, _ in taught],
+                courses=[course_id for _, _, course_id in taught],
+            )
+        for user_id, classes_ in students.items():
+            for program_id, class_id in classes_:
+                scope = class_scope(program_id, class_id)
+                previous = self.members.get(user_id)
+                self.members[user_id] = previous.merge(scope) if previous else scope
+        everything = Scope(everything=True)
+        for user_id in admins:
+            self.members[user_id] = everything
+
+    def get_nodes(self, model):
+        if model is Institution:
+            return {self.institution_id}
+        if model is Program:
+            return self.programs
+        if model is Class:
+            return self.classes
+        if model is Course:
+            return self.courses
+        raise TypeError('%s objects are not part of the institution hierarchy.' % model.__name__)
+
+    def _scope_ids(self, scope, model):
+        if model is Program:
+            return scope.programs
+        if model is Class:
+            return scope.classes
+        return scope.courses
+
+    def can_view(self, user_id, model, pk):
+        """
+        Return whether the user can see the `model` object `pk`.
+        """
+        nodes = self.get_nodes(model)
+        scope = self.members.get(user_id)
+        if scope is None or pk not in nodes:
+            return False
+        if scope.everything or model is Institution:
+            return True
+        return pk in self._scope_ids(scope, model)
+
+    def visible_ids(self, user_id, model):
+        """
+        Return the ids of the `model` objects the user can see.
+        """
+        nodes = self.get_nodes(model)
+        scope = self.members.get(user_id)
+        if scope is None:
+            return set()
+        if scope.everything or model is Institution:
+            return set(nodes)
+        return set(self._scope_ids(scope, model))
+
+
+def build_graph(institution_id, version):
+    # read from the primary: a replica lagging behind the version would
+    # cache stale rows under it
+    using = router.db_for_write(Membership)
+    classes = Program.objects.using(using).filter(
+        institution=institution_id
+    ).values_list('pk', 'classes__pk')
+    memberships = Membership.objects.using(using).filter(
+        institution_id=institution_id
+    ).values_list('user_id', 'role', 'program_id', 'class_id', 'course_id')
+    return InstitutionGraph(institution_id, version, classes, memberships)
+
+
+def get_graph(institution_id):
+    """
+    Return the graph of the institution, rebuilt once per version by each
+    process.
+    """
+    version = get_version(institution_id)
+    graph = graphs.get(institution_id)
+    if graph is not None and graph.version == version:
+        return graph
+
+    with _locks[institution_id % LOCK_STRIPES]:
+        graph = graphs.get(institution_id)
+        if graph is None or graph.version != version:
+            graph = build_graph(institution_id, version)
+            graphs.set(institution_id, graph)
+
+    return graph
+
+
+def get_user_graph(user):
+    """
+    Return the graph of the institution of `user`, None when the user
+    belongs to none.
+    """
+    if not user.is_authenticated:
+        return None
+
+    cached = user_institutions.get(user.pk)
+    institution_id = cached if cached is not None else user.get_institution_id()
+    if institution_id is not None:
+        graph = get_graph(institution_id)
+        if user.pk in graph.members:
+            user_institutions.set(user.pk, institution_id)
+            return graph
+
+    # the user may have moved to another institution since it was cached
+    user_institutions.delete(user.pk)
+    return get_user_graph(user) if cached is not None else None
+
+
+def can_view(user, obj):
+    """
+    Return whether `user` can see `obj`, an institution, program, class or
+    course.
+    """
+    graph = get_user_graph(user)
+    return graph is not None and graph.can_view(user.pk, obj._meta.concrete_model, obj.pk)
+
+
+def visible_ids(user, model):
+    """
+    Return the ids of the `model` objects `user` can see. Check objects
+    against them rather than passing them to a query: a `pk__in` of a whole
+    institution is the id list the scoped querysets avoid.
+    """
+    graph = get_user_graph(user)
+    return graph.visible_ids(user.pk, model) if graph is not None else set()
+
+
+def filter_visible(user, objects):
+    """
+    Return the `objects` `user` can see, in their order. Accepts instances
+    of the hierarchy models.
+    """
+    graph = get_user_graph(user)
+    if graph is None:
+        return []
+    return [
+        obj for obj in objects
+        if graph.can_view(user.pk, obj._meta.concrete_model, obj.pk)
+    ]
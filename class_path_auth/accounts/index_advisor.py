@@ -0,0 +1,264 @@
+"""
+Index advice for the unmanaged accounts schema.
+
+The accounts tables are owned by another service, so their indexes are
+whatever was created by hand. The advisor replays the read only benchmark
+scenarios in process, capturing every SELECT the routes run (the scoping
+querysets of the viewsets and their eager loading), then:
+
+- runs EXPLAIN on each of them and flags the full scans of tables over a
+  number of rows, and the indexes SQLite had to build on the fly;
+- checks that every column the queries join or filter on, and every
+  foreign key of the accounts models, leads an index;
+- suggests the CREATE INDEX statements of the missing ones.
+
+PostgreSQL and SQLite plans are understood.
+"""
+import json
+import re
+
+from collections import OrderedDict
+
+from django.apps import apps
+from django.db import connections, router
+from django.test.utils import override_settings
+
+from . import benchmark
+from .models import User
+
+
+SUPPORTED_VENDORS = ('postgresql', 'sqlite')
+
+TABLE = re.compile(r'(?:FROM|JOIN)\s+"(\w+)"(?:\s+(?:AS\s+)?"?(\w+)"?)?', re.IGNORECASE)
+CONDITION = re.compile(
+    r'"(\w+)"\."(\w+)"\s*(?:=|<>|!=|<=|>=|<|>|\bIN\b|\bIS\b|\bLIKE\b)\s*(?:"(\w+)"\."(\w+)")?',
+    re.IGNORECASE
+)
+SQLITE_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)(?: AS \w+)?(?P<index> USING (?:COVERING )?INDEX)?')
+SQLITE_AUTOMATIC = re.compile(r'^SEARCH (?:TABLE )?(\w+).* USING AUTOMATIC (?:COVERING |PARTIAL )*INDEX')
+
+
+class QueryRecorder:
+    """
+    connection.execute_wrapper hook keeping the SELECTs run, with the
+    scenarios that ran them.
+    """
+
+    def __init__(self):
+        self.queries = OrderedDict()
+        self.scenario = None
+
+    def __call__(self, execute, sql, params, many, context):
+        if not many and sql.lstrip()[:6].upper() == 'SELECT':
+            query = self.queries.setdefault(sql, {'params': params, 'scenarios': []})
+            if self.scenario not in query['scenarios']:
+                query['scenarios'].append(self.scenario)
+        return execute(sql, params, many, context)
+
+
+def capture_queries(actors, using=None):
+    """
+    Run the read only benchmark scenarios once, returning the SELECTs they
+    ran by SQL.
+    """
+    connection = connections[using or router.db_for_read(User)]
+    recorder = QueryRecorder()
+    client = benchmark.DjangoClient()
+
+    # cached responses would hide the queries behind them
+    with override_settings(RESPONSE_CACHE_TTL=0), connection.execute_wrapper(recorder):
+        for scenario in benchmark.SCENARIOS:
+            # the logins only look users up by their unique registration number
+            if scenario.write or scenario.body:
+                continue
+            if scenario.role is None:
+                actor = {'ids': {}, 'token': None}
+            elif actors.get(scenario.role):
+                actor = actors[scenario.role][0]
+            else:
+                continue
+
+            recorder.scenario = scenario.name
+            client.request(
+                scenario.method, scenario.get_path(actor), None,
+                actor['token'] if scenario.authenticated else None,
+            )
+
+    return recorder.queries
+
+
+def get_model_tables():
+    """
+    Return the models by table name, for the tables the advisor knows.
+    """
+    return {
+        model._meta.db_table: model for model in apps.get_models(include_auto_created=True)
+    }
+
+
+def get_referenced_columns(sql):
+    """
+    Return the (table, column) pairs compared in the joins and filters of
+    `sql`, with the aliases of the tables resolved.
+    """
+    aliases = {}
+    for table, alias in TABLE.findall(sql):
+        aliases[table] = table
+        if alias and alias.upper() not in ('ON', 'WHERE', 'INNER', 'LEFT', 'GROUP', 'ORDER'):
+            aliases[alias] = table
+
+    columns = set()
+    for match in CONDITION.finditer(sql):
+        for table, column in (match.group(1, 2), match.group(3, 4)):
+            if table and table in aliases:
+                columns.add((aliases[table], column))
+    return columns
+
+
+def explain_sqlite(cursor, sql, params):
+    cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+    plan, findings = [], []
+    for row in cursor.fetchall():
+        detail = row[-1]
+        plan.append(detail)
+
+        scan = SQLITE_SCAN.match(detail)
+        if scan and not scan.group('index'):
+            findings.append((scan.group(1), 'full scan', detail))
+        automatic = SQLITE_AUTOMATIC.match(detail)
+        if automatic:
+            findings.append((automatic.group(1), 'automatic index', detail))
+    return plan, findings
+
+
+def _walk(plan):
+    yield plan
+    for child in plan.get('Plans', ()):
+        yield from _walk(child)
+
+
+def explain_postgresql(cursor, sql, params):
+    cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+    document = cursor.fetchone()[0]
+    if isinstance(document, str):
+        document = json.loads(document)
+
+    plan, findings = [], []
+    for node in _walk(document[0]['Plan']):
+        relation = node.get('Relation Name')
+        line = node['Node Type'] + (' on %s' % relation if relation else '')
+        if node.get('Filter'):
+            line += ' filter %s' % node['Filter']
+        plan.append(line)
+        if node['Node Type'] == 'Seq Scan':
+            findings.append((relation, 'full scan', line))
+    return plan, findings
+
+
+EXPLAINERS = {
+    'sqlite': explain_sqlite,
+    'postgresql': explain_postgresql,
+}
+
+
+class IndexAdvisor:
+
+    def __init__(self, using=None, min_rows=1000, concurrently=False):
+        self.connection = connections[using or router.db_for_read(User)]
+        if self.connection.vendor not in SUPPORTED_VENDORS:
+            raise ValueError(
+                'Query plans of %s databases are not supported.' % self.connection.vendor
+            )
+        self.explain = EXPLAINERS[self.connection.vendor]
+        self.min_rows = min_rows
+        self.concurrently = concurrently and self.connection.vendor == 'postgresql'
+        self.tables = get_model_tables()
+        self._row_counts = {}
+        self._indexed = {}
+
+    def count_rows(self, table):
+        if table not in self._row_counts:
+            with self.connection.cursor() as cursor:
+                cursor.execute('SELECT COUNT(*) FROM %s' % self.connection.ops.quote_name(table))
+                self._row_counts[table] = cursor.fetchone()[0]
+        return self._row_counts[table]
+
+    def get_indexed_columns(self, table):
+        """
+        Return the columns leading an index, unique or primary key of `table`.
+        """
+        if table not in self._indexed:
+            with self.connection.cursor() as cursor:
+                constraints = self.connection.introspection.get_constraints(cursor, table)
+            self._indexed[table] = {
+                constraint['columns'][0] for constraint in constraints.values()
+                if constraint['columns'] and (
+                    constraint['index'] or constraint['unique'] or constraint['primary_key']
+                )
+            }
+        return self._indexed[table]
+
+    def get_foreign_key_columns(self):
+        for model in apps.get_app_config('accounts').get_models():
+            for field in model._meta.concrete_fields:
+                if field.many_to_one or field.one_to_one:
+                    yield model._meta.db_table, field.column
+
+    def get_index_sql(self, table, column):
+        quote_name = self.connection.ops.quote_name
+        name = ('%s_%s_idx' % (table, column))[:self.connection.ops.max_name_length() or 63]
+        return 'CREATE INDEX %s%s ON %s (%s);' % (
+            'CONCURRENTLY ' if self.concurrently else '',
+            quote_name(name), quote_name(table), quote_name(column),
+        )
+
+    def advise(self, queries):
+        scans, used_by = OrderedDict(), OrderedDict()
+        plans = []
+
+        with self.connection.cursor() as cursor:
+            for sql, query in queries.items():
+                plan, findings = self.explain(cursor, sql, query['params'])
+                plans.append(OrderedDict([
+                    ('sql', sql), ('scenarios', query['scenarios']), ('plan', plan)
+                ]))
+
+                for table, kind, detail in findings:
+                    if table not in self.tables or self.count_rows(table) < self.min_rows:
+                        continue
+                    scan = scans.setdefault((table, kind), OrderedDict([
+                        ('table', table), ('kind', kind), ('rows', self.count_rows(table)),
+                        ('detail', detail), ('scenarios', []),
+                    ]))
+                    scan['scenarios'].extend(
+                        name for name in query['scenarios'] if name not in scan['scenarios']
+                    )
+
+                for column in sorted(get_referenced_columns(sql)):
+                    scenarios = used_by.setdefault(column, [])
+                    scenarios.extend(
+                        name for name in query['scenarios'] if name not in scenarios
+                    )
+
+        for column in self.get_foreign_key_columns():
+            used_by.setdefault(column, [])
+
+        missing = []
+        for (table, column), scenarios in sorted(used_by.items()):
+            if table not in self.tables or column in self.get_indexed_columns(table):
+                continue
+            missing.append(OrderedDict([
+                ('table', table),
+                ('column', column),
+                ('rows', self.count_rows(table)),
+                ('scenarios', scenarios),
+                ('sql', self.get_index_sql(table, column)),
+            ]))
+
+        return OrderedDict([
+            ('vendor', self.connection.vendor),
+            ('queries', len(plans)),
+            ('scans', list(scans.values())),
+            ('missing_indexes', missing),
+            ('plans', plans),
+        ])
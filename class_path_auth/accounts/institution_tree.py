@@ -0,0 +1,116 @@
+"""
+Precomputed institution -> programs -> classes documents.
+
+Each institution has a version number in the cache, bumped whenever one of
+its Institution, Program or Class rows changes. Documents are cached under
+their version, so a bump makes every process rebuild once: concurrent
+requests in a process share one of LOCK_STRIPES locks and processes
+coordinate through a cache lock, so a stampede triggers a single rebuild.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+from ..db.replicas import read_from_primary
+from .models import Institution
+
+
+# a fixed set of locks, each institution always maps to the same one
+LOCK_STRIPES = 64
+_locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+
+
+def get_cache():
+    return caches[settings.INSTITUTION_TREE_CACHE_ALIAS]
+
+
+def _version_key(institution_id):
+    return 'institution-tree:%s:version' % institution_id
+
+
+def get_version(institution_id):
+    cache = get_cache()
+    key = _version_key(institution_id)
+
+    version = cache.get(key)
+    if version is None:
+        # start from the clock so a lost version never reuses an old document
+        cache.add(key, int(time.time() * 1000000), None)
+        version = cache.get(key)
+
+    return version
+
+
+def bump_version(institution_id):
+    cache = get_cache()
+    try:
+        cache.incr(_version_key(institution_id))
+    except ValueError:
+        cache.set(_version_key(institution_id), int(time.time() * 1000000), None)
+
+
+def build_tree(institution_id):
+    from .api.eager_loading import setup_eager_loading
+    from .api.serializers import InstitutionSerializer
+
+    # the document is stored under a version bumped on primary commits
+    with read_from_primary():
+        queryset = setup_eager_loading(
+            InstitutionSerializer,
+            Institution.objects.filter(pk=institution_id)
+        )
+        institution = queryset.first()
+        if institution is None:
+            return None
+
+        return dict(InstitutionSerializer(institution).data)
+
+
+def get_tree(institution_id):
+    """
+    Return the institution document, rebuilding it at most once per version.
+    """
+    cache = get_cache()
+    key = 'institution-tree:%s:%s' % (institution_id, get_version(institution_id))
+
+    tree = cache.get(key)
+    if tree is not None:
+        return tree
+
+    with _locks[institution_id % LOCK_STRIPES]:
+        tree = cache.get(key)
+        if tree is None:
+            tree = _rebuild(institution_id, key)
+
+    return tree
+
+
+def _rebuild(institution_id, key):
+    cache = get_cache()
+    lock_key = key + ':lock'
+    timeout = settings.INSTITUTION_TREE_LOCK_TIMEOUT
+    deadline = time.monotonic() + timeout
+
+    # another process is rebuilding this version, wait for its document
+    locked = cache.add(lock_key, True, timeout)
+    while not locked:
+        time.sleep(0.05)
+        tree = cache.get(key)
+        if tree is not None:
+            return tree
+        if time.monotonic() > deadline:
+            # rebuild without the lock, it's still the other process' to release
+            break
+        locked = cache.add(lock_key, True, timeout)
+
+    try:
+        tree = build_tree(institution_id)
+        if tree is not None:
+            cache.set(key, tree, settings.INSTITUTION_TREE_TTL)
+    finally:
+        if locked:
+            cache.delete(lock_key)
+
+    return tree
@@ -0,0 +1,142 @@
+"""
+Per-request instrumentation.
+
+InstrumentationMiddleware counts and times the SQL queries run while a
+request is handled, collects the time spent in named sections (`auth` and
+`serialize` are timed by the authentication classes and serializers), then
+reports everything in a `Server-Timing` header and a JSON log line.
+
+Routes can be given a query budget in QUERY_BUDGETS, keyed by URL name.
+Going over it is logged, or raises QueryBudgetExceeded when
+QUERY_BUDGET_MODE is 'raise', which makes the test client fail.
+"""
+import contextlib
+import json
+import logging
+import threading
+import time
+
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import connections
+
+
+logger = logging.getLogger('class_path_auth.requests')
+
+_local = threading.local()
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class RequestMetrics:
+
+    def __init__(self):
+        self.queries = 0
+        self.timings = OrderedDict([('db', 0.0)])
+        self._running = set()
+
+    def __call__(self, execute, sql, params, many, context):
+        # connection.execute_wrapper hook
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.timings['db'] += time.perf_counter() - started
+
+    def add(self, name, seconds):
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+
+def get_metrics():
+    return getattr(_local, 'metrics', None)
+
+
+@contextlib.contextmanager
+def timer(name):
+    """
+    Add the time spent in the block to the current request's `name` timing.
+    Nested blocks of the same name are only counted once.
+    """
+    metrics = get_metrics()
+    if metrics is None or name in metrics._running:
+        yield
+        return
+
+    metrics._running.add(name)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics._running.discard(name)
+        metrics.add(name, time.perf_counter() - started)
+
+
+class InstrumentationMiddleware:
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not settings.INSTRUMENTATION_ENABLED:
+            return self.get_response(request)
+
+        metrics = _local.metrics = RequestMetrics()
+        started = time.perf_counter()
+        try:
+            with contextlib.ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(metrics))
+                response = self.get_response(request)
+        finally:
+            _local.metrics = None
+        metrics.add('total', time.perf_counter() - started)
+
+        response['Server-Timing'] = self.server_timing(metrics)
+
+        url_name = self.get_url_name(request)
+        self.log(request, response, url_name, metrics)
+        self.check_budget(url_name, metrics)
+
+        return response
+
+    def get_url_name(self, request):
+        match = getattr(request, 'resolver_match', None)
+        return match.url_name if match is not None else None
+
+    def server_timing(self, metrics):
+        entries = []
+        for name, seconds in metrics.timings.items():
+            entry = '%s;dur=%.1f' % (name, seconds * 1000)
+            if name == 'db':
+                entry += ';desc="%d queries"' % metrics.queries
+            entries.append(entry)
+        return ', '.join(entries)
+
+    def log(self, request, response, url_name, metrics):
+        record = OrderedDict([
+            ('method', request.method),
+            ('path', request.path),
+            ('route', url_name),
+            ('status', response.status_code),
+            ('queries', metrics.queries),
+        ])
+        for name, seconds in metrics.timings.items():
+            record[name + '_ms'] = round(seconds * 1000, 2)
+
+        logger.info(json.dumps(record))
+
+    def check_budget(self, url_name, metrics):
+        budget = settings.QUERY_BUDGETS.get(url_name)
+        if budget is None or metrics.queries <= budget:
+            return
+
+        message = '%s ran %d queries, over its budget of %d.' % (
+            url_name, metrics.queries, budget
+        )
+        if settings.QUERY_BUDGET_MODE == 'raise':
+            raise QueryBudgetExceeded(message)
+        logger.warning(message)
@@ -0,0 +1,83 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import benchmark, index_advisor
+
+
+class Command(BaseCommand):
+    help = (
+        'Replay the queries of the api routes, EXPLAIN them and suggest the indexes '
+        'missing from the unmanaged accounts schema.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=None)
+        parser.add_argument(
+            '--min-rows', type=int, default=1000,
+            help='Only flag full scans of tables with at least this many rows.'
+        )
+        parser.add_argument(
+            '--concurrently', action='store_true',
+            help='Suggest CREATE INDEX CONCURRENTLY on PostgreSQL.'
+        )
+        parser.add_argument(
+            '--prefix', default=None,
+            help='Replay the routes as the users seeded with this prefix.'
+        )
+        parser.add_argument(
+            '--format', choices=('text', 'json'), default='text',
+            help='Print a report, or the full report with every plan as JSON.'
+        )
+
+    def write_text(self, report, verbosity):
+        self.stdout.write('Explained %d queries on %s.' % (report['queries'], report['vendor']))
+
+        self.stdout.write('\nFull scans')
+        for scan in report['scans']:
+            self.stdout.write('  %s (%d rows), %s: %s' % (
+                scan['table'], scan['rows'], scan['kind'], scan['detail']
+            ))
+            self.stdout.write('    in %s' % ', '.join(scan['scenarios']))
+        if not report['scans']:
+            self.stdout.write('  none')
+
+        self.stdout.write('\nMissing indexes')
+        for index in report['missing_indexes']:
+            self.stdout.write('  %s.%s (%d rows)%s' % (
+                index['table'], index['column'], index['rows'],
+                ', used by %s' % ', '.join(index['scenarios']) if index['scenarios'] else '',
+            ))
+        if not report['missing_indexes']:
+            self.stdout.write('  none')
+
+        if report['missing_indexes']:
+            self.stdout.write('\nSuggested DDL')
+            for index in report['missing_indexes']:
+                self.stdout.write('  ' + index['sql'])
+
+        if verbosity > 1:
+            for plan in report['plans']:
+                self.stdout.write('\n%s\n  %s\n  -> %s' % (
+                    ', '.join(plan['scenarios']), plan['sql'], '\n  -> '.join(plan['plan'])
+                ))
+
+    def handle(self, *args, **options):
+        try:
+            advisor = index_advisor.IndexAdvisor(
+                options['database'], options['min_rows'], options['concurrently']
+            )
+        except ValueError as exc:
+            raise CommandError(exc)
+
+        actors = benchmark.load_actors(1, None, options['prefix'])
+        if not any(actors.values()):
+            raise CommandError('There are no users to replay the routes as.')
+
+        queries = index_advisor.capture_queries(actors, options['database'])
+        report = advisor.advise(queries)
+
+        if options['format'] == 'json':
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            self.write_text(report, options['verbosity'])
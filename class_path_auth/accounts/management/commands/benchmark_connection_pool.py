@@ -0,0 +1,90 @@
+import itertools
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.utils import load_backend
+from django.core.management.base import BaseCommand, CommandError
+
+from ....db import ENGINES, pool as connection_pool, pooled
+from ... import benchmark
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure the latency of requests that connect, run a query and close the '
+        'connection, like every request does, without and with the connection pool.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+        parser.add_argument('--requests', type=int, default=1000)
+        parser.add_argument('--concurrency', type=int, default=4)
+        parser.add_argument(
+            '--query', default='SELECT 1',
+            help='Query run by each request, like a token lookup.'
+        )
+
+    def get_settings(self, alias):
+        settings_dict = dict(connections.databases[alias])
+        pool_options = settings_dict.pop('POOL', None) or {}
+
+        # the plain backend of a pooled engine
+        engines = {pooled: engine for engine, pooled in ENGINES.items()}
+        settings_dict['ENGINE'] = engines.get(settings_dict['ENGINE'], settings_dict['ENGINE'])
+        if settings_dict['ENGINE'] not in ENGINES:
+            raise CommandError('Connection pooling is not available for %s.' % settings_dict['ENGINE'])
+
+        return settings_dict, pooled(settings_dict, **pool_options)
+
+    def run(self, settings_dict, alias, options):
+        backend = load_backend(settings_dict['ENGINE'])
+
+        def worker(numbers):
+            # wrappers belong to the thread that created them
+            connection = backend.DatabaseWrapper(dict(settings_dict), alias)
+            latencies = []
+            for _ in numbers:
+                started = time.perf_counter()
+                with connection.cursor() as cursor:
+                    cursor.execute(options['query'])
+                    cursor.fetchall()
+                connection.close()
+                latencies.append(time.perf_counter() - started)
+            return latencies
+
+        concurrency = options['concurrency']
+        started = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as executor:
+            latencies = list(itertools.chain.from_iterable(executor.map(
+                worker,
+                [range(worker, options['requests'], concurrency) for worker in range(concurrency)]
+            )))
+        elapsed = time.perf_counter() - started
+
+        return len(latencies) / elapsed, benchmark.summarize(
+            [seconds * 1000 for seconds in latencies]
+        )
+
+    def handle(self, *args, **options):
+        plain, pooled_settings = self.get_settings(options['database'])
+        if plain['ENGINE'] == 'django.db.backends.sqlite3' and plain['NAME'] in ('', ':memory:'):
+            raise CommandError('In-memory SQLite databases are not pooled.')
+
+        self.stdout.write('%-8s %8s %8s %8s %8s %8s' % (
+            'mode', 'req/s', 'mean ms', 'p50 ms', 'p95 ms', 'p99 ms'
+        ))
+        alias = 'pool-benchmark'
+        for mode, settings_dict in (('direct', plain), ('pooled', pooled_settings)):
+            throughput, latency = self.run(settings_dict, alias, options)
+            self.stdout.write('%-8s %8.0f %8.3f %8.3f %8.3f %8.3f' % (
+                mode, throughput, latency['mean'], latency['p50'], latency['p95'], latency['p99']
+            ))
+
+        stats = connection_pool.get_stats()[alias]
+        connection_pool.close_all()
+        self.stdout.write('\npool: %s' % ', '.join(
+            '%s=%s' % (name, round(value, 3) if isinstance(value, float) else value)
+            for name, value in sorted(stats.items())
+        ))
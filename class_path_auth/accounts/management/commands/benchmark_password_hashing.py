@@ -0,0 +1,46 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...hashing import get_hashing_workers, hash_passwords
+
+
+class Command(BaseCommand):
+    help = 'Measure bulk password hashing throughput for growing worker counts.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--passwords', type=int, default=2000,
+            help='Number of passwords hashed per run.'
+        )
+        parser.add_argument(
+            '--workers', type=int, nargs='+',
+            help='Worker counts to measure, defaults to powers of two up to the available cores.'
+        )
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        workers = options['workers']
+        if not workers:
+            available = get_hashing_workers()
+            workers = [1]
+            while workers[-1] * 2 <= available:
+                workers.append(workers[-1] * 2)
+            if workers[-1] != available:
+                workers.append(available)
+
+        passwords = ['benchmark-password-%d' % i for i in range(options['passwords'])]
+        baseline = None
+
+        self.stdout.write('workers  seconds  hashes/s  speedup')
+        for count in workers:
+            started = time.perf_counter()
+            for _ in hash_passwords(passwords, workers=count, batch_size=options['batch_size']):
+                pass
+            elapsed = time.perf_counter() - started
+
+            throughput = len(passwords) / elapsed
+            baseline = baseline or throughput
+            self.stdout.write('%7d  %7.2f  %8.1f  %6.2fx' % (
+                count, elapsed, throughput, throughput / baseline
+            ))
@@ -0,0 +1,61 @@
+import random
+import time
+
+from django.db import connection, transaction
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import CaptureQueriesContext
+
+from ...api.serializers import ScoreSerializer
+from ...models import Course, Student
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure the bulk score upsert of a course: one insert pass and one '
+        'update pass, rolled back afterwards.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('course', type=int, help='Id of the course to score.')
+        parser.add_argument(
+            '--rows', type=int, default=1000,
+            help='Scores per payload, at most the number of students of the class.'
+        )
+
+    def upsert(self, course, student_ids):
+        payload = [
+            {
+                'student_id': student_id,
+                'first_score': round(random.uniform(0, 10), 1),
+                'second_score': round(random.uniform(0, 10), 1),
+            }
+            for student_id in student_ids
+        ]
+
+        started = time.perf_counter()
+        with CaptureQueriesContext(connection) as queries:
+            serializer = ScoreSerializer(data=payload, many=True, context={'course': course})
+            serializer.is_valid(raise_exception=True)
+            serializer.save()
+        return time.perf_counter() - started, len(queries)
+
+    def handle(self, *args, **options):
+        course = Course.objects.filter(pk=options['course']).first()
+        if course is None:
+            raise CommandError('Course %s does not exist.' % options['course'])
+
+        student_ids = list(
+            Student.objects.filter(class_id=course.class_id_id)
+            .order_by('pk').values_list('pk', flat=True)[:options['rows']]
+        )
+        if not student_ids:
+            raise CommandError('The class of this course has no students.')
+
+        self.stdout.write('pass     rows  seconds   rows/s  queries')
+        with transaction.atomic():
+            for name in ('insert', 'update'):
+                elapsed, queries = self.upsert(course, student_ids)
+                self.stdout.write('%-6s  %5d  %7.3f  %7.0f  %7d' % (
+                    name, len(student_ids), elapsed, len(student_ids) / elapsed, queries
+                ))
+            transaction.set_rollback(True)
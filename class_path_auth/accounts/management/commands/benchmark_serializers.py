@@ -0,0 +1,64 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...api import serializers
+from ...api.compiled import get_compiled_serializer
+from ...api.eager_loading import setup_eager_loading
+
+
+SERIALIZERS = {
+    'users': serializers.UserSerializer,
+    'classes': serializers.ClassSerializer,
+    'courses': serializers.CourseSerializer,
+}
+
+
+class Command(BaseCommand):
+    help = 'Compare DRF and compiled serialization time of the list serializers.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'resources', nargs='*',
+            help='Serializers to measure among %s, defaults to all of them.'
+                 % ', '.join(sorted(SERIALIZERS))
+        )
+        parser.add_argument(
+            '--rows', type=int, default=200,
+            help='Rows serialized per run, like a page of a list endpoint.'
+        )
+        parser.add_argument('--repeat', type=int, default=10)
+
+    def measure(self, render, repeat):
+        started = time.perf_counter()
+        for _ in range(repeat):
+            render()
+        return (time.perf_counter() - started) / repeat * 1000
+
+    def handle(self, *args, **options):
+        repeat = options['repeat']
+
+        self.stdout.write('serializer  rows  drf ms  compiled ms  speedup')
+        for resource in options['resources'] or sorted(SERIALIZERS):
+            if resource not in SERIALIZERS:
+                raise CommandError('Unknown serializer %r.' % resource)
+
+            serializer_class = SERIALIZERS[resource]
+            queryset = serializer_class.Meta.model.objects.order_by('pk')[:options['rows']]
+
+            rows = queryset.count()
+            if not rows:
+                raise CommandError('There are no %s to serialize.' % resource)
+
+            compiled = get_compiled_serializer(serializer_class)
+            drf = self.measure(
+                lambda: serializer_class(
+                    setup_eager_loading(serializer_class, queryset), many=True
+                ).data,
+                repeat
+            )
+            fast = self.measure(lambda: compiled.data(queryset), repeat)
+
+            self.stdout.write('%10s  %4d  %6.1f  %11.1f  %6.2fx' % (
+                resource, rows, drf, fast, drf / fast
+            ))
@@ -0,0 +1,37 @@
+from django.db import DEFAULT_DB_ALIAS
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import memberships
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare the denormalized memberships with the ones computed from the '
+        'profiles, courses, classes and programs, listing the users that differ.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+        parser.add_argument('--batch-size', type=int, default=memberships.BATCH_SIZE)
+        parser.add_argument(
+            '--fix', action='store_true',
+            help='Refresh the memberships of the users that differ.'
+        )
+
+    def handle(self, *args, **options):
+        using = options['database']
+        drifted = memberships.check(using, options['batch_size'])
+        if not drifted:
+            self.stdout.write(self.style.SUCCESS('The memberships of %s are consistent.' % using))
+            return
+
+        message = 'The memberships of %d users of %s differ: %s%s' % (
+            len(drifted), using, ', '.join(map(str, drifted[:20])),
+            '...' if len(drifted) > 20 else '.',
+        )
+        if not options['fix']:
+            raise CommandError(message)
+
+        self.stdout.write(message)
+        memberships.refresh(drifted, using, options['batch_size'])
+        self.stdout.write(self.style.SUCCESS('Refreshed them.'))
@@ -0,0 +1,62 @@
+import time
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import seeding, sharding
+
+
+class Command(BaseCommand):
+    help = (
+        'Move the rows of an institution, with its members\' users and addresses, '
+        'to another database of DATABASE_SHARDS or back to the default one. Writes '
+        'to the institution must be stopped while it runs.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('institution', type=int)
+        parser.add_argument('database', help='Alias of the target database.')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--create-schema', action='store_true',
+            help='Create the missing tables of the unmanaged accounts models in the '
+                 'target first. The other tables are created by migrate --database.'
+        )
+        parser.add_argument(
+            '--keep-source', action='store_true',
+            help='Leave the rows in the source database once moved.'
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only print the number of rows that would be moved.'
+        )
+
+    def handle(self, *args, **options):
+        try:
+            mover = sharding.InstitutionMover(
+                options['institution'],
+                options['database'],
+                batch_size=options['batch_size'],
+                log=self.stdout.write if options['verbosity'] > 1 else None,
+            )
+        except (ValueError, ImproperlyConfigured) as exc:
+            raise CommandError(exc)
+
+        if options['dry_run']:
+            for model, pks in mover.collect():
+                self.stdout.write('%-12s %8d' % (model._meta.db_table, len(pks)))
+            return
+
+        if options['create_schema']:
+            for table in seeding.create_schema(mover.target):
+                self.stdout.write('Created table %s' % table)
+
+        started = time.perf_counter()
+        try:
+            mover.run(delete_source=not options['keep_source'])
+        except ValueError as exc:
+            raise CommandError(exc)
+
+        self.stdout.write(self.style.SUCCESS('Moved institution %s from %s to %s in %.1fs.' % (
+            options['institution'], mover.source, mover.target, time.perf_counter() - started
+        )))
@@ -0,0 +1,29 @@
+import time
+
+from django.db import DEFAULT_DB_ALIAS
+from django.core.management.base import BaseCommand
+
+from ... import memberships
+
+
+class Command(BaseCommand):
+    help = (
+        'Recompute the denormalized memberships of every user from their profiles, '
+        'courses, classes and programs, e.g. after rows were written without signals.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+        parser.add_argument(
+            '--batch-size', type=int, default=memberships.BATCH_SIZE,
+            help='Number of users rebuilt per transaction.'
+        )
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        rows = memberships.rebuild(options['database'], options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            'Rebuilt the memberships of %s in %.1fs, %d rows written.' % (
+                options['database'], time.perf_counter() - started, rows
+            )
+        ))
@@ -0,0 +1,187 @@
+import json
+import platform
+import sys
+
+from collections import OrderedDict
+
+import django
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from ... import benchmark
+from ...models import Course, Scores, Student, Teacher, User
+
+
+class Command(BaseCommand):
+    help = (
+        'Drive every api route with concurrent authenticated clients and report '
+        'the latency percentiles, throughput and queries per request of each one.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'scenarios', nargs='*',
+            help='Scenarios to run, defaults to all the read only ones. '
+                 'Run with --list to see them.'
+        )
+        parser.add_argument('--list', action='store_true', help='List the scenarios and exit.')
+        parser.add_argument(
+            '--base-url', default=None,
+            help='Benchmark the server at this url instead of sending the requests '
+                 'in process. It must use the same database.'
+        )
+        parser.add_argument('--requests', type=int, default=200, help='Requests per scenario.')
+        parser.add_argument('--concurrency', type=int, default=8, help='Concurrent clients.')
+        parser.add_argument(
+            '--warmup', type=int, default=20,
+            help='Requests per scenario sent before measuring, to fill the caches.'
+        )
+        parser.add_argument(
+            '--actors', type=int, default=20,
+            help='Users of each role the requests are spread over.'
+        )
+        parser.add_argument(
+            '--prefix', default=None,
+            help='Only send requests as the users seeded with this prefix.'
+        )
+        parser.add_argument(
+            '--password', default='benchmark', help='Password of the users, to log in.'
+        )
+        parser.add_argument(
+            '--include-writes', action='store_true',
+            help='Also run the scenarios that write, enrolling users and scoring courses. '
+                 'SQLite serializes writes, concurrent ones fail with locking errors.'
+        )
+        parser.add_argument(
+            '--output', default=None,
+            help='Write the JSON report to this file, or to stdout with "-".'
+        )
+        parser.add_argument(
+            '--baseline', default=None,
+            help='A previous JSON report to compare the p95 latency and queries with.'
+        )
+
+    def get_scenarios(self, options):
+        scenarios = OrderedDict((scenario.name, scenario) for scenario in benchmark.SCENARIOS)
+        names = options['scenarios']
+        for name in names:
+            if name not in scenarios:
+                raise CommandError(
+                    'Unknown scenario %r, run with --list to see them.' % name
+                )
+
+        if names:
+            return [scenarios[name] for name in names]
+        return [
+            scenario for scenario in scenarios.values()
+            if options['include_writes'] or not scenario.write
+        ]
+
+    def get_metadata(self, options):
+        return OrderedDict([
+            ('created_at', timezone.now().isoformat()),
+            ('target', options['base_url'] or 'in-process'),
+            ('database', settings.DATABASES['default']['ENGINE']),
+            ('python', platform.python_version()),
+            ('django', django.get_version()),
+            ('requests', options['requests']),
+            ('concurrency', options['concurrency']),
+            ('warmup', options['warmup']),
+            ('settings', OrderedDict(
+                (name, getattr(settings, name, None)) for name in (
+                    'COMPILED_SERIALIZERS', 'RESPONSE_CACHE_TTL', 'LOGIN_TOKEN_MODE',
+                    'TOKEN_CACHE_ALIAS', 'INSTRUMENTATION_ENABLED',
+                )
+            )),
+            ('dataset', OrderedDict(
+                (model._meta.db_table, model.objects.count())
+                for model in (User, Teacher, Student, Course, Scores)
+            )),
+        ])
+
+    def log(self, scenario, result, skipped):
+        if result is None:
+            self.stderr.write('%-26s skipped: %s' % (scenario.name, skipped))
+            return
+
+        latency, queries = result['latency_ms'], result['queries']
+        self.stderr.write('%-26s %5d %5d %8.1f %8.1f %8.1f %8.1f %8s' % (
+            scenario.name, result['requests'], result['errors'], result['throughput'],
+            latency['p50'], latency['p95'], latency['p99'],
+            '%.1f' % queries['mean'] if queries else '-',
+        ))
+
+    def compare(self, report, path):
+        with open(path) as baseline_file:
+            baseline = {
+                route['name']: route for route in json.load(baseline_file)['routes']
+            }
+
+        self.stderr.write('\n%-26s %10s %10s %8s %8s' % (
+            'scenario', 'p95 before', 'p95 after', 'change', 'queries'
+        ))
+        for route in report['routes']:
+            before = baseline.get(route['name'])
+            if before is None:
+                continue
+            p95, previous = route['latency_ms']['p95'], before['latency_ms']['p95']
+            queries = [
+                result['queries']['mean'] if result['queries'] else None
+                for result in (before, route)
+            ]
+            self.stderr.write('%-26s %10.1f %10.1f %+7.0f%% %8s' % (
+                route['name'], previous, p95,
+                (p95 - previous) / previous * 100 if previous else 0,
+                '%s->%s' % tuple('-' if count is None else '%g' % count for count in queries),
+            ))
+
+    def handle(self, *args, **options):
+        if options['list']:
+            for scenario in benchmark.SCENARIOS:
+                self.stdout.write('%-26s %-6s %-20s %s%s' % (
+                    scenario.name, scenario.method, scenario.url_name, scenario.role or '-',
+                    ' (writes)' if scenario.write else ''
+                ))
+            return
+
+        if options['requests'] < 1 or options['concurrency'] < 1:
+            raise CommandError('--requests and --concurrency must be positive.')
+
+        scenarios = self.get_scenarios(options)
+        uncovered = benchmark.get_uncovered_routes()
+        if uncovered:
+            self.stderr.write('Routes without a scenario: %s' % ', '.join(uncovered))
+
+        actors = benchmark.load_actors(options['actors'], options['password'], options['prefix'])
+        if options['base_url']:
+            base_url = options['base_url']
+            client_factory = lambda: benchmark.HttpClient(base_url)
+        else:
+            client_factory = benchmark.DjangoClient
+
+        runner = benchmark.Benchmark(
+            actors, client_factory,
+            requests=options['requests'],
+            concurrency=options['concurrency'],
+            warmup=options['warmup'],
+        )
+
+        self.stderr.write('%-26s %5s %5s %8s %8s %8s %8s %8s' % (
+            'scenario', 'reqs', 'errs', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'queries'
+        ))
+        report = OrderedDict([('meta', self.get_metadata(options))])
+        report.update(runner.run(scenarios, self.log))
+        report['uncovered'] = uncovered
+
+        if options['baseline']:
+            self.compare(report, options['baseline'])
+
+        if options['output'] == '-':
+            json.dump(report, sys.stdout, indent=2)
+            sys.stdout.write('\n')
+        elif options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(report, output, indent=2)
+                output.write('\n')
@@ -0,0 +1,72 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import seeding
+from ...models import User
+
+
+class Command(BaseCommand):
+    help = (
+        'Seed a reproducible synthetic dataset of institutions, programs, classes, '
+        'teachers, students, courses, scores and addresses for load benchmarks.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--users', type=int, default=10000,
+            help='Number of users, the other models are scaled from it. '
+                 'One institution is created every %d users.' % seeding.USERS_PER_INSTITUTION
+        )
+        parser.add_argument('--seed', type=int, default=0, help='Random seed of the dataset.')
+        parser.add_argument(
+            '--prefix', default='bench',
+            help='Prefix of the registration numbers and emails of the seeded users.'
+        )
+        parser.add_argument('--password', default='benchmark', help='Password of every user.')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--database', default=None)
+        parser.add_argument(
+            '--create-schema', action='store_true',
+            help='Create the missing tables of the unmanaged accounts models first.'
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only print the number of rows that would be seeded.'
+        )
+
+    def handle(self, *args, **options):
+        try:
+            scale = seeding.get_scale(options['users'])
+        except ValueError as exc:
+            raise CommandError(exc)
+
+        if options['dry_run']:
+            for name, count in scale.items():
+                self.stdout.write('%-12s %8d' % (name, count))
+            return
+
+        if options['create_schema']:
+            for table in seeding.create_schema(options['database']):
+                self.stdout.write('Created table %s' % table)
+
+        if User.objects.using(options['database']).filter(
+                registration_number__startswith='%s-' % options['prefix']).exists():
+            raise CommandError(
+                'Users prefixed %r were already seeded, use another --prefix.'
+                % options['prefix']
+            )
+
+        started = time.perf_counter()
+        seeding.seed(
+            options['users'],
+            random_seed=options['seed'],
+            prefix=options['prefix'],
+            password=options['password'],
+            batch_size=options['batch_size'],
+            using=options['database'],
+            log=self.stdout.write if options['verbosity'] > 1 else None,
+        )
+        self.stdout.write(self.style.SUCCESS(
+            'Seeded %d users in %.1fs.' % (scale['users'], time.perf_counter() - started)
+        ))
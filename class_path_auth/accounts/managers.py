@@ -1,10 +1,91 @@
-from django.contrib.auth.models import UserManager, Permission
-from django.contrib.contenttypes.models import ContentType
+from django.contrib.auth.models import UserManager
+from django.db import models
 
 from rest_framework.authtoken.models import Token
 
+from .hashing import hash_passwords
 
-class CustomUserManager(UserManager):
+
+class InstitutionQuerySet(models.QuerySet):
+    """
+    Base queryset for models that can be scoped to an institution.
+
+    Subclasses define `institution_lookups`, the paths from the model to
+    the institution; rows matching any of them belong to the institution.
+    Each scope is a single joined query.
+    """
+    institution_lookups = ()
+
+    def for_institution(self, institution):
+        # a missing institution would turn the joins into IS NULL checks
+        if institution is None:
+            return self.none()
+
+        condition = models.Q()
+        for lookup in self.institution_lookups:
+            condition |= models.Q(**{lookup: institution})
+        return self.filter(condition)
+
+
+class UserQuerySet(InstitutionQuerySet):
+    """
+    Users are scoped through their memberships, a single indexed read.
+    """
+
+    def members_of(self, institution, roles):
+        from .models import Membership
+
+        if institution is None:
+            return self.none()
+
+        memberships = Membership.objects.filter(
+            institution_id=getattr(institution, 'pk', institution), role__in=roles
+        )
+        return self.filter(pk__in=memberships.ids('user'))
+
+    def for_institution(self, institution):
+        from .models import Membership
+
+        return self.members_of(institution, (Membership.TEACHER, Membership.STUDENT))
+
+    def teachers_of(self, institution):
+        from .models import Membership
+
+        return self.members_of(institution, (Membership.TEACHER,))
+
+    def students_of(self, institution):
+        from .models import Membership
+
+        return self.members_of(institution, (Membership.STUDENT,))
+
+
+class StudentQuerySet(InstitutionQuerySet):
+    institution_lookups = ('class_id__program__institution',)
+
+
+class ClassQuerySet(InstitutionQuerySet):
+    institution_lookups = ('program__institution',)
+
+
+class CourseQuerySet(InstitutionQuerySet):
+    institution_lookups = ('teacher__institution',)
+
+
+class ScoresQuerySet(InstitutionQuerySet):
+    institution_lookups = ('course__teacher__institution',)
+
+
+class MembershipQuerySet(models.QuerySet):
+
+    def ids(self, field):
+        """
+        Return the `field` ids of the memberships, as a subquery for `__in`
+        lookups.
+        """
+        return self.filter(**{field + '__isnull': False}).values(field)
+
+
+class CustomUserManager(UserManager.from_queryset(UserQuerySet)):
     def create_user(self, registration_number, email=None, password=None, **extra_fields):
         extra_fields.setdefault('is_staff', False)
         extra_fields.setdefault('is_superuser', False)
@@ -21,22 +102,64 @@ class CustomUserManager(UserManager):
 
         return self._create_user(registration_number, email, password, **extra_fields)
 
-    def define_permissions(self, instance):
-        content_type = ContentType.objects.get_for_model(instance)
-        if instance.is_student:
-            permission_is_student, _ = Permission.objects.get_or_create(
-                codename='is_student',
-                name='Is student',
-                content_type=content_type,
-            )
-            instance.user_permissions.add(permission_is_student.id)
-        elif instance.is_teacher:
-            permission_is_teacher, _ = Permission.objects.get_or_create(
-                codename='is_teacher',
-                name='Is teacher',
-                content_type=content_type,
-            )
-            instance.user_permissions.add(permission_is_teacher.id)
+    def bulk_create_users(self, users_data, batch_size=500):
+        """
+        Create users and their api tokens with set based inserts.
+
+        `users_data` is an iterable of dicts holding the `create_user`
+        arguments. Passwords are hashed in parallel, one batch ahead of the
+        inserts. Returns the created users, with their primary keys set.
+        """
+        users_data = list(users_data)
+        passwords = hash_passwords(
+            (data.get('password') for data in users_data),
+            batch_size=batch_size
+        )
+
+        users = []
+        try:
+            for start in range(0, len(users_data), batch_size):
+                batch = [
+                    self._build_user(data, next(passwords))
+                    for data in users_data[start:start + batch_size]
+                ]
+                users.extend(self._bulk_insert_users(batch))
+        finally:
+            passwords.close()
+
+        return users
+
+    def _build_user(self, data, password_hash):
+        extra_fields = dict(data)
+        extra_fields.pop('password', None)
+        registration_number = extra_fields.pop('registration_number')
+        email = self.normalize_email(extra_fields.pop('email', None))
+        extra_fields.setdefault('is_staff', False)
+        extra_fields.setdefault('is_superuser', False)
+
+        return self.model(
+            registration_number=registration_number,
+            email=email,
+            password=password_hash,
+            **extra_fields
+        )
+
+    def _bulk_insert_users(self, users):
+        users = self.bulk_create(users)
+
+        # backends that don't return primary keys from bulk inserts
+        if any(user.pk is None for user in users):
+            ids = dict(self.filter(
+                registration_number__in=[user.registration_number for user in users]
+            ).values_list('registration_number', 'id'))
+            for user in users:
+                user.pk = ids[user.registration_number]
+
+        Token.objects.bulk_create([
+            Token(user=user, key=Token().generate_key()) for user in users
+        ])
+
+        return users
 
     def _create_user(self, registration_number, email, password, **extra_fields):
         """
@@ -57,7 +180,4 @@ class CustomUserManager(UserManager):
         # create api token
         Token.objects.create(user=user)
 
-        # define user permissions
-        self.define_permissions(user)
-
         return user
@@ -0,0 +1,161 @@
+"""
+Denormalized access scopes.
+
+Membership rows answer the scope questions of the api (the users of an
+institution, the classes and programs of a teacher, the institution of a
+user) with one indexed read instead of joins through Course, Class and
+Program. Every admin, teacher and student profile has a row with its
+institution, and its program and class for students; teachers have one more
+row per course they teach.
+
+Rows are derived data: the signals refresh the rows of the users a profile,
+course, class or program change touches, in the database it was saved to,
+and rows written with bulk_create are refreshed by their callers. Changed
+rows bump the hierarchy graphs of their institutions. `rebuild` recomputes
+every row, as migration 0005 does on deploy, and `check` finds the users
+whose rows drifted, e.g. profiles written by the service owning the schema,
+see the rebuild_memberships and check_memberships commands.
+"""
+import collections
+import functools
+
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Q
+
+from . import hierarchy
+from .models import Admin, Course, Membership, Student, Teacher, User
+
+
+ROW_FIELDS = ('user_id', 'role', 'institution_id', 'program_id', 'class_id', 'course_id')
+
+BATCH_SIZE = 500
+
+
+def _batches(ids, batch_size):
+    ids = list(ids)
+    for start in range(0, len(ids), batch_size):
+        yield ids[start:start + batch_size]
+
+
+def expected_rows(user_ids, using=DEFAULT_DB_ALIAS):
+    """
+    Yield the membership rows of `user_ids` computed from their profiles,
+    as tuples of ROW_FIELDS.
+    """
+    admins = Admin.objects.using(using).filter(
+        user__in=user_ids, institution__isnull=False
+    ).values_list('user_id', 'institution_id')
+    for user_id, institution_id in admins:
+        yield user_id, Membership.ADMIN, institution_id, None, None, None
+
+    teachers = Teacher.objects.using(using).filter(
+        user__in=user_ids
+    ).values_list('user_id', 'institution_id')
+    for user_id, institution_id in teachers:
+        yield user_id, Membership.TEACHER, institution_id, None, None, None
+
+    # courses belong to the institution of their teacher, see CourseQuerySet
+    courses = Course.objects.using(using).filter(teacher__user__in=user_ids).values_list(
+        'teacher__user_id', 'teacher__institution_id', 'class_id__program_id', 'class_id_id', 'pk'
+    )
+    for user_id, institution_id, program_id, class_id, course_id in courses:
+        yield user_id, Membership.TEACHER, institution_id, program_id, class_id, course_id
+
+    students = Student.objects.using(using).filter(user__in=user_ids).values_list(
+        'user_id', 'class_id__program__institution_id', 'class_id__program_id', 'class_id_id'
+    )
+    for user_id, institution_id, program_id, class_id in students:
+        yield user_id, Membership.STUDENT, institution_id, program_id, class_id, None
+
+
+def _diff(user_ids, using):
+    """
+    Return the expected rows of `user_ids` and the rows of the users whose
+    rows in the table differ from them.
+    """
+    expected = collections.Counter(expected_rows(user_ids, using))
+    actual = collections.Counter(
+        Membership.objects.using(using).filter(user__in=user_ids).values_list(*ROW_FIELDS)
+    )
+    return expected, (expected - actual) + (actual - expected)
+
+
+def refresh(user_ids, using=DEFAULT_DB_ALIAS, batch_size=BATCH_SIZE):
+    """
+    Replace the membership rows of `user_ids` that changed in the `using`
+    database, and bump the hierarchy of their institutions. Returns the
+    number of rows written.
+    """
+    written = 0
+    for batch in _batches(set(user_ids) - {None}, batch_size):
+        with transaction.atomic(using=using):
+            expected, differences = _diff(batch, using)
+            changed = {row[0] for row in differences}
+            if not changed:
+                continue
+
+            Membership.objects.using(using).filter(user__in=changed).delete()
+            rows = Membership.objects.using(using).bulk_create([
+                Membership(**dict(zip(ROW_FIELDS, row)))
+                for row in expected.elements() if row[0] in changed
+            ])
+            written += len(rows)
+
+            institutions = {row[2] for row in differences}
+            transaction.on_commit(
+                functools.partial(hierarchy.bump_versions, institutions), using=using
+            )
+    return written
+
+
+def refresh_related(using, field, pk, **current):
+    """
+    Refresh the users with a membership row whose `field` is `pk`. Given
+    `current` values, only those of rows that disagree with them, e.g. the
+    rows of a class that moved to another program.
+    """
+    rows = Membership.objects.using(using).filter(**{field: pk})
+    if current:
+        condition = Q()
+        for name, value in current.items():
+            condition |= ~Q(**{name: value})
+        rows = rows.filter(condition)
+    return refresh(rows.values_list('user', flat=True).distinct(), using)
+
+
+def refresh_course(course, using=DEFAULT_DB_ALIAS):
+    """
+    Refresh the rows of the teacher of `course`, and of its previous
+    teacher if it changed.
+    """
+    users = set(
+        Membership.objects.using(using).filter(course_id=course.pk).values_list('user', flat=True)
+    )
+    users.update(
+        Teacher.objects.using(using).filter(pk=course.teacher_id).values_list('user', flat=True)
+    )
+    return refresh(users, using)
+
+
+def _user_ids(using):
+    return User.objects.using(using).order_by('pk').values_list('pk', flat=True)
+
+
+def rebuild(using=DEFAULT_DB_ALIAS, batch_size=BATCH_SIZE):
+    """
+    Recompute the membership rows of every user of the `using` database, a
+    batch of users per transaction. Returns the number of rows written.
+    """
+    return refresh(_user_ids(using), using, batch_size)
+
+
+def check(using=DEFAULT_DB_ALIAS, batch_size=BATCH_SIZE):
+    """
+    Return the ids of the users whose membership rows differ from the ones
+    computed from their profiles.
+    """
+    drifted = []
+    for batch in _batches(_user_ids(using), batch_size):
+        expected, differences = _diff(batch, using)
+        drifted.extend(sorted({row[0] for row in differences}))
+    return drifted
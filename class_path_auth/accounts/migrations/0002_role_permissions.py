@@ -0,0 +1,32 @@
+# Generated by Django 2.2.7 on 2026-10-18 16:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Scores',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('first_score', models.FloatField(null=True, verbose_name='first score')),
+                ('second_score', models.FloatField(null=True, verbose_name='second score')),
+                ('third_score', models.FloatField(null=True, verbose_name='third score')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='created at')),
+                ('modified_at', models.DateTimeField(auto_now=True, verbose_name='modified at')),
+            ],
+            options={
+                'db_table': 'scores',
+                'managed': False,
+            },
+        ),
+        migrations.AlterModelOptions(
+            name='user',
+            options={'get_latest_by': 'date_joined', 'managed': False, 'permissions': (('is_student', 'Is student'), ('is_teacher', 'Is teacher'), ('is_admin', 'Is admin'))},
+        ),
+    ]
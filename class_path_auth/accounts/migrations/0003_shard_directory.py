@@ -0,0 +1,35 @@
+# Generated by Django 2.2.7 on 2026-10-18 17:03
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0002_role_permissions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InstitutionShard',
+            fields=[
+                ('institution_id', models.IntegerField(primary_key=True, serialize=False, verbose_name='institution')),
+                ('database', models.CharField(max_length=100, verbose_name='database')),
+            ],
+            options={
+                'db_table': 'institution_shards',
+            },
+        ),
+        migrations.CreateModel(
+            name='ShardMember',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='shard_membership', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('institution_id', models.IntegerField(db_index=True, verbose_name='institution')),
+            ],
+            options={
+                'db_table': 'shard_members',
+            },
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 2.2.7 on 2026-10-18 17:13
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0003_shard_directory'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Membership',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('role', models.CharField(choices=[('admin', 'admin'), ('teacher', 'teacher'), ('student', 'student')], max_length=10, verbose_name='role')),
+                ('institution_id', models.IntegerField(verbose_name='institution')),
+                ('program_id', models.IntegerField(db_index=True, null=True, verbose_name='program')),
+                ('class_id', models.IntegerField(db_index=True, null=True, verbose_name='class')),
+                ('course_id', models.IntegerField(db_index=True, null=True, verbose_name='course')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'memberships',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='membership',
+            index=models.Index(fields=['institution_id', 'role'], name='memberships_institution'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+from django.db import migrations
+
+
+def backfill_memberships(apps, schema_editor):
+    # rows are computed by the live module, the same code the signals use
+    from class_path_auth.accounts import memberships
+
+    connection = schema_editor.connection
+    if 'users' not in connection.introspection.table_names():
+        # the accounts schema is owned by another service, a database it
+        # hasn't created yet has no profiles to backfill from
+        return
+
+    memberships.rebuild(connection.alias)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0004_memberships'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_memberships, migrations.RunPython.noop),
+    ]
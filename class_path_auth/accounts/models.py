@@ -5,7 +5,10 @@ from django.db import models
 
 from django.utils.translation import gettext_lazy as _
 
-from .managers import CustomUserManager
+from .managers import (
+    ClassQuerySet, CourseQuerySet, CustomUserManager, MembershipQuerySet,
+    ScoresQuerySet, StudentQuerySet,
+)
 
 
 class User(AbstractUser):
@@ -28,10 +31,61 @@ class User(AbstractUser):
     class Meta:
         db_table = 'users'
         managed = False
+        get_latest_by = 'date_joined'
+        # role permissions, created by the post_migrate hook and granted by
+        # RolePermissionBackend from the role flags
+        permissions = (
+            ('is_student', 'Is student'),
+            ('is_teacher', 'Is teacher'),
+            ('is_admin', 'Is admin'),
+        )
 
     def __str__(self):
         return self.email
 
+    def refresh_from_db(self, using=None, fields=None):
+        # users built from signed token claims load all their deferred
+        # columns at once, on the first access to any of them
+        if fields is not None and getattr(self, '_load_deferred_together', False):
+            self._load_deferred_together = False
+            self.load_deferred_fields(using)
+            fields = [f for f in fields if f in self.get_deferred_fields()]
+            if not fields:
+                return
+        super().refresh_from_db(using, fields)
+
+    def load_deferred_fields(self, using=None):
+        """
+        Load every deferred field of the user, and its api token, in one query.
+        """
+        deferred_fields = self.get_deferred_fields()
+        db_instance = User._base_manager.db_manager(using or self._state.db).select_related(
+            'auth_token'
+        ).get(pk=self.pk)
+
+        for attname in deferred_fields:
+            setattr(self, attname, getattr(db_instance, attname))
+
+        auth_token = self._meta.get_field('auth_token')
+        if auth_token.is_cached(db_instance):
+            auth_token.set_cached_value(self, auth_token.get_cached_value(db_instance))
+
+    def get_institution_id(self):
+        """
+        Return the id of the institution the user belongs to, in one query.
+        """
+        if self.is_student:
+            role = Membership.STUDENT
+        elif self.is_teacher:
+            role = Membership.TEACHER
+        elif self.is_admin:
+            role = Membership.ADMIN
+        else:
+            return None
+
+        memberships = Membership.objects.filter(user=self, role=role)
+        return memberships.values_list('institution_id', flat=True).first()
+
 
 class Profile(models.Model):
     cpf = models.CharField(
@@ -97,6 +151,8 @@ class Class(models.Model):
     created_at = models.DateTimeField(_('created_at'), auto_now_add=True)
     modified_at = models.DateTimeField(_('modified_at'), auto_now=True)
 
+    objects = ClassQuerySet.as_manager()
+
     class Meta:
         db_table = 'class'
         managed = False
@@ -159,6 +215,8 @@ class Student(Profile):
     created_at = models.DateTimeField(_('created at'), auto_now_add=True)
     modified_at = models.DateTimeField(_('modified at'), auto_now=True)
 
+    objects = StudentQuerySet.as_manager()
+
     class Meta:
         db_table = 'student'
         managed = False
@@ -209,6 +267,8 @@ class Course(models.Model):
     created_at = models.DateTimeField(_('created at'), auto_now_add=True)
     modified_at = models.DateTimeField(_('modified at'), auto_now=True)
 
+    objects = CourseQuerySet.as_manager()
+
     class Meta:
         db_table = 'course'
         managed = False
@@ -234,9 +294,79 @@ class Scores(models.Model):
     created_at = models.DateTimeField(_('created at'), auto_now_add=True)
     modified_at = models.DateTimeField(_('modified at'), auto_now=True)
 
+    objects = ScoresQuerySet.as_manager()
+
     class Meta:
         db_table = 'scores'
         managed = False
 
     def __str__(self):
         return self.name
+
+
+class Membership(models.Model):
+    """
+    Denormalized scope of a user: one row per profile, with the institution,
+    program and class it belongs to, plus one row per course of a teacher.
+    Derived from the profiles, courses, classes and programs and kept up to
+    date by accounts.memberships.
+    """
+    ADMIN = 'admin'
+    TEACHER = 'teacher'
+    STUDENT = 'student'
+    ROLE_CHOICES = (
+        (ADMIN, _('admin')),
+        (TEACHER, _('teacher')),
+        (STUDENT, _('student')),
+    )
+
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='memberships'
+    )
+    role = models.CharField(_('role'), max_length=10, choices=ROLE_CHOICES)
+    institution_id = models.IntegerField(_('institution'))
+    program_id = models.IntegerField(_('program'), null=True, db_index=True)
+    class_id = models.IntegerField(_('class'), null=True, db_index=True)
+    course_id = models.IntegerField(_('course'), null=True, db_index=True)
+
+    objects = MembershipQuerySet.as_manager()
+
+    class Meta:
+        db_table = 'memberships'
+        indexes = [
+            models.Index(fields=['institution_id', 'role'], name='memberships_institution'),
+        ]
+
+
+class InstitutionShard(models.Model):
+    """
+    Directory entry of an institution moved out of the default database, or
+    whose id was allocated by the directory, naming the database alias
+    holding its rows.
+    """
+    institution_id = models.IntegerField(_('institution'), primary_key=True)
+    database = models.CharField(_('database'), max_length=100)
+
+    class Meta:
+        db_table = 'institution_shards'
+
+    def __str__(self):
+        return '%s: %s' % (self.institution_id, self.database)
+
+
+class ShardMember(models.Model):
+    """
+    Directory entry of a user of an institution listed in InstitutionShard.
+    """
+    user = models.OneToOneField(
+        User,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='shard_membership'
+    )
+    institution_id = models.IntegerField(_('institution'), db_index=True)
+
+    class Meta:
+        db_table = 'shard_members'
@@ -0,0 +1,157 @@
+"""
+Per-user cache of the rendered my-* responses.
+
+Entries are stored in a shared cache under the view, the user and the
+requested path, along with the versions of the tags they depend on, such as
+('user', 3) or ('class', 12). Signals bump the version of a tag when one of
+its rows changes, so an entry is served only while every row it was rendered
+from is unchanged, and unrelated users keep their entries.
+"""
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+from rest_framework.response import Response
+
+from ..db.replicas import read_from_primary
+from .cache import registry
+from .models import Student
+
+
+def get_cache():
+    return caches[settings.RESPONSE_CACHE_ALIAS]
+
+
+def _tag_key(tag):
+    return 'response-tag:%s:%s' % tag
+
+
+def bump_tags(tags):
+    cache = get_cache()
+    for tag in tags:
+        try:
+            cache.incr(_tag_key(tag))
+        except ValueError:
+            cache.set(_tag_key(tag), int(time.time() * 1000000), None)
+
+
+class ResponseCache:
+
+    def __init__(self, name):
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+
+        registry[name] = self
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def get_versions(self, tags):
+        """
+        Return the current version of each tag, to be stored with an entry
+        rendered afterwards.
+        """
+        cache = get_cache()
+        keys = [_tag_key(tag) for tag in tags]
+
+        versions = cache.get_many(keys)
+        for key in keys:
+            if key not in versions:
+                # start from the clock so a lost version never reuses an old one
+                cache.add(key, int(time.time() * 1000000), None)
+                versions[key] = cache.get(key)
+
+        return versions
+
+    def get(self, key):
+        cache = get_cache()
+
+        entry = cache.get(key)
+        if entry is not None:
+            versions, data = entry
+            if cache.get_many(list(versions)) == versions:
+                self._count('hits')
+                return data
+            self._count('invalidations')
+
+        self._count('misses')
+        return None
+
+    def set(self, key, versions, data):
+        get_cache().set(key, (versions, data), settings.RESPONSE_CACHE_TTL)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+response_cache = ResponseCache('responses')
+
+
+def get_user_tags(user):
+    """
+    Return the tags of a response rendering the user and its profile.
+    """
+    tags = [('user', user.pk)]
+
+    if user.is_student:
+        student = Student.objects.filter(user=user).values_list(
+            'class_id', 'class_id__program'
+        ).first()
+        if student is not None:
+            # the nested user of a student profile renders its groups
+            tags += [('class', student[0]), ('program', student[1]), ('groups', 'all')]
+
+    return tags
+
+
+class CachedResponseMixin:
+    """
+    Serve the GETs of a view from the per-user response cache.
+
+    Views return the tags their response depends on from `get_cache_tags`,
+    which is only called on misses, before rendering.
+    """
+
+    def get_cache_tags(self):
+        raise NotImplementedError
+
+    def get_cache_key(self):
+        path = hashlib.md5(self.request.get_full_path().encode()).hexdigest()
+        return 'response:%s:%s:%s' % (self.__class__.__name__, self.request.user.pk, path)
+
+    def get_cached_response(self, handler, request, *args, **kwargs):
+        if not settings.RESPONSE_CACHE_TTL:
+            return handler(request, *args, **kwargs)
+
+        key = self.get_cache_key()
+        data = response_cache.get(key)
+        if data is not None:
+            return Response(data)
+
+        # a lagging replica would store stale rows under the current versions
+        with read_from_primary():
+            versions = response_cache.get_versions(self.get_cache_tags())
+            response = handler(request, *args, **kwargs)
+        if response.status_code == 200:
+            response_cache.set(key, versions, response.data)
+
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.get_cached_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.get_cached_response(super().retrieve, request, *args, **kwargs)
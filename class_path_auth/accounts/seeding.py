@@ -0,0 +1,346 @@
+"""
+Synthetic institution data for load benchmarks.
+
+`seed` fills the database with institutions, programs, classes, admins,
+teachers, students, addresses, courses and scores, scaled from a number of
+users. The dataset only depends on the number of users and the random seed:
+primary keys, names, tokens and scores are generated, so two runs with the
+same arguments produce the same rows and benchmark results can be compared
+between releases.
+
+Every user shares one password, hashed once, and rows are inserted with
+explicit primary keys in batches, which keeps seeding 100k users within a
+few minutes.
+"""
+import itertools
+import random
+
+from django.apps import apps
+from django.contrib.auth.hashers import make_password
+from django.core.management.color import no_style
+from django.db import connections, router, transaction
+from django.db.models import Max
+
+from rest_framework.authtoken.models import Token
+
+from . import memberships
+from .gradebook import SCORE_FIELDS
+from .models import (
+    Address, Admin, Class, Course, Institution, Membership, Program, Scores, Student,
+    Teacher, User,
+)
+
+
+USERS_PER_INSTITUTION = 2000
+PROGRAMS_PER_INSTITUTION = 4
+CLASSES_PER_PROGRAM = 5
+COURSES_PER_CLASS = 6
+TEACHERS_PER_CLASS = 3
+# share of the scores of each column already given
+SCORED = (1.0, 0.8, 0.5)
+
+SEEDED_MODELS = (
+    Institution, Program, Class, User, Token, Admin, Teacher, Student, Address, Course, Scores
+)
+
+FIRST_NAMES = (
+    'Ana', 'Bruno', 'Carla', 'Daniel', 'Eduarda', 'Felipe', 'Gabriela', 'Heitor',
+    'Isabela', 'João', 'Larissa', 'Lucas', 'Mariana', 'Miguel', 'Natália', 'Pedro',
+    'Rafaela', 'Samuel', 'Sofia', 'Thiago', 'Valentina', 'Vinícius',
+)
+LAST_NAMES = (
+    'Almeida', 'Barbosa', 'Cardoso', 'Carvalho', 'Costa', 'Ferreira', 'Gomes',
+    'Lima', 'Martins', 'Oliveira', 'Pereira', 'Ribeiro', 'Rocha', 'Santos',
+    'Silva', 'Souza',
+)
+STATES = (
+    ('PI', 'Teresina'), ('CE', 'Fortaleza'), ('MA', 'São Luís'),
+    ('PE', 'Recife'), ('BA', 'Salvador'), ('SP', 'São Paulo'),
+)
+SUBJECTS = (
+    'Matemática', 'Português', 'Física', 'Química', 'Biologia', 'História',
+    'Geografia', 'Inglês', 'Filosofia', 'Sociologia', 'Artes', 'Programação',
+)
+
+
+def get_scale(users):
+    """
+    Return the number of rows of each model seeded for `users` users.
+    """
+    institutions = max(1, round(users / USERS_PER_INSTITUTION))
+    classes = institutions * PROGRAMS_PER_INSTITUTION * CLASSES_PER_PROGRAM
+    teachers = max(institutions, min(classes * TEACHERS_PER_CLASS, users // 10))
+    # plus one staff user, allowed into the operations endpoints
+    students = users - institutions - teachers - 1
+    if students < classes:
+        raise ValueError(
+            'At least %d users are needed to give every class a student.'
+            % (institutions + teachers + classes + 1)
+        )
+
+    courses = classes * COURSES_PER_CLASS
+    return {
+        'institutions': institutions,
+        'programs': institutions * PROGRAMS_PER_INSTITUTION,
+        'classes': classes,
+        'users': users,
+        'admins': institutions,
+        'teachers': teachers,
+        'staff': 1,
+        'students': students,
+        'addresses': users,
+        'courses': courses,
+        'scores': students * COURSES_PER_CLASS,
+    }
+
+
+def registration_number(prefix, role, number):
+    return '%s-%s%07d' % (prefix, role, number)
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class Seeder:
+    """
+    Insert one synthetic dataset, see `seed`.
+    """
+
+    def __init__(self, users, random_seed=0, prefix='bench', password='benchmark',
+                 batch_size=1000, using=None, log=None):
+        self.scale = get_scale(users)
+        self.random = random.Random(random_seed)
+        self.prefix = prefix
+        self.password_hash = make_password(password)
+        self.batch_size = batch_size
+        self.using = using or router.db_for_write(User)
+        self.log = log or (lambda message: None)
+        self.next_ids = {}
+
+    def next_id(self, model):
+        if model not in self.next_ids:
+            last = model.objects.using(self.using).aggregate(last=Max('pk'))['last']
+            self.next_ids[model] = itertools.count((last or 0) + 1)
+        return next(self.next_ids[model])
+
+    def insert(self, model, objs):
+        count = 0
+        for batch in _chunks(objs, self.batch_size):
+            model.objects.using(self.using).bulk_create(batch)
+            count += len(batch)
+        self.log('%s: %d rows' % (model._meta.db_table, count))
+
+    def name(self):
+        return self.random.choice(FIRST_NAMES), self.random.choice(LAST_NAMES)
+
+    def token_key(self):
+        return '%040x' % self.random.getrandbits(160)
+
+    def build_user(self, role, number, **flags):
+        first_name, last_name = self.name()
+        registration = registration_number(self.prefix, role, number)
+        return User(
+            pk=self.next_id(User),
+            registration_number=registration,
+            email='%s@%s.example.com' % (registration, self.prefix),
+            password=self.password_hash,
+            first_name=first_name,
+            last_name=last_name,
+            **flags
+        )
+
+    def build_address(self, user):
+        state, city = self.random.choice(STATES)
+        return Address(
+            pk=self.next_id(Address),
+            user_id=user.pk,
+            state=state,
+            city=city,
+            street='Rua %s' % self.random.choice(LAST_NAMES),
+            neighborhood='Bairro %s' % self.random.choice(LAST_NAMES),
+            number=self.random.randint(1, 3000),
+            postal_code='%05d-%03d' % (self.random.randint(0, 99999), self.random.randint(0, 999)),
+        )
+
+    def cpf(self):
+        return '%011d' % self.random.randint(0, 10 ** 11 - 1)
+
+    def build_score(self, student_id, course_id):
+        values = {
+            field: round(self.random.triangular(0, 10, 7), 1)
+            if self.random.random() < share else None
+            for field, share in zip(SCORE_FIELDS, SCORED)
+        }
+        return Scores(pk=self.next_id(Scores), student_id=student_id, course_id=course_id, **values)
+
+    def insert_users(self, users, profiles):
+        """
+        Insert users with their tokens, addresses and role profiles.
+        """
+        self.insert(User, users)
+        self.insert(Token, (Token(key=self.token_key(), user_id=user.pk) for user in users))
+        self.insert(Address, (self.build_address(user) for user in users))
+        for model, objs in profiles:
+            self.insert(model, objs)
+
+    def run(self):
+        scale = self.scale
+        institutions = [
+            Institution(pk=self.next_id(Institution), name='Instituição %d' % number)
+            for number in range(1, scale['institutions'] + 1)
+        ]
+        self.insert(Institution, institutions)
+
+        programs = [
+            Program(
+                pk=self.next_id(Program),
+                name='Programa %d' % number,
+                institution_id=institution.pk,
+            )
+            for institution in institutions
+            for number in range(1, PROGRAMS_PER_INSTITUTION + 1)
+        ]
+        self.insert(Program, programs)
+
+        classes = [
+            Class(pk=self.next_id(Class), name='Turma %d' % number, program_id=program.pk)
+            for program in programs
+            for number in range(1, CLASSES_PER_PROGRAM + 1)
+        ]
+        self.insert(Class, classes)
+        institution_of_class = {
+            klass.pk: institutions[index // (PROGRAMS_PER_INSTITUTION * CLASSES_PER_PROGRAM)].pk
+            for index, klass in enumerate(classes)
+        }
+
+        self.insert_users([self.build_user('o', 1, is_staff=True)], [])
+
+        admin_users = [
+            self.build_user('a', number, is_admin=True)
+            for number in range(1, scale['admins'] + 1)
+        ]
+        self.insert_users(admin_users, [(Admin, (
+            Admin(pk=self.next_id(Admin), user_id=user.pk, institution_id=institution.pk)
+            for user, institution in zip(admin_users, institutions)
+        ))])
+
+        # teachers and students are spread evenly over the institutions
+        teacher_users = [
+            self.build_user('t', number, is_teacher=True)
+            for number in range(1, scale['teachers'] + 1)
+        ]
+        teachers = [
+            Teacher(
+                pk=self.next_id(Teacher),
+                user_id=user.pk,
+                institution_id=institutions[index % len(institutions)].pk,
+                cpf=self.cpf(),
+            )
+            for index, user in enumerate(teacher_users)
+        ]
+        self.insert_users(teacher_users, [(Teacher, teachers)])
+
+        teachers_by_institution = {}
+        for teacher in teachers:
+            teachers_by_institution.setdefault(teacher.institution_id, []).append(teacher.pk)
+
+        courses = [
+            Course(
+                pk=self.next_id(Course),
+                name=SUBJECTS[(klass.pk + number) % len(SUBJECTS)],
+                class_id_id=klass.pk,
+                teacher_id=self.random.choice(
+                    teachers_by_institution[institution_of_class[klass.pk]]
+                ),
+            )
+            for klass in classes
+            for number in range(COURSES_PER_CLASS)
+        ]
+        self.insert(Course, courses)
+        courses_by_class = {}
+        for course in courses:
+            courses_by_class.setdefault(course.class_id_id, []).append(course.pk)
+
+        students = []
+        for start in range(0, scale['students'], self.batch_size):
+            stop = min(start + self.batch_size, scale['students'])
+            student_users = [
+                self.build_user('s', number, is_student=True)
+                for number in range(start + 1, stop + 1)
+            ]
+            batch = [
+                Student(
+                    pk=self.next_id(Student),
+                    user_id=user.pk,
+                    class_id_id=classes[(start + index) % len(classes)].pk,
+                    cpf=self.cpf(),
+                )
+                for index, user in enumerate(student_users)
+            ]
+            self.insert_users(student_users, [(Student, batch)])
+            students.extend((student.pk, student.class_id_id) for student in batch)
+
+        self.insert(Scores, (
+            self.build_score(student_id, course_id)
+            for student_id, class_id in students
+            for course_id in courses_by_class[class_id]
+        ))
+
+        seeded = User.objects.using(self.using).filter(
+            registration_number__startswith='%s-' % self.prefix
+        )
+        rows = memberships.refresh(seeded.values_list('pk', flat=True), self.using)
+        self.log('%s: %d rows' % (Membership._meta.db_table, rows))
+
+        self.reset_sequences()
+        return scale
+
+    def reset_sequences(self):
+        # rows were inserted with explicit keys, move the sequences past them
+        connection = connections[self.using]
+        statements = connection.ops.sequence_reset_sql(no_style(), SEEDED_MODELS)
+        with connection.cursor() as cursor:
+            for statement in statements:
+                cursor.execute(statement)
+
+
+def seed(users, **kwargs):
+    """
+    Seed a synthetic dataset of `users` users, returning the number of rows
+    of each model. Accepts the keyword arguments of `Seeder`.
+    """
+    seeder = Seeder(users, **kwargs)
+    with transaction.atomic(using=seeder.using):
+        return seeder.run()
+
+
+def create_schema(using=None):
+    """
+    Create the missing tables of the unmanaged accounts models, which are
+    owned by another service and never created by the migrations.
+    """
+    using = using or router.db_for_write(User)
+    connection = connections[using]
+    existing = set(connection.introspection.table_names())
+
+    created = []
+    with connection.schema_editor() as editor:
+        for model in apps.get_app_config('accounts').get_models():
+            if model._meta.managed or model._meta.db_table in existing:
+                continue
+
+            # the schema editor leaves out the indexes of unmanaged models
+            model._meta.managed = True
+            try:
+                editor.create_model(model)
+            finally:
+                model._meta.managed = False
+            created.append(model._meta.db_table)
+
+    return created
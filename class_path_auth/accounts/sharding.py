@@ -0,0 +1,527 @@
+"""
+Institution sharding.
+
+Every accounts model hangs off an institution, so the rows of each one
+(programs, classes, profiles, courses, scores, and its members' users and
+addresses) can live in their own database, one of DATABASE_SHARDS.
+Institutions stay in the default database until moved with
+`move_institution`.
+
+The default database is also the directory: it holds every user and token,
+so logins and authentications never need to know the shard, plus the
+InstitutionShard and ShardMember entries mapping moved institutions and
+their users to their shard. Shards keep a copy of the users of their
+institutions and of their tokens, which their queries join; both are
+saved to the directory and the copies follow, see `sync_user` and
+`sync_token`.
+
+ShardMiddleware routes each request, once authenticated, to the shard of
+its user, and InstitutionShardRouter sends the institution models there.
+Outside of requests, `use_shard` picks the shard.
+
+Institution ids are global, the directory routes by them, so they are
+allocated from the directory (see `allocate_institution_id`) and a new
+institution whose id is listed for another database is refused. The other
+rows created in a shard take their primary keys from its own sequences;
+`move_institution` refuses to copy rows whose keys are taken in the target.
+"""
+import contextlib
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured, MiddlewareNotUsed
+from django.core.management.color import no_style
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, connections, transaction
+from django.db.models import Max, Q, Subquery
+
+from rest_framework.authtoken.models import Token
+from rest_framework.permissions import SAFE_METHODS
+
+from ..db.replicas import get_authenticated_user
+from . import memberships
+from .cache import LRUCache
+from .models import (
+    Address, Admin, Class, Course, Institution, InstitutionShard, Membership,
+    Program, Scores, ShardMember, Student, Teacher, User,
+)
+
+
+# rows of an institution, parents first
+SHARDED_MODELS = (
+    Institution, Program, Class, User, Address, Admin, Teacher, Student, Course, Scores,
+    Membership,
+)
+
+# directory rows the shards keep a copy of, for their queries to join
+DIRECTORY_COPIES = (User, Token)
+
+_local = threading.local()
+
+directory_cache = LRUCache(
+    name='shard-directory',
+    maxsize=settings.SHARD_DIRECTORY_CACHE_SIZE,
+    ttl=settings.SHARD_DIRECTORY_TTL,
+)
+
+
+def is_shard(alias):
+    return alias in settings.DATABASE_SHARDS
+
+
+def check_shard(alias):
+    if alias != DEFAULT_DB_ALIAS and not is_shard(alias):
+        raise ImproperlyConfigured('%r is not one of the DATABASE_SHARDS.' % alias)
+    return alias
+
+
+def get_institution_shard(institution_id):
+    """
+    Return the alias of the database holding the institution.
+    """
+    key = ('institution', institution_id)
+    alias = directory_cache.get(key)
+    if alias is None:
+        alias = InstitutionShard.objects.filter(
+            institution_id=institution_id
+        ).values_list('database', flat=True).first() or DEFAULT_DB_ALIAS
+        directory_cache.set(key, alias)
+    return check_shard(alias)
+
+
+def get_user_shard(user_id):
+    """
+    Return the alias of the database holding the user's institution.
+    """
+    key = ('user', user_id)
+    alias = directory_cache.get(key)
+    if alias is None:
+        institution = ShardMember.objects.filter(user=user_id).values('institution_id')
+        alias = InstitutionShard.objects.filter(
+            institution_id=Subquery(institution)
+        ).values_list('database', flat=True).first() or DEFAULT_DB_ALIAS
+        directory_cache.set(key, alias)
+    return check_shard(alias)
+
+
+def get_current_shard():
+    """
+    Return the shard the institution models are routed to, None when it's
+    the default database or not known yet.
+    """
+    alias = getattr(_local, 'shard', None)
+    if alias is None:
+        request = getattr(_local, 'request', None)
+        if request is None:
+            return None
+
+        alias = request.__dict__.get('_shard')
+        if alias is None:
+            user = get_authenticated_user(request)
+            if user is None:
+                return None
+            alias = request._shard = get_user_shard(user.pk)
+
+    return alias if alias != DEFAULT_DB_ALIAS else None
+
+
+@contextlib.contextmanager
+def use_shard(alias):
+    """
+    Route the institution models to the `alias` shard within the block.
+    """
+    previous = getattr(_local, 'shard', None)
+    _local.shard = check_shard(alias)
+    try:
+        yield
+    finally:
+        _local.shard = previous
+
+
+class InstitutionShardRouter:
+    """
+    Route the institution models to the current shard, and rows related to
+    an instance to the database it was read from. Users are read from the
+    shard once it is known by safe requests, and always written to the
+    directory.
+    """
+
+    def _route(self, model, hints):
+        if not settings.DATABASE_SHARDS:
+            return None
+
+        instance = hints.get('instance')
+        related = instance is not None and is_shard(instance._state.db)
+        if model not in SHARDED_MODELS:
+            # e.g. the token or groups of a user read from a shard
+            return DEFAULT_DB_ALIAS if related else None
+        if related:
+            return instance._state.db
+        return get_current_shard()
+
+    def db_for_read(self, model, **hints):
+        request = getattr(_local, 'request', None)
+        if model is User and request is not None and request.method not in SAFE_METHODS:
+            # writes check users against the directory, e.g. for uniqueness
+            return DEFAULT_DB_ALIAS
+        return self._route(model, hints)
+
+    def db_for_write(self, model, **hints):
+        if model is User:
+            return DEFAULT_DB_ALIAS if settings.DATABASE_SHARDS else None
+        return self._route(model, hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if is_shard(obj1._state.db) or is_shard(obj2._state.db):
+            return True
+        return None
+
+
+class ShardMiddleware:
+
+    def __init__(self, get_response):
+        if not settings.DATABASE_SHARDS:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        _local.request = request
+        try:
+            response = self.get_response(request)
+        except Exception:
+            _local.request = None
+            raise
+
+        if response.streaming:
+            # streamed content is read after the middleware returns
+            response._closable_objects.append(self)
+        else:
+            self.close()
+
+        return response
+
+    def close(self):
+        _local.request = None
+
+
+def copy_rows(model, pks, source, target, batch_size=1000):
+    """
+    Insert the `source` rows of `model` into `target` as they are, keeping
+    the timestamps bulk_create would set. Returns the number of rows copied.
+    """
+    connection = connections[target]
+    fields = model._meta.concrete_fields
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+        connection.ops.quote_name(model._meta.db_table),
+        ', '.join(connection.ops.quote_name(field.column) for field in fields),
+        ', '.join(['%s'] * len(fields)),
+    )
+
+    copied = 0
+    with connection.cursor() as cursor:
+        for start in range(0, len(pks), batch_size):
+            batch = pks[start:start + batch_size]
+            if model in DIRECTORY_COPIES:
+                # the copies already there are kept in sync
+                existing = set(
+                    model._base_manager.using(target).filter(pk__in=batch)
+                    .values_list('pk', flat=True)
+                )
+                batch = [pk for pk in batch if pk not in existing]
+
+            rows = model._base_manager.using(source).filter(pk__in=batch).values_list(
+                *[field.attname for field in fields]
+            )
+            params = [
+                [field.get_db_prep_save(value, connection) for field, value in zip(fields, row)]
+                for row in rows
+            ]
+            cursor.executemany(sql, params)
+            copied += len(params)
+
+    return copied
+
+
+def add_members(institution_id, users, using):
+    """
+    Copy `users` and their tokens to the `using` shard of their institution
+    and list them in the directory. Must run before their profiles are
+    created there.
+    """
+    if using == DEFAULT_DB_ALIAS:
+        return
+
+    ids = [user.pk for user in users]
+    copy_rows(User, ids, DEFAULT_DB_ALIAS, using)
+    copy_rows(
+        Token,
+        list(Token.objects.using(DEFAULT_DB_ALIAS).filter(user__in=ids).values_list('pk', flat=True)),
+        DEFAULT_DB_ALIAS,
+        using
+    )
+    set_members(institution_id, ids)
+
+
+def set_members(institution_id, user_ids):
+    ShardMember.objects.filter(user__in=user_ids).delete()
+    ShardMember.objects.bulk_create([
+        ShardMember(user_id=user_id, institution_id=institution_id) for user_id in user_ids
+    ])
+    for user_id in user_ids:
+        directory_cache.delete(('user', user_id))
+
+
+def allocate_institution_id(using):
+    """
+    Reserve the next institution id in the directory for an institution
+    about to be created in the `using` database.
+
+    The id follows every institution of the default database and every id
+    listed in the directory, and is listed for `using` before the
+    institution is created, so no other database can take it.
+    """
+    for _ in range(3):
+        last_ids = [
+            Institution.objects.using(DEFAULT_DB_ALIAS).aggregate(last=Max('pk'))['last'],
+            InstitutionShard.objects.aggregate(last=Max('institution_id'))['last'],
+        ]
+        institution_id = max(last_id or 0 for last_id in last_ids) + 1
+        try:
+            with transaction.atomic(using=DEFAULT_DB_ALIAS):
+                InstitutionShard.objects.create(institution_id=institution_id, database=using)
+        except IntegrityError:
+            # taken by a concurrent allocation
+            continue
+
+        directory_cache.delete(('institution', institution_id))
+        return institution_id
+
+    raise IntegrityError('Could not allocate an institution id in the directory.')
+
+
+def register_institution(institution, user_ids=()):
+    """
+    List an institution created in a shard, and the users moved to it, in
+    the directory.
+
+    Raises IntegrityError when its id belongs to an institution of another
+    database, which the directory would otherwise route to this one.
+    """
+    if not settings.DATABASE_SHARDS:
+        return
+
+    using = institution._state.db
+    listed = InstitutionShard.objects.filter(
+        institution_id=institution.pk
+    ).values_list('database', flat=True).first()
+
+    if listed is not None and listed != using:
+        raise IntegrityError(
+            'Institution id %s is already listed in %s, not %s.' % (institution.pk, listed, using)
+        )
+    if using == DEFAULT_DB_ALIAS:
+        return
+
+    if listed is None:
+        if Institution.objects.using(DEFAULT_DB_ALIAS).filter(pk=institution.pk).exists():
+            raise IntegrityError(
+                'Institution id %s is taken in %s.' % (institution.pk, DEFAULT_DB_ALIAS)
+            )
+        InstitutionShard.objects.create(institution_id=institution.pk, database=using)
+
+    directory_cache.delete(('institution', institution.pk))
+    set_members(institution.pk, list(user_ids))
+
+
+def sync_user(user, update_fields=None, deleted=False):
+    """
+    Apply a change of a directory user to its copy in the user's shard.
+    """
+    if not settings.DATABASE_SHARDS:
+        return
+
+    alias = get_user_shard(user.pk)
+    if alias == DEFAULT_DB_ALIAS:
+        return
+
+    copies = User.objects.using(alias).filter(pk=user.pk)
+    if deleted:
+        copies.delete()
+        return
+
+    fields = [
+        field for field in User._meta.concrete_fields
+        if not field.primary_key and (update_fields is None or field.name in update_fields)
+    ]
+    copies.update(**{field.attname: getattr(user, field.attname) for field in fields})
+
+
+def sync_token(token, deleted=False):
+    """
+    Replace the copy of a directory token in its user's shard.
+    """
+    if not settings.DATABASE_SHARDS:
+        return
+
+    alias = get_user_shard(token.user_id)
+    if alias == DEFAULT_DB_ALIAS:
+        return
+
+    # users have a single token
+    Token.objects.using(alias).filter(user=token.user_id).delete()
+    if not deleted:
+        copy_rows(Token, [token.pk], DEFAULT_DB_ALIAS, alias)
+
+
+class InstitutionMover:
+    """
+    Move the rows of an institution to another database.
+
+    Rows are copied to the target, the directory is switched to it, then
+    they are deleted from the source. Memberships are derived rows, rebuilt
+    in the target rather than copied with their keys. Writes to the
+    institution must be stopped meanwhile; other processes follow the
+    directory within SHARD_DIRECTORY_TTL seconds.
+    """
+
+    def __init__(self, institution_id, target, batch_size=1000, log=None):
+        self.institution_id = institution_id
+        self.source = get_institution_shard(institution_id)
+        self.target = check_shard(target)
+        self.batch_size = batch_size
+        self.log = log or (lambda message: None)
+
+        if self.source == self.target:
+            raise ValueError('Institution %s is already in %s.' % (institution_id, target))
+
+    def get_querysets(self):
+        """
+        Return the (model, queryset) pairs of the institution's rows in the
+        source database, parents first.
+        """
+        institution = self.institution_id
+        users = User.objects.using(self.source).filter(
+            Q(admin__institution=institution)
+            | Q(teacher__institution=institution)
+            | Q(student__class_id__program__institution=institution)
+        ).distinct()
+        courses = Course.objects.filter(
+            Q(class_id__program__institution=institution) | Q(teacher__institution=institution)
+        ).distinct()
+
+        querysets = [
+            (Institution, Institution.objects.filter(pk=institution)),
+            (Program, Program.objects.filter(institution=institution)),
+            (Class, Class.objects.filter(program__institution=institution)),
+            (User, users),
+            (Token, Token.objects.filter(user__in=users)),
+            (Address, Address.objects.filter(user__in=users)),
+            (Admin, Admin.objects.filter(institution=institution)),
+            (Teacher, Teacher.objects.filter(institution=institution)),
+            (Student, Student.objects.filter(class_id__program__institution=institution)),
+            (Course, courses),
+            (Scores, Scores.objects.filter(course__in=courses)),
+        ]
+        return [(model, queryset.using(self.source)) for model, queryset in querysets]
+
+    def collect(self):
+        """
+        Return the primary keys of the institution's rows, by model.
+        """
+        return [
+            (model, list(queryset.order_by('pk').values_list('pk', flat=True)))
+            for model, queryset in self.get_querysets()
+        ]
+
+    def batches(self, pks):
+        for start in range(0, len(pks), self.batch_size):
+            yield pks[start:start + self.batch_size]
+
+    def check_conflicts(self, rows):
+        for model, pks in rows:
+            if model in DIRECTORY_COPIES:
+                continue
+            for batch in self.batches(pks):
+                taken = model._base_manager.using(self.target).filter(pk__in=batch)
+                if taken.exists():
+                    raise ValueError(
+                        '%s keys %s are already taken in %s.' % (
+                            model._meta.db_table,
+                            ', '.join(map(str, taken.values_list('pk', flat=True)[:10])),
+                            self.target,
+                        )
+                    )
+
+    def without_directory_copies(self, rows, using):
+        # the directory keeps every user and token
+        if using != DEFAULT_DB_ALIAS:
+            return rows
+        return [(model, pks) for model, pks in rows if model not in DIRECTORY_COPIES]
+
+    def delete(self, using, rows):
+        """
+        Delete the rows without cascades or signals, children first.
+        """
+        connection = connections[using]
+        with connection.cursor() as cursor:
+            for model, pks in reversed(rows):
+                sql = 'DELETE FROM %s WHERE %s IN (%%s)' % (
+                    connection.ops.quote_name(model._meta.db_table),
+                    connection.ops.quote_name(model._meta.pk.column),
+                )
+                for batch in self.batches(pks):
+                    cursor.execute(sql % ', '.join(['%s'] * len(batch)), batch)
+
+    def delete_memberships(self, using, user_ids):
+        for batch in self.batches(user_ids):
+            Membership.objects.using(using).filter(user__in=batch).delete()
+
+    def update_directory(self, user_ids):
+        with transaction.atomic(using=DEFAULT_DB_ALIAS):
+            InstitutionShard.objects.filter(institution_id=self.institution_id).delete()
+            ShardMember.objects.filter(institution_id=self.institution_id).delete()
+
+            if self.target != DEFAULT_DB_ALIAS:
+                InstitutionShard.objects.create(
+                    institution_id=self.institution_id, database=self.target
+                )
+                ShardMember.objects.bulk_create([
+                    ShardMember(user_id=user_id, institution_id=self.institution_id)
+                    for user_id in user_ids
+                ])
+
+        directory_cache.clear()
+
+    def run(self, delete_source=True):
+        rows = self.collect()
+        self.check_conflicts(rows)
+
+        with transaction.atomic(using=self.target):
+            for model, pks in self.without_directory_copies(rows, self.target):
+                copied = copy_rows(model, pks, self.source, self.target, self.batch_size)
+                self.log('%s: %d rows' % (model._meta.db_table, copied))
+
+            # rows were inserted with explicit keys, move the sequences past them
+            connection = connections[self.target]
+            with connection.cursor() as cursor:
+                for statement in connection.ops.sequence_reset_sql(
+                        no_style(), [model for model, pks in rows]):
+                    cursor.execute(statement)
+
+            users = next(pks for model, pks in rows if model is User)
+            copied = memberships.refresh(users, self.target, self.batch_size)
+            self.log('%s: %d rows' % (Membership._meta.db_table, copied))
+
+        try:
+            self.update_directory(users)
+        except Exception:
+            with transaction.atomic(using=self.target):
+                self.delete_memberships(self.target, users)
+                self.delete(self.target, self.without_directory_copies(rows, self.target))
+            raise
+
+        if delete_source:
+            with transaction.atomic(using=self.source):
+                self.delete_memberships(self.source, users)
+                self.delete(self.source, self.without_directory_copies(rows, self.source))
+
+        return [(model._meta.db_table, len(pks)) for model, pks in rows]
@@ -0,0 +1,228 @@
+from django.contrib.auth.models import Group, Permission
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Q
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from rest_framework.authtoken.models import Token
+
+from .authentication import (
+    invalidate_token, invalidate_user_credentials, invalidate_user_tokens,
+)
+from .backends import invalidate_user_permissions
+from .institution_tree import bump_version
+from .models import (
+    Address, Admin, Class, Course, Institution, Program, Student, Teacher, User,
+)
+from . import hierarchy, memberships, sharding, versions
+from .response_cache import bump_tags
+
+
+@receiver([post_save, post_delete], sender=Token)
+def clear_cached_token(sender, instance, **kwargs):
+    invalidate_token(instance.key)
+    # a new token for the same user means the previous one was rotated
+    invalidate_user_tokens(instance.user_id)
+
+
+@receiver([post_save, post_delete], sender=User)
+def clear_cached_user(sender, instance, **kwargs):
+    invalidate_user_tokens(instance.pk)
+    invalidate_user_credentials(instance.pk)
+    invalidate_user_permissions(instance.pk)
+
+
+@receiver(post_save, sender=User)
+def sync_shard_user(sender, instance, using, raw=False, update_fields=None, **kwargs):
+    # users are saved to the directory, the copies in the shards follow
+    if using == DEFAULT_DB_ALIAS and not raw:
+        sharding.sync_user(instance, update_fields)
+
+
+@receiver(pre_delete, sender=User)
+def delete_shard_user(sender, instance, using, **kwargs):
+    # before the directory forgets the user's shard
+    if using == DEFAULT_DB_ALIAS:
+        sharding.sync_user(instance, deleted=True)
+
+
+@receiver(post_save, sender=Token)
+def sync_shard_token(sender, instance, using, raw=False, **kwargs):
+    if using == DEFAULT_DB_ALIAS and not raw:
+        sharding.sync_token(instance)
+
+
+@receiver(post_delete, sender=Token)
+def delete_shard_token(sender, instance, using, **kwargs):
+    if using == DEFAULT_DB_ALIAS:
+        sharding.sync_token(instance, deleted=True)
+
+
+@receiver([post_save, post_delete], sender=Admin)
+@receiver([post_save, post_delete], sender=Teacher)
+@receiver([post_save, post_delete], sender=Student)
+def refresh_profile_memberships(sender, instance, using, raw=False, **kwargs):
+    if not raw:
+        memberships.refresh([instance.user_id], using)
+
+
+@receiver([post_save, post_delete], sender=Course)
+def refresh_course_memberships(sender, instance, using, raw=False, **kwargs):
+    if not raw:
+        memberships.refresh_course(instance, using)
+
+
+@receiver(post_save, sender=Class)
+@receiver(post_save, sender=Program)
+def refresh_moved_memberships(sender, instance, using, raw=False, **kwargs):
+    if raw:
+        return
+
+    # only the rows of a class or program that moved are stale
+    if sender is Class:
+        memberships.refresh_related(using, 'class_id', instance.pk, program_id=instance.program_id)
+    else:
+        memberships.refresh_related(
+            using, 'program_id', instance.pk, institution_id=instance.institution_id
+        )
+
+
+@receiver(post_delete, sender=Class)
+@receiver(post_delete, sender=Program)
+def refresh_deleted_memberships(sender, instance, using, **kwargs):
+    # the cascades already refreshed the students and courses, unless the
+    # rows were deleted without signals
+    field = 'class_id' if sender is Class else 'program_id'
+    memberships.refresh_related(using, field, instance.pk)
+
+
+@receiver(m2m_changed, sender=User.user_permissions.through)
+@receiver(m2m_changed, sender=User.groups.through)
+@receiver(m2m_changed, sender=Group.permissions.through)
+def clear_cached_permissions(sender, instance, reverse, **kwargs):
+    if isinstance(instance, User):
+        invalidate_user_permissions(instance.pk)
+    else:
+        # a group or permission changed, any user may be affected
+        invalidate_user_permissions()
+
+
+@receiver([post_save, post_delete], sender=Institution)
+@receiver([post_save, post_delete], sender=Program)
+@receiver([post_save, post_delete], sender=Class)
+def bump_institution_tree(sender, instance, **kwargs):
+    if sender is Institution:
+        institution_id = instance.pk
+    elif sender is Program:
+        institution_id = instance.institution_id
+    else:
+        # the program may already be gone when deleted in cascade
+        programs = Program.objects.filter(pk=instance.program_id)
+        institution_id = programs.values_list('institution_id', flat=True).first()
+
+    if institution_id is not None:
+        # readers must not rebuild from data that is not committed yet
+        transaction.on_commit(lambda: bump_version(institution_id))
+        transaction.on_commit(lambda: hierarchy.bump_versions([institution_id]))
+
+
+@receiver([post_save, post_delete], sender=User)
+@receiver([post_save, post_delete], sender=Token)
+@receiver([post_save, post_delete], sender=Group)
+@receiver([post_save, post_delete], sender=Permission)
+def bump_model_version(sender, **kwargs):
+    transaction.on_commit(lambda: versions.bump_version(sender))
+
+
+@receiver(m2m_changed, sender=User.user_permissions.through)
+@receiver(m2m_changed, sender=User.groups.through)
+@receiver(m2m_changed, sender=Group.permissions.through)
+def bump_membership_version(sender, action, **kwargs):
+    if not action.startswith('post_'):
+        return
+
+    # memberships are rendered from the side owning the many to many field
+    model = Group if sender is Group.permissions.through else User
+    transaction.on_commit(lambda: versions.bump_version(model))
+
+
+@receiver([post_save, post_delete], sender=User)
+@receiver([post_save, post_delete], sender=Token)
+@receiver([post_save, post_delete], sender=Address)
+@receiver([post_save, post_delete], sender=Admin)
+@receiver([post_save, post_delete], sender=Teacher)
+@receiver([post_save, post_delete], sender=Student)
+@receiver([post_save, post_delete], sender=Class)
+@receiver([post_save, post_delete], sender=Program)
+@receiver([post_save, post_delete], sender=Institution)
+@receiver([post_save, post_delete], sender=Course)
+@receiver([post_save, post_delete], sender=Group)
+def bump_response_tags(sender, instance, **kwargs):
+    if sender is User:
+        tags = [('user', instance.pk)]
+    elif sender in (Token, Address, Admin, Student):
+        tags = [('user', instance.user_id)]
+    elif sender is Teacher:
+        tags = [('user', instance.user_id), ('teacher', instance.pk)]
+    elif sender is Course:
+        tags = [
+            ('course', instance.pk),
+            ('class', instance.class_id_id),
+            ('teacher', instance.teacher_id),
+        ]
+    elif sender is Group:
+        tags = [('groups', 'all')]
+    else:
+        tags = [(sender._meta.model_name, instance.pk)]
+
+    tags += get_course_anchor_tags(sender, instance)
+    transaction.on_commit(lambda: bump_tags(tags))
+
+
+def get_course_anchor_tags(sender, instance):
+    """
+    Return the teacher and class tags of the courses rendering `instance`.
+    Cached course lists are only tagged with their teacher or class, so
+    changes to the rows nested in a course are announced on them.
+    """
+    if sender is Class:
+        courses = Course.objects.filter(class_id=instance.pk)
+    elif sender is Program:
+        courses = Course.objects.filter(class_id__program=instance.pk)
+    elif sender is Institution:
+        courses = Course.objects.filter(
+            Q(teacher__institution=instance.pk) | Q(class_id__program__institution=instance.pk)
+        )
+    elif sender is Teacher:
+        courses = Course.objects.filter(teacher=instance.pk)
+    elif sender is User and instance.is_teacher:
+        courses = Course.objects.filter(teacher__user=instance.pk)
+    else:
+        return []
+
+    tags = set()
+    for teacher, class_ in courses.values_list('teacher', 'class_id'):
+        tags.update([('teacher', teacher), ('class', class_)])
+    return sorted(tags)
+
+
+@receiver(m2m_changed, sender=User.user_permissions.through)
+@receiver(m2m_changed, sender=User.groups.through)
+@receiver(m2m_changed, sender=Group.permissions.through)
+def bump_membership_response_tags(sender, instance, action, reverse, pk_set, **kwargs):
+    changed = action.startswith('post_')
+
+    if sender is Group.permissions.through:
+        tags = [('groups', 'all')] if changed else []
+    elif not reverse:
+        tags = [('user', instance.pk)] if changed else []
+    elif action == 'pre_clear':
+        # the users losing the group or permission are only known before
+        tags = [('user', pk) for pk in instance.user_set.values_list('pk', flat=True)]
+    elif action in ('post_add', 'post_remove'):
+        tags = [('user', pk) for pk in pk_set]
+    else:
+        tags = []
+
+    if tags:
+        transaction.on_commit(lambda: bump_tags(tags))
@@ -0,0 +1,13 @@
+"""
+Statistics shared by the gradebooks and the load benchmark.
+"""
+import math
+
+
+def percentile(values, percent):
+    """
+    Return the percentile of sorted `values`, interpolating between ranks.
+    """
+    rank = (len(values) - 1) * percent / 100
+    low, high = math.floor(rank), math.ceil(rank)
+    return values[low] + (values[high] - values[low]) * (rank - low)
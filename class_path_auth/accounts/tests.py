@@ -1,3 +1,1537 @@
-from django.test import TestCase
+import csv
+import datetime
+import importlib
+import io
+import json
+import math
+import os
+import shutil
+import tempfile
+import threading
+import time
+import types
+from unittest import mock
 
-# Create your tests here.
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PublicKey
+
+from django.conf import settings
+from django.contrib.auth.hashers import check_password
+from django.contrib.auth.models import Group, Permission
+from django.core.cache import caches
+from django.core.management import call_command
+from django.core.signals import request_finished
+from django.db import (
+    DEFAULT_DB_ALIAS, IntegrityError, OperationalError, connection, connections, transaction,
+)
+from django.db.models import Q
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from ..db import pool, pooled, replicas
+from . import (
+    authentication, benchmark, hashing, hierarchy, index_advisor, institution_tree,
+    instrumentation, memberships, response_cache as response_cache_module, sharding, tokens,
+)
+from .api import serializers
+from .api.permissions import CanViewObject
+from .api.compiled import get_compiled_serializer
+from .authentication import (
+    CachedBasicAuthentication, CachedTokenAuthentication, credentials_cache, token_cache,
+)
+from .backends import ROLE_PERMISSIONS, permission_cache
+from .response_cache import response_cache
+from .models import (
+    Address, Admin, Class, Course, Institution, InstitutionShard, Membership, Program,
+    Scores, Student, Teacher, User,
+)
+
+
+def create_institution(name, students=3, classes=2, programs=1):
+    institution = Institution.objects.create(name=name)
+    programs = [
+        Program.objects.create(name='%s program %d' % (name, i), institution=institution)
+        for i in range(programs)
+    ]
+    classes = [
+        Class.objects.create(name='%s class %d' % (name, i), program=programs[i % len(programs)])
+        for i in range(classes)
+    ]
+
+    admin = User.objects.create_user(name + '-admin', name + '-admin@example.com', 'pw', is_admin=True)
+    Admin.objects.create(user=admin, institution=institution, cpf='000')
+
+    teacher = User.objects.create_user(name + '-teacher', name + '-teacher@example.com', 'pw', is_teacher=True)
+    teacher_profile = Teacher.objects.create(user=teacher, institution=institution)
+    for class_ in classes:
+        Course.objects.create(name='Math', class_id=class_, teacher=teacher_profile)
+
+    for i in range(students):
+        user = User.objects.create_user(
+            '%s-student-%d' % (name, i), '%s-student-%d@example.com' % (name, i), 'pw',
+            is_student=True
+        )
+        Student.objects.create(
+            user=user, class_id=classes[i % len(classes)], description='student'
+        )
+        for number in range(i % 3):
+            Address.objects.create(
+                state='PI', city='Teresina', street='Street', neighborhood='Center',
+                number=number, postal_code='64000', user=user
+            )
+
+    return institution, admin, teacher
+
+
+def run_on_commit():
+    # TestCase never commits, run the callbacks right away instead
+    return mock.patch.object(transaction, 'on_commit', side_effect=lambda func, using=None: func())
+
+
+class SQLiteDatabasesMixin:
+    """
+    Add the `extra_databases` aliases, each a migrated SQLite file, for the
+    tests of the class.
+    """
+    extra_databases = ()
+
+    @classmethod
+    def setUpClass(cls):
+        cls.database_dir = tempfile.mkdtemp()
+        for alias in cls.extra_databases:
+            name = os.path.join(cls.database_dir, alias + '.sqlite3')
+            connections.databases[alias] = {
+                'ENGINE': 'django.db.backends.sqlite3', 'NAME': name, 'TEST': {'NAME': name},
+            }
+            call_command('migrate', database=alias, run_syncdb=True, verbosity=0)
+
+        cls.databases = set(cls.databases) | set(cls.extra_databases)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        for alias in cls.extra_databases:
+            connections[alias].close()
+            del connections[alias]
+            del connections.databases[alias]
+        shutil.rmtree(cls.database_dir)
+
+
+class CompiledSerializerParityTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.institution, cls.admin, cls.teacher = create_institution('north')
+        create_institution('south', students=2)
+
+        student = User.objects.filter(is_student=True).first()
+        student.groups.add(*[Group.objects.create(name=name) for name in ('b', 'a')])
+        student.user_permissions.add(*Permission.objects.all()[:3])
+
+        # flags without a matching profile and users without a token
+        orphan = User.objects.create_user('orphan', 'orphan@example.com', 'pw', is_student=True)
+        Token.objects.filter(user=orphan).delete()
+        both = User.objects.create_user('both', 'both@example.com', 'pw', is_student=True, is_teacher=True)
+        Teacher.objects.create(user=both, institution=cls.institution)
+
+    def assertParity(self, serializer_class, queryset):
+        expected = serializer_class(queryset, many=True).data
+        compiled = get_compiled_serializer(serializer_class).data(queryset)
+
+        self.assertTrue(expected)
+        self.assertEqual(JSONRenderer().render(compiled), JSONRenderer().render(expected))
+
+    def test_user_serializer(self):
+        self.assertParity(serializers.UserSerializer, User.objects.order_by('pk'))
+
+    def test_course_serializer(self):
+        self.assertParity(serializers.CourseSerializer, Course.objects.order_by('pk'))
+
+    def test_class_serializer(self):
+        self.assertParity(serializers.ClassSerializer, Class.objects.order_by('pk'))
+
+    def test_profile_serializers(self):
+        self.assertParity(serializers.StudentSerializer, Student.objects.order_by('pk'))
+        self.assertParity(serializers.TeacherSerializer, Teacher.objects.order_by('pk'))
+
+    def test_nested_lists(self):
+        self.assertParity(serializers.InstitutionSerializer, Institution.objects.order_by('pk'))
+
+    def test_list_endpoints(self):
+        teacher_client, admin_client = APIClient(), APIClient()
+        teacher_client.force_authenticate(self.teacher)
+        admin_client.force_authenticate(self.admin)
+
+        requests = [
+            (admin_client, url)
+            for url in ('/users/', '/students/', '/teachers/', '/classes/', '/courses/')
+        ]
+        requests += [(teacher_client, url) for url in ('/my-classes/', '/my-courses/')]
+
+        for client, url in requests:
+            for page_size in (2, 100):
+                with override_settings(COMPILED_SERIALIZERS=False):
+                    expected = client.get(url, {'page_size': page_size})
+                compiled = client.get(url, {'page_size': page_size})
+
+                self.assertEqual(compiled.status_code, 200, url)
+                self.assertEqual(compiled.content, expected.content, url)
+
+
+class RolePermissionBackendTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.institution, cls.admin, cls.teacher = create_institution('north', students=1)
+        cls.student = User.objects.get(student__class_id__program__institution=cls.institution)
+        cls.group = Group.objects.create(name='reviewers')
+        cls.group.permissions.add(Permission.objects.get(codename='view_course'))
+
+    def setUp(self):
+        permission_cache.clear()
+
+    def get_user(self, user):
+        # a fresh instance, has_perm also memoizes on the user
+        return User.objects.get(pk=user.pk)
+
+    def test_created_by_post_migrate(self):
+        permissions = Permission.objects.filter(
+            content_type__app_label='accounts', codename__in=['is_student', 'is_teacher', 'is_admin']
+        )
+        self.assertEqual(permissions.count(), 3)
+
+    def test_role_permissions(self):
+        roles = ((self.student, 'is_student'), (self.teacher, 'is_teacher'), (self.admin, 'is_admin'))
+        for user, role in roles:
+            with self.subTest(role):
+                user = self.get_user(user)
+                self.assertEqual(
+                    {flag for flag in ROLE_PERMISSIONS if user.has_perm('accounts.' + flag)}, {role}
+                )
+
+        inactive = self.get_user(self.teacher)
+        inactive.is_active = False
+        self.assertFalse(inactive.has_perm('accounts.is_teacher'))
+
+    def test_cached_permissions(self):
+        user = self.get_user(self.teacher)
+        with self.assertNumQueries(2):
+            self.assertFalse(user.has_perm('accounts.view_course'))
+
+        # the next request, with another instance of the user
+        user = self.get_user(self.teacher)
+        with self.assertNumQueries(0):
+            self.assertFalse(user.has_perm('accounts.view_course'))
+            self.assertTrue(user.has_perm('accounts.is_teacher'))
+
+        self.get_user(self.teacher).groups.add(self.group)
+        self.assertTrue(self.get_user(self.teacher).has_perm('accounts.view_course'))
+
+        self.group.permissions.clear()
+        self.assertFalse(self.get_user(self.teacher).has_perm('accounts.view_course'))
+
+
+class CachedTokenAuthenticationTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create_user('cached', 'cached@example.com', 'pw', is_student=True)
+        cls.user_id, cls.key = user.pk, user.auth_token.key
+
+    def setUp(self):
+        token_cache.clear()
+        self.authentication = CachedTokenAuthentication()
+
+    def authenticate(self, key=None):
+        return self.authentication.authenticate_credentials(key or self.key)
+
+    def get_user(self):
+        return User.objects.get(pk=self.user_id)
+
+    def test_cache_hit(self):
+        with self.assertNumQueries(1):
+            user, token = self.authenticate()
+
+        with self.assertNumQueries(0):
+            cached_user, cached_token = self.authenticate()
+            self.assertEqual(cached_user.email, 'cached@example.com')
+            self.assertEqual(cached_token.key, self.key)
+            self.assertEqual(cached_token.user, cached_user)
+
+    def test_rotated_or_deleted_token(self):
+        self.authenticate()
+        Token.objects.filter(key=self.key).get().delete()
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate()
+
+        token = Token.objects.create(user_id=self.user_id)
+        self.authenticate(token.key)
+        token.delete()
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate(token.key)
+
+    def test_saved_or_deactivated_user(self):
+        self.authenticate()
+        user = self.get_user()
+        user.email = 'renamed@example.com'
+        user.save()
+        self.assertEqual(self.authenticate()[0].email, 'renamed@example.com')
+
+        user.is_active = False
+        user.save()
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate()
+
+    def test_revoked_in_another_process(self):
+        self.authenticate()
+        # the entry the LRU of another process keeps for the token
+        entry = token_cache.get(authentication._cache_key(self.key))
+
+        user = self.get_user()
+        user.is_active = False
+        user.save()
+        token_cache.set(authentication._cache_key(self.key), entry)
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate()
+
+    @override_settings(TOKEN_CACHE_ALIAS='default')
+    def test_shared_cache(self):
+        caches['default'].clear()
+        self.authenticate()
+
+        # another process, with nothing in its own cache
+        token_cache.clear()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.authenticate()[0].pk, self.user_id)
+
+        user = self.get_user()
+        user.email = 'renamed@example.com'
+        user.save()
+        token_cache.clear()
+        self.assertEqual(self.authenticate()[0].email, 'renamed@example.com')
+
+
+class CachedBasicAuthenticationTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user_id = User.objects.create_user('basic', 'basic@example.com', 'pw').pk
+
+    def setUp(self):
+        credentials_cache.clear()
+        self.authentication = CachedBasicAuthentication()
+
+    def authenticate(self, password='pw'):
+        return self.authentication.authenticate_credentials('basic', password)
+
+    def get_user(self):
+        return User.objects.get(pk=self.user_id)
+
+    def test_cache_hit(self):
+        self.authenticate()
+
+        with self.assertNumQueries(0), mock.patch.object(User, 'check_password') as check_password:
+            user, _ = self.authenticate()
+        self.assertEqual(user.email, 'basic@example.com')
+        check_password.assert_not_called()
+
+    def test_wrong_password(self):
+        self.authenticate()
+        for _ in range(2):
+            with self.assertRaises(AuthenticationFailed):
+                self.authenticate('wrong')
+
+    def test_changed_password(self):
+        self.authenticate()
+        user = self.get_user()
+        user.set_password('new-password')
+        user.save()
+
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate()
+        self.assertEqual(self.authenticate('new-password')[0].pk, self.user_id)
+
+    def test_deactivated_user(self):
+        self.authenticate()
+        user = self.get_user()
+        user.is_active = False
+        user.save()
+
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate()
+
+
+class QueryCountTests(TestCase):
+    """
+    Every route runs the same number of queries whatever the size of the
+    data, within its budget in QUERY_BUDGETS.
+
+    The routes are the read only benchmark scenarios, requested with cold
+    caches as the users of a small and a large institution, authenticated
+    with their api token and again with a signed access token.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        sizes = (('small', 2, 1, 1), ('large', 12, 4, 3))
+        for name, students, classes, programs in sizes:
+            create_institution(name, students=students, classes=classes, programs=programs)
+            User.objects.create_user(name + '-staff', name + '-staff@example.com', 'pw', is_staff=True)
+
+            group = Group.objects.create(name=name)
+            group.user_set.add(*User.objects.filter(registration_number__startswith=name))
+            for course in Course.objects.filter(class_id__program__institution__name=name):
+                Scores.objects.bulk_create([
+                    Scores(course=course, student=student, first_score=7.5)
+                    for student in course.class_id.students.all()
+                ])
+
+        cls.actors = {name: benchmark.load_actors(1, 'pw', name) for name, *_ in sizes}
+        for actors in cls.actors.values():
+            for actor in sum(actors.values(), []):
+                pair = tokens.issue_tokens(User.objects.get(pk=actor['user_id']))
+                actor['access'], actor['refresh'] = pair['access'], pair['refresh']
+
+    def clear_caches(self):
+        for cache in caches.all():
+            cache.clear()
+        for cache in (token_cache, credentials_cache, permission_cache):
+            cache.clear()
+
+    def count_queries(self, scenario, actor, keyword='Token'):
+        extra = {}
+        if scenario.authenticated:
+            token = actor['access'] if keyword == 'Bearer' else actor['token']
+            extra['HTTP_AUTHORIZATION'] = '%s %s' % (keyword, token)
+        body = scenario.body(actor, 0) if scenario.body else None
+
+        # the budget is asserted once the query counts are compared
+        with self.settings(QUERY_BUDGETS={}), CaptureQueriesContext(connection) as queries:
+            response = self.client.generic(
+                scenario.method, scenario.get_path(actor),
+                JSONRenderer().render(body) if body is not None else '',
+                content_type='application/json', **extra
+            )
+            if response.streaming:
+                b''.join(response.streaming_content)
+
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def assertQueriesDoNotScale(self, scenarios, keyword='Token'):
+        for scenario in scenarios:
+            with self.subTest(scenario.name, keyword=keyword):
+                counts = []
+                for actors in self.actors.values():
+                    actor = actors[scenario.role][0] if scenario.role else {'ids': {}}
+                    self.clear_caches()
+                    counts.append(self.count_queries(scenario, actor, keyword))
+
+                small, large = counts
+                self.assertEqual(small, large, 'queries grow with the data')
+                self.assertLessEqual(large, settings.QUERY_BUDGETS[scenario.url_name])
+
+    def test_queries_do_not_scale_with_data(self):
+        self.assertQueriesDoNotScale(
+            [scenario for scenario in benchmark.SCENARIOS if not scenario.write]
+        )
+
+    def test_signed_token_queries_do_not_scale_with_data(self):
+        self.assertQueriesDoNotScale(
+            [
+                scenario for scenario in benchmark.SCENARIOS
+                if scenario.authenticated and not scenario.write
+            ],
+            keyword='Bearer'
+        )
+
+
+    def test_failing_client_does_not_deadlock(self):
+        class FakeClient:
+            def request(self, method, path, body=None, token=None):
+                return 200, None, b''
+
+            def close(self):
+                pass
+
+        clients = iter([FakeClient()])
+
+        def client_factory():
+            client = next(clients, None)
+            if client is None:
+                raise ConnectionRefusedError
+            return client
+
+        errors = []
+
+        def run():
+            runner = benchmark.Benchmark({}, client_factory, requests=4, concurrency=2)
+            try:
+                runner.run_scenario(benchmark.Scenario('keys', 'login-keys', None))
+            except Exception as exc:
+                errors.append(exc)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive(), 'the workers deadlocked at the barrier')
+        self.assertEqual([type(exc) for exc in errors], [ConnectionRefusedError])
+
+
+class SignedTokenTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.institution, cls.admin, cls.teacher = create_institution('north')
+        cls.student = User.objects.filter(is_student=True).first()
+
+    def setUp(self):
+        caches['default'].clear()
+
+    @override_settings(LOGIN_TOKEN_MODE='signed')
+    def login(self, user):
+        response = self.client.post(
+            '/login/', {'username': user.registration_number, 'password': 'pw'}
+        )
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def refresh(self, refresh):
+        return self.client.post('/login/refresh/', {'refresh': refresh})
+
+    def test_login(self):
+        pair = self.login(self.student)
+        claims = tokens.decode(pair['access'])
+
+        self.assertEqual(pair['token_type'], 'Bearer')
+        self.assertEqual(claims['sub'], str(self.student.pk))
+        self.assertEqual(claims['institution_id'], self.institution.pk)
+        self.assertTrue(claims['is_student'])
+        self.assertFalse(claims['is_admin'])
+        self.assertEqual(tokens.decode(pair['refresh'], tokens.REFRESH)['sub'], str(self.student.pk))
+
+    def test_verification_keys(self):
+        key, = self.client.get('/login/keys/').json()['keys']
+        access = self.login(self.student)['access']
+        header, claims, signature = access.split('.')
+
+        self.assertEqual(key['kid'], tokens.get_key_id())
+        # raises InvalidSignature when the published key doesn't verify it
+        Ed25519PublicKey.from_public_bytes(tokens._b64decode(key['x'])).verify(
+            tokens._b64decode(signature), (header + '.' + claims).encode()
+        )
+
+    def test_bearer_authentication(self):
+        pair = self.login(self.student)
+
+        response = self.client.get('/my-account/', HTTP_AUTHORIZATION='Bearer ' + pair['access'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['email'], self.student.email)
+        self.assertEqual(response.json()['token'], self.student.auth_token.key)
+
+        # the claims of the access token under the signature of the refresh one
+        forged = '.'.join(pair['access'].split('.')[:2] + pair['refresh'].split('.')[2:])
+        for token in (pair['refresh'], forged, 'not-a-token'):
+            response = self.client.get('/my-account/', HTTP_AUTHORIZATION='Bearer ' + token)
+            self.assertEqual(response.status_code, 401)
+
+    def test_refresh(self):
+        pair = self.login(self.student)
+
+        response = self.refresh(pair['refresh'])
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.json()['refresh'], pair['refresh'])
+        self.assertEqual(tokens.decode(response.json()['access'])['sub'], str(self.student.pk))
+
+        # the rotated token is still good, the redeemed one isn't
+        self.assertEqual(self.refresh(pair['refresh']).status_code, 400)
+        self.assertEqual(self.refresh(response.json()['refresh']).status_code, 200)
+
+    def test_refresh_after_password_change(self):
+        pair = self.login(self.student)
+
+        user = User.objects.get(pk=self.student.pk)
+        user.set_password('new-password')
+        user.save()
+
+        self.assertEqual(self.refresh(pair['refresh']).status_code, 400)
+
+
+class KeysetPaginationTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.institution, cls.admin, cls.teacher = create_institution('north', classes=5)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def get_page(self, url, params=None):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        page = response.json()
+        return [row['id'] for row in page['results']], page['next'], page['previous']
+
+    def walk(self):
+        """
+        Return the pages of /classes/ following the next links, then the
+        previous ones back.
+        """
+        forward, backward = [], []
+        ids, next_url, previous_url = self.get_page('/classes/', {'page_size': 2})
+        forward.append(ids)
+        self.assertIsNone(previous_url)
+        while next_url:
+            ids, next_url, previous_url = self.get_page(next_url)
+            forward.append(ids)
+
+        while previous_url:
+            ids, next_url, previous_url = self.get_page(previous_url)
+            backward.append(ids)
+
+        return forward, backward
+
+    def assertWalks(self, expected):
+        for compiled in (True, False):
+            with self.subTest(compiled=compiled), override_settings(COMPILED_SERIALIZERS=compiled):
+                forward, backward = self.walk()
+                self.assertEqual(forward, [expected[0:2], expected[2:4], expected[4:]])
+                self.assertEqual(backward, [expected[2:4], expected[0:2]])
+
+    def test_next_and_previous(self):
+        self.assertWalks(list(Class.objects.order_by('created_at', 'pk').values_list('pk', flat=True)))
+
+    def test_equal_sort_keys(self):
+        Class.objects.update(created_at=datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc))
+        self.assertWalks(list(Class.objects.order_by('pk').values_list('pk', flat=True)))
+
+    def test_invalid_cursor(self):
+        for cursor in ('not base64!', 'cj0xJnA9eA==', 'eD0x'):
+            response = self.client.get('/classes/', {'cursor': cursor})
+            self.assertEqual(response.status_code, 404, cursor)
+
+
+class InstitutionTreeTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.institution, cls.admin, cls.teacher = create_institution('north')
+
+    def setUp(self):
+        institution_tree.get_cache().clear()
+        self.key = 'institution-tree:%s:%s' % (
+            self.institution.pk, institution_tree.get_version(self.institution.pk)
+        )
+
+    def test_single_flight(self):
+        def build_tree(institution_id):
+            time.sleep(0.1)
+            return {'id': institution_id}
+
+        with mock.patch.object(institution_tree, 'build_tree', side_effect=build_tree) as build:
+            threads = [
+                threading.Thread(target=institution_tree.get_tree, args=(self.institution.pk,))
+                for _ in range(4)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            # another process holds the lock, its document is waited for
+            cache = institution_tree.get_cache()
+            cache.delete(self.key)
+            cache.add(self.key + ':lock', True)
+            threading.Timer(0.1, cache.set, (self.key, {'id': 'other'})).start()
+            self.assertEqual(institution_tree.get_tree(self.institution.pk), {'id': 'other'})
+
+        self.assertEqual(build.call_count, 1)
+
+    @override_settings(INSTITUTION_TREE_LOCK_TIMEOUT=0)
+    def test_lock_held_past_deadline(self):
+        cache = institution_tree.get_cache()
+        cache.add(self.key + ':lock', 'other')
+
+        self.assertEqual(institution_tree.get_tree(self.institution.pk)['name'], 'north')
+        self.assertEqual(cache.get(self.key + ':lock'), 'other')
+
+    def test_bumped_on_save(self):
+        version = institution_tree.get_version(self.institution.pk)
+        program = Program.objects.get(institution=self.institution)
+        class_ = Class.objects.filter(program=program).first()
+
+        with run_on_commit():
+            program.name = 'renamed'
+            program.save()
+            program_version = institution_tree.get_version(self.institution.pk)
+            class_.save()
+
+        self.assertGreater(program_version, version)
+        self.assertGreater(institution_tree.get_version(self.institution.pk), program_version)
+        tree = institution_tree.get_tree(self.institution.pk)
+        self.assertEqual(tree['programs'][0]['name'], 'renamed')
+
+
+class ConditionalGetTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.institution, cls.admin, cls.teacher = create_institution('north', classes=4)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+        caches['default'].clear()
+
+    def get(self, url, **headers):
+        return self.client.get(url, {'page_size': 2}, **headers)
+
+    def touch(self, class_):
+        Class.objects.filter(pk=class_.pk).update(
+            modified_at=class_.modified_at + datetime.timedelta(hours=1)
+        )
+
+    def test_if_none_match(self):
+        response = self.get('/classes/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('no-cache', response['Cache-Control'])
+
+        response = self.get('/classes/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+        response = self.get('/classes/', HTTP_IF_NONE_MATCH='"stale"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_if_modified_since(self):
+        response = self.get('/classes/')
+        last_modified = response['Last-Modified']
+
+        response = self.get('/classes/', HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+        self.touch(Class.objects.order_by('created_at', 'pk').first())
+        response = self.get('/classes/', HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['Last-Modified'], last_modified)
+
+    def test_only_the_page_is_validated(self):
+        etag = self.get('/classes/')['ETag']
+        classes = list(Class.objects.order_by('created_at', 'pk'))
+
+        # the first page holds two classes, the third tells there's a next page
+        self.touch(classes[-1])
+        self.assertEqual(self.get('/classes/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        Class.objects.filter(pk=classes[1].pk).delete()
+        response = self.get('/classes/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [row['id'] for row in response.json()['results']], [classes[0].pk, classes[2].pk]
+        )
+
+    def test_detail(self):
+        class_ = Class.objects.filter(program__institution=self.institution).first()
+        url = '/classes/%d/' % class_.pk
+        etag = self.client.get(url)['ETag']
+
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.touch(class_)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class ExportTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.institution, cls.admin, cls.teacher = create_institution('north')
+        create_institution('south')
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def export(self, path):
+        response = self.client.get('/exports/' + path)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content).decode()
+
+    def test_csv(self):
+        rows = list(csv.DictReader(io.StringIO(self.export('users.csv'))))
+
+        self.assertEqual(
+            [int(row['id']) for row in rows],
+            list(User.objects.for_institution(self.institution).order_by('pk').values_list('pk', flat=True))
+        )
+        self.assertTrue(all(row['email'].startswith('north-') for row in rows))
+
+    def test_ndjson(self):
+        rows = [json.loads(line) for line in self.export('courses.ndjson').splitlines()]
+
+        self.assertEqual(
+            [row['id'] for row in rows],
+            list(Course.objects.filter(teacher__user=self.teacher).order_by('pk').values_list('pk', flat=True))
+        )
+        self.assertEqual({row['teacher_email'] for row in rows}, {'north-teacher@example.com'})
+
+    def test_admin_without_institution(self):
+        user = User.objects.create_user('lone-admin', 'lone-admin@example.com', 'pw', is_admin=True)
+        Admin.objects.create(user=user, cpf='000')
+        self.client.force_authenticate(user)
+
+        self.assertEqual(self.client.get('/exports/users.csv').status_code, 404)
+
+
+class EnrollmentTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.institution, cls.admin, cls.teacher = create_institution('north')
+        cls.class_ = Class.objects.filter(program__institution=cls.institution).first()
+        _, cls.other_admin, _ = create_institution('south')
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def row(self, number, role='student', **fields):
+        row = {
+            'registration_number': 'new-%d' % number,
+            'email': 'new-%d@example.com' % number,
+            'password': 'enrolled-%d-pass' % number,
+            'role': role,
+        }
+        if role == 'student':
+            row['class_id'] = self.class_.pk
+        row.update(fields)
+        return row
+
+    def enroll(self, rows):
+        return self.client.post('/enrollments/', rows, format='json')
+
+    def test_json(self):
+        response = self.enroll([self.row(1), self.row(2, 'teacher', first_name='Ada')])
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['created'], 2)
+        self.assertTrue(Student.objects.filter(user__registration_number='new-1', class_id=self.class_).exists())
+        teacher = Teacher.objects.get(user__registration_number='new-2')
+        self.assertEqual((teacher.institution_id, teacher.user.first_name), (self.institution.pk, 'Ada'))
+        self.assertTrue(teacher.user.check_password('enrolled-2-pass'))
+        self.assertEqual(memberships.check(), [])
+
+    def test_csv(self):
+        body = (
+            'registration_number,email,password,role,class_id\n'
+            'new-1,new-1@example.com,enrolled-pass,student,%d\n'
+            'new-2,new-2@example.com,enrolled-pass,teacher,\n' % self.class_.pk
+        )
+        response = self.client.post('/enrollments/', body, content_type='text/csv')
+        self.assertEqual(response.status_code, 201)
+
+        upload = io.BytesIO(body.replace('new-', 'upload-').encode())
+        upload.name = 'users.csv'
+        response = self.client.post('/enrollments/', {'file': upload}, format='multipart')
+        self.assertEqual(response.status_code, 201)
+
+        self.assertEqual(
+            User.objects.filter(registration_number__regex=r'^(new|upload)-').count(), 4
+        )
+
+    def test_row_errors(self):
+        response = self.enroll([self.row(1), self.row(2, email='not-an-email'), self.row(3, role='guest')])
+
+        self.assertEqual(response.status_code, 400)
+        errors = response.json()['errors']
+        self.assertEqual([error['row'] for error in errors], [2, 3])
+        self.assertEqual(list(errors[0]['errors']), ['email'])
+        self.assertEqual(list(errors[1]['errors']), ['role'])
+
+        other_class = Class.objects.exclude(program__institution=self.institution).first()
+        response = self.enroll([self.row(1), self.row(2, class_id=other_class.pk)])
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['errors'], [
+            {'row': 2, 'errors': {'class_id': ['Unknown class for this institution.']}}
+        ])
+        # the valid rows aren't created either
+        self.assertFalse(User.objects.filter(registration_number='new-1').exists())
+
+    def test_duplicate_registration_numbers(self):
+        taken = User.objects.filter(is_student=True).first().registration_number
+        response = self.enroll([
+            self.row(1, registration_number=taken),
+            self.row(2),
+            self.row(3, registration_number='new-2'),
+        ])
+
+        self.assertEqual(response.status_code, 400)
+        errors = response.json()['errors']
+        self.assertEqual([error['row'] for error in errors], [1, 3])
+        for error in errors:
+            self.assertEqual(list(error['errors']), ['registration_number'])
+
+    def test_admin_without_institution(self):
+        user = User.objects.create_user('lone-admin', 'lone-admin@example.com', 'pw', is_admin=True)
+        Admin.objects.create(user=user, cpf='000')
+        self.client.force_authenticate(user)
+
+        self.assertEqual(self.enroll([self.row(1, 'teacher')]).status_code, 404)
+        self.assertFalse(User.objects.filter(registration_number='new-1').exists())
+
+
+class ResponseCacheTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.institution, cls.admin, cls.teacher = create_institution('north')
+
+    def setUp(self):
+        response_cache_module.get_cache().clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.teacher)
+
+    def get(self):
+        response = self.client.get('/my-courses/')
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_served_from_cache(self):
+        hits = response_cache.hits
+        with CaptureQueriesContext(connection) as rendered:
+            first = self.get()
+        with CaptureQueriesContext(connection) as cached:
+            second = self.get()
+
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(response_cache.hits, hits + 1)
+        self.assertLess(len(cached), len(rendered))
+
+    def test_invalidated_by_tagged_saves(self):
+        course = Course.objects.filter(teacher__user=self.teacher).select_related(
+            'class_id__program__institution', 'teacher'
+        ).first()
+        student = User.objects.filter(student__class_id=course.class_id).first()
+        changes = (
+            ('course', course, 'name'),
+            ('class', course.class_id, 'name'),
+            ('teacher', course.teacher, 'description'),
+            # nested in the courses, announced on their teacher and class
+            ('program', course.class_id.program, 'name'),
+            ('institution', course.class_id.program.institution, 'name'),
+        )
+
+        for user in (self.teacher, student):
+            self.client.force_authenticate(user)
+            for tag, obj, field in changes:
+                with self.subTest(tag, user=user.registration_number):
+                    self.get()
+                    setattr(obj, field, 'renamed %s %s' % (tag, user.pk))
+                    with run_on_commit():
+                        obj.save()
+                    self.assertIn('renamed %s %s' % (tag, user.pk), self.get().content.decode())
+
+
+class GradebookTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.institution, cls.admin, cls.teacher = create_institution('north', students=4, classes=1)
+        cls.course = Course.objects.get(teacher__user=cls.teacher)
+        students = Student.objects.filter(class_id=cls.course.class_id).order_by('pk')
+        # the last student has no scores yet
+        for student, scores in zip(students, ((4, 6, 8), (10, None, None), (2, 4, None))):
+            Scores.objects.create(
+                student=student, course=cls.course,
+                first_score=scores[0], second_score=scores[1], third_score=scores[2]
+            )
+
+    @override_settings(GRADEBOOK_PASSING_SCORE=6)
+    def test_statistics(self):
+        client = APIClient()
+        client.force_authenticate(self.teacher)
+        response = client.get('/my-courses/gradebook/')
+        self.assertEqual(response.status_code, 200)
+
+        gradebook, = response.json()
+        self.assertEqual([row['final_score'] for row in gradebook['students']], [6, 10, 3, None])
+
+        statistics = gradebook['statistics']
+        first = statistics['first_score']
+        self.assertEqual((first['count'], first['median'], first['min'], first['max']), (3, 4, 2, 10))
+        self.assertAlmostEqual(first['mean'], 16 / 3)
+        self.assertAlmostEqual(first['stddev'], math.sqrt(104 / 9))
+        for name, value in {'p10': 2.4, 'p25': 3, 'p75': 7, 'p90': 8.8}.items():
+            self.assertAlmostEqual(first['percentiles'][name], value)
+
+        final = statistics['final_score']
+        self.assertEqual((final['count'], final['median']), (3, 6))
+        self.assertAlmostEqual(final['mean'], 19 / 3)
+        self.assertAlmostEqual(final['pass_rate'], 2 / 3)
+        self.assertEqual(statistics['third_score']['count'], 1)
+        self.assertNotIn('pass_rate', first)
+
+
+class PasswordHashingTests(TestCase):
+    passwords = ['password-%d' % i for i in range(6)]
+
+    def assertHashesInOrder(self, hashes):
+        self.assertEqual(len(hashes), len(self.passwords))
+        for password, encoded in zip(self.passwords, hashes):
+            self.assertTrue(check_password(password, encoded))
+
+    def test_serial_order(self):
+        with mock.patch.object(hashing, 'ProcessPoolExecutor') as executor:
+            hashes = list(hashing.hash_passwords(self.passwords, workers=2))
+
+        self.assertFalse(executor.called)
+        self.assertHashesInOrder(hashes)
+
+    @override_settings(PASSWORD_HASHING_PARALLEL_THRESHOLD=2)
+    def test_parallel_order(self):
+        with mock.patch.object(
+                hashing, 'ProcessPoolExecutor', wraps=hashing.ProcessPoolExecutor) as executor:
+            # three batches, so results are yielded while others are hashed
+            hashes = list(hashing.hash_passwords(self.passwords, workers=2, batch_size=2))
+
+        executor.assert_called_once_with(max_workers=2)
+        self.assertHashesInOrder(hashes)
+
+
+class InstrumentationTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.institution, cls.admin, cls.teacher = create_institution('north')
+
+    def setUp(self):
+        token_cache.clear()
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.admin.auth_token.key)
+
+    def test_server_timing(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/classes/')
+
+        timings = dict(
+            entry.split(';', 1) for entry in response['Server-Timing'].split(', ')
+        )
+        self.assertEqual(list(timings)[0], 'db')
+        self.assertIn('desc="%d queries"' % len(queries), timings['db'])
+        self.assertIn('auth', timings)
+        self.assertRegex(timings['total'], r'^dur=\d+\.\d$')
+
+    def test_query_budget(self):
+        with self.settings(QUERY_BUDGETS={'Class-list': 1}):
+            with self.assertRaisesMessage(instrumentation.QueryBudgetExceeded, 'over its budget of 1'):
+                self.client.get('/classes/')
+
+            with self.settings(QUERY_BUDGET_MODE='warn'), \
+                    self.assertLogs(instrumentation.logger, 'WARNING') as logs:
+                self.assertEqual(self.client.get('/classes/').status_code, 200)
+            self.assertIn('Class-list ran', logs.output[-1])
+
+
+class ScoreUpsertTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.institution, cls.admin, cls.teacher = create_institution('north', students=4)
+        cls.course = Course.objects.filter(teacher__user=cls.teacher).order_by('pk').first()
+        cls.students = list(Student.objects.filter(class_id=cls.course.class_id).order_by('pk'))
+        _, _, cls.other_teacher = create_institution('south')
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.teacher)
+
+    def put(self, rows, course=None):
+        url = '/my-courses/%d/scores/' % (course or self.course).pk
+        return self.client.put(url, rows, format='json')
+
+    def test_create_and_update(self):
+        first, second = self.students
+        response = self.put([{'student_id': first.pk, 'first_score': 7.5}])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'created': 1, 'updated': 0})
+
+        response = self.put([
+            {'student_id': first.pk, 'second_score': 9},
+            {'student_id': second.pk, 'first_score': 5},
+        ])
+        self.assertEqual(response.json(), {'created': 1, 'updated': 1})
+
+        scores = Scores.objects.filter(course=self.course).order_by('student')
+        self.assertEqual(
+            list(scores.values_list('student', 'first_score', 'second_score')),
+            [(first.pk, 7.5, 9), (second.pk, 5, None)]
+        )
+
+    def test_row_errors(self):
+        first, _ = self.students
+        outsider = Student.objects.exclude(class_id=self.course.class_id).first()
+        response = self.put([
+            {'student_id': first.pk, 'first_score': 7.5},
+            {'student_id': outsider.pk, 'first_score': 7.5},
+            {'student_id': first.pk, 'second_score': 8},
+        ])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([sorted(row) for row in response.json()], [[], ['student_id'], ['student_id']])
+
+        response = self.put([{'student_id': first.pk, 'first_score': -1}])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(list(response.json()[0]), ['first_score'])
+        self.assertFalse(Scores.objects.filter(course=self.course).exists())
+
+    def test_course_of_another_teacher(self):
+        course = Course.objects.filter(teacher__user=self.other_teacher).first()
+        response = self.put([{'student_id': self.students[0].pk, 'first_score': 7.5}], course)
+
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(Scores.objects.filter(course=course).exists())
+
+
+@override_settings(DATABASE_SHARDS=['shard_1', 'shard_2'])
+class ShardingTests(SQLiteDatabasesMixin, TestCase):
+    extra_databases = ('shard_1', 'shard_2')
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.north, cls.north_admin, cls.north_teacher = create_institution('north')
+        cls.south, cls.south_admin, _ = create_institution('south')
+        sharding.InstitutionMover(cls.north.pk, 'shard_1').run()
+
+    def setUp(self):
+        sharding.directory_cache.clear()
+
+    def get_ids(self, user, url):
+        client = APIClient()
+        client.force_authenticate(user)
+        response = client.get(url, {'page_size': 100})
+        self.assertEqual(response.status_code, 200)
+        return {row['id'] for row in response.json()['results']}
+
+    def test_move(self):
+        classes = Class.objects.using('shard_1').filter(program__institution=self.north.pk)
+
+        self.assertEqual(classes.count(), 2)
+        self.assertFalse(Class.objects.filter(program__institution=self.north.pk).exists())
+        self.assertFalse(Institution.objects.filter(pk=self.north.pk).exists())
+        # users stay in the directory, their shard keeps copies
+        self.assertTrue(User.objects.filter(pk=self.north_admin.pk).exists())
+        self.assertTrue(User.objects.using('shard_1').filter(pk=self.north_admin.pk).exists())
+        self.assertEqual(memberships.check('shard_1'), [])
+        self.assertFalse(Membership.objects.filter(institution_id=self.north.pk).exists())
+
+    def test_directory(self):
+        self.assertEqual(sharding.get_institution_shard(self.north.pk), 'shard_1')
+        self.assertEqual(sharding.get_institution_shard(self.south.pk), DEFAULT_DB_ALIAS)
+        self.assertEqual(sharding.get_user_shard(self.north_teacher.pk), 'shard_1')
+        self.assertEqual(sharding.get_user_shard(self.south_admin.pk), DEFAULT_DB_ALIAS)
+
+        with self.assertNumQueries(0):
+            sharding.get_institution_shard(self.north.pk)
+            sharding.get_user_shard(self.north_teacher.pk)
+
+    def test_routing(self):
+        north_classes = Class.objects.using('shard_1').values_list('pk', flat=True)
+        south_classes = Class.objects.filter(program__institution=self.south).values_list('pk', flat=True)
+
+        self.assertEqual(self.get_ids(self.north_admin, '/classes/'), set(north_classes))
+        self.assertEqual(self.get_ids(self.south_admin, '/classes/'), set(south_classes))
+        self.assertEqual(
+            self.get_ids(self.north_teacher, '/my-classes/'), set(north_classes)
+        )
+
+        with sharding.use_shard('shard_1'):
+            self.assertEqual(set(Class.objects.values_list('pk', flat=True)), set(north_classes))
+
+    def test_allocated_institution_ids(self):
+        # the serializer sets the institution of the admin
+        request = types.SimpleNamespace(user=User.objects.get(pk=self.south_admin.pk))
+        serializer = serializers.InstitutionSerializer(data={'name': 'east'}, context={'request': request})
+        serializer.is_valid(raise_exception=True)
+        east = serializer.save()
+
+        self.assertEqual(east.pk, max(self.north.pk, self.south.pk) + 1)
+        self.assertEqual(sharding.get_institution_shard(east.pk), DEFAULT_DB_ALIAS)
+
+        west_id = sharding.allocate_institution_id('shard_2')
+        self.assertEqual(west_id, east.pk + 1)
+        self.assertEqual(sharding.get_institution_shard(west_id), 'shard_2')
+
+        west = Institution.objects.using('shard_2').create(pk=west_id, name='west')
+        sharding.register_institution(west)
+
+    def test_colliding_ids_are_refused(self):
+        # the sequence of shard_1 continues from the moved institution, into
+        # the ids of the default database
+        east = Institution.objects.using('shard_1').create(name='east')
+        self.assertEqual(east.pk, self.south.pk)
+
+        with self.assertRaises(IntegrityError):
+            sharding.register_institution(east)
+
+        west = Institution.objects.using('shard_2').create(pk=self.north.pk, name='west')
+        with self.assertRaises(IntegrityError):
+            sharding.register_institution(west)
+
+        self.assertEqual(
+            dict(InstitutionShard.objects.values_list('institution_id', 'database')),
+            {self.north.pk: 'shard_1'}
+        )
+
+
+class IndexAdvisorTests(TestCase):
+
+    def test_referenced_columns(self):
+        sql = (
+            'SELECT "scores"."id" FROM "scores" '
+            'INNER JOIN "course" ON ("scores"."course_id" = "course"."id") '
+            'WHERE ("course"."teacher_id" IN (1, 2) AND "scores"."first_score" > 5)'
+        )
+        self.assertEqual(index_advisor.get_referenced_columns(sql), {
+            ('scores', 'course_id'), ('course', 'id'), ('course', 'teacher_id'),
+            ('scores', 'first_score'),
+        })
+
+    def test_suggested_indexes(self):
+        recorder = index_advisor.QueryRecorder()
+        with connection.execute_wrapper(recorder):
+            recorder.scenario = 'passing-scores'
+            list(Scores.objects.filter(first_score__gte=6))
+            recorder.scenario = 'teacher-courses'
+            list(Course.objects.filter(teacher_id=1))
+
+        advice = index_advisor.IndexAdvisor(min_rows=0).advise(recorder.queries)
+        missing = {(index['table'], index['column']): index for index in advice['missing_indexes']}
+
+        self.assertEqual(advice['queries'], 2)
+        self.assertEqual(missing['scores', 'first_score']['scenarios'], ['passing-scores'])
+        self.assertEqual(
+            missing['scores', 'first_score']['sql'],
+            'CREATE INDEX "scores_first_score_idx" ON "scores" ("first_score");'
+        )
+        # foreign keys lead an index
+        self.assertNotIn(('course', 'teacher_id'), missing)
+        self.assertIn(('scores', 'full scan'), {(scan['table'], scan['kind']) for scan in advice['scans']})
+
+
+class FakeConnection:
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPoolTests(TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.pool = pool.ConnectionPool(
+            'test', min_size=0, max_size=1, max_lifetime=60, timeout=0.05,
+            health_check_delay=10, timer=lambda: self.now,
+        )
+
+    def checkout(self, check=lambda connection: None):
+        return self.pool.checkout(FakeConnection, check)
+
+    def checkin(self, connection):
+        self.pool.checkin(connection, lambda connection: True)
+
+    def test_exhausted_pool_times_out(self):
+        self.pool.timer = time.monotonic
+        self.checkout()
+
+        started = time.monotonic()
+        with self.assertRaises(pool.PoolTimeout):
+            self.checkout()
+        self.assertGreaterEqual(time.monotonic() - started, 0.05)
+        self.assertEqual(self.pool.stats()['timeouts'], 1)
+
+    def test_reused_until_too_old(self):
+        connection = self.checkout()
+        self.checkin(connection)
+        self.assertIs(self.checkout(), connection)
+
+        self.checkin(connection)
+        self.now = 60
+        replacement = self.checkout()
+        self.assertIsNot(replacement, connection)
+        self.assertTrue(connection.closed)
+
+    def test_stale_connection_replaced(self):
+        connection = self.checkout()
+        self.checkin(connection)
+
+        def check(connection):
+            raise OperationalError('gone')
+
+        # only connections idle for health_check_delay are checked
+        self.now = 9
+        self.assertIs(self.checkout(check), connection)
+        self.checkin(connection)
+        self.now = 20
+        replacement = self.checkout(check)
+
+        self.assertIsNot(replacement, connection)
+        self.assertTrue(connection.closed)
+        self.assertEqual(self.pool.stats()['failed_checks'], 1)
+
+    def test_returned_on_request_end(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        connections.databases['pooled'] = pooled({
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(directory, 'pooled.sqlite3'),
+        }, min_size=1, max_size=2)
+        self.addCleanup(connections.databases.pop, 'pooled')
+        self.addCleanup(delattr, connections._connections, 'pooled')
+        self.addCleanup(pool.close_all)
+
+        connections['pooled'].ensure_connection()
+        raw = connections['pooled'].connection
+        stats = connections['pooled'].get_pool().stats()
+        self.assertEqual((stats['in_use'], stats['idle']), (1, 0))
+
+        request_finished.send(sender=self.__class__)
+        stats = connections['pooled'].get_pool().stats()
+        self.assertIsNone(connections['pooled'].connection)
+        self.assertEqual((stats['in_use'], stats['idle']), (0, 1))
+
+        connections['pooled'].ensure_connection()
+        self.assertIs(connections['pooled'].connection, raw)
+        connections['pooled'].close()
+
+
+@override_settings(DATABASE_REPLICAS=['replica_1'])
+class ReplicaTests(SQLiteDatabasesMixin, TransactionTestCase):
+    """
+    The replica is an empty copy of the schema, so what a request reads
+    tells which database it read from.
+    """
+    extra_databases = ('replica_1',)
+
+    def setUp(self):
+        self.institution, self.admin, self.teacher = create_institution('north')
+        replicas._unavailable.clear()
+        caches[settings.REPLICA_PIN_CACHE_ALIAS].clear()
+
+        self.client = APIClient()
+        self.client.force_authenticate(self.teacher)
+
+    def request(self, method, url, data=None):
+        with CaptureQueriesContext(connections[DEFAULT_DB_ALIAS]) as primary, \
+                CaptureQueriesContext(connections['replica_1']) as replica:
+            response = getattr(self.client, method)(url, data, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        return response, len(primary), len(replica)
+
+    def test_safe_requests_read_from_replica(self):
+        response, primary, replica = self.request('get', '/my-classes/')
+
+        self.assertEqual(response.json()['results'], [])
+        self.assertEqual(primary, 0)
+        self.assertGreater(replica, 0)
+
+    def test_writes_and_pinned_users_read_from_primary(self):
+        _, _, replica = self.request('patch', '/my-account/', {'email': 'ada@example.com'})
+        self.assertEqual(replica, 0)
+        self.assertEqual(User.objects.get(pk=self.teacher.pk).email, 'ada@example.com')
+
+        # the teacher is pinned to the primary after the write
+        response, _, replica = self.request('get', '/my-classes/')
+        self.assertEqual(len(response.json()['results']), 2)
+        self.assertEqual(replica, 0)
+
+        self.client.force_authenticate(self.admin)
+        self.assertGreater(self.request('get', '/classes/')[2], 0)
+        replicas.pin_to_primary(self.admin)
+        self.assertEqual(self.request('get', '/classes/')[2], 0)
+
+    def test_cached_renders_read_from_primary(self):
+        response, primary, _ = self.request('get', '/my-courses/')
+        self.assertEqual(len(response.json()['results']), 2)
+        self.assertGreater(primary, 0)
+
+        replicas._local.state = types.SimpleNamespace(get_read_alias=lambda: 'replica_1')
+        try:
+            tree = institution_tree.build_tree(self.institution.pk)
+        finally:
+            replicas._local.state = None
+        self.assertEqual(tree['name'], 'north')
+
+    def test_unavailable_replica(self):
+        replica = connections['replica_1']
+        with mock.patch.object(
+                replica, 'ensure_connection', side_effect=OperationalError('down')) as connect:
+            with CaptureQueriesContext(connections[DEFAULT_DB_ALIAS]) as primary, \
+                    self.assertLogs(replicas.logger, 'WARNING'):
+                response = self.client.get('/my-classes/')
+
+            self.assertEqual(len(response.json()['results']), 2)
+            self.assertGreater(len(primary), 0)
+            self.assertIn('replica_1', replicas._unavailable)
+
+            # skipped without trying to connect until REPLICA_RETRY_AFTER
+            self.assertEqual(self.client.get('/my-classes/').status_code, 200)
+            self.assertEqual(connect.call_count, 1)
+
+
+class MembershipTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.institution, cls.admin, cls.teacher = create_institution('north', classes=3, programs=2)
+        cls.other, *_ = create_institution('south')
+
+    def assertConsistent(self):
+        self.assertEqual(memberships.check(), [])
+
+    def get_ids(self, client, url):
+        response = client.get(url, {'page_size': 100})
+        self.assertEqual(response.status_code, 200)
+        return {row['id'] for row in response.json()['results']}
+
+    def test_teacher_scopes(self):
+        client = APIClient()
+        client.force_authenticate(self.teacher)
+        classes = Class.objects.filter(courses__teacher__user=self.teacher)
+
+        self.assertEqual(self.get_ids(client, '/my-classes/'), set(classes.values_list('pk', flat=True)))
+        self.assertEqual(
+            self.get_ids(client, '/my-programs/'), set(classes.values_list('program', flat=True))
+        )
+        self.assertEqual(self.teacher.get_institution_id(), self.institution.pk)
+
+    def test_signals_keep_memberships(self):
+        self.assertConsistent()
+
+        class_ = Class.objects.filter(program__institution=self.institution).first()
+        class_.program = Program.objects.filter(institution=self.institution).last()
+        class_.save()
+        self.assertConsistent()
+
+        program = class_.program
+        program.institution = self.other
+        program.save()
+        self.assertConsistent()
+
+        user = User.objects.create_user('north-teacher-2', 'north-teacher-2@example.com', 'pw', is_teacher=True)
+        course = Course.objects.filter(teacher__user=self.teacher).first()
+        course.teacher = Teacher.objects.create(user=user, institution=self.institution)
+        course.save()
+        self.assertConsistent()
+
+        Student.objects.filter(class_id=class_).first().delete()
+        self.assertConsistent()
+        class_.delete()
+        self.assertConsistent()
+        Institution.objects.filter(pk=self.institution.pk).delete()
+        self.assertConsistent()
+
+    def test_rebuild(self):
+        Membership.objects.filter(role=Membership.STUDENT).delete()
+        Membership.objects.filter(role=Membership.TEACHER).update(class_id=None)
+
+        drifted = User.objects.filter(Q(is_student=True) | Q(is_teacher=True))
+        self.assertEqual(memberships.check(), list(drifted.order_by('pk').values_list('pk', flat=True)))
+
+        memberships.rebuild()
+        self.assertConsistent()
+
+    def test_backfill_migration(self):
+        migration = importlib.import_module(
+            'class_path_auth.accounts.migrations.0005_backfill_memberships'
+        )
+        Membership.objects.all().delete()
+
+        migration.backfill_memberships(None, types.SimpleNamespace(connection=connection))
+        self.assertConsistent()
+        self.assertEqual(self.teacher.get_institution_id(), self.institution.pk)
+
+
+class HierarchyTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.institution, cls.admin, cls.teacher = create_institution('north', classes=3, programs=2)
+        cls.other, cls.other_admin, _ = create_institution('south')
+
+        # a teacher of a single course, and a student of its class
+        user = User.objects.create_user('north-teacher-2', 'north-teacher-2@example.com', 'pw', is_teacher=True)
+        cls.course = Course.objects.filter(teacher__user=cls.teacher).first()
+        cls.course.teacher = Teacher.objects.create(user=user, institution=cls.institution)
+        cls.course.save()
+        cls.course_teacher = user
+        cls.student = User.objects.get(student__class_id=cls.course.class_id_id)
+
+    def setUp(self):
+        hierarchy.graphs.clear()
+        hierarchy.user_institutions.clear()
+
+    def get_objects(self):
+        return (
+            list(Institution.objects.order_by('pk')) + list(Program.objects.order_by('pk'))
+            + list(Class.objects.order_by('pk')) + list(Course.objects.order_by('pk'))
+        )
+
+    def test_scopes(self):
+        objects = self.get_objects()
+        class_ = self.course.class_id
+        north = [
+            obj for obj in objects
+            if obj == self.institution
+            or obj in Program.objects.filter(institution=self.institution)
+            or obj in Class.objects.filter(program__institution=self.institution)
+            or obj in Course.objects.filter(teacher__institution=self.institution)
+        ]
+
+        self.assertEqual(hierarchy.filter_visible(self.admin, objects), north)
+        self.assertEqual(
+            hierarchy.filter_visible(self.course_teacher, objects),
+            [self.institution, class_.program, class_, self.course]
+        )
+        self.assertEqual(
+            hierarchy.filter_visible(self.student, objects),
+            [self.institution, class_.program, class_] + list(class_.courses.order_by('pk'))
+        )
+        self.assertFalse(hierarchy.can_view(self.other_admin, self.course))
+        self.assertEqual(
+            hierarchy.visible_ids(self.teacher, Course),
+            set(Course.objects.filter(teacher__user=self.teacher).values_list('pk', flat=True))
+        )
+
+    def test_no_queries_once_built(self):
+        objects = self.get_objects()
+        users = (self.admin, self.teacher, self.course_teacher, self.student, self.other_admin)
+        for user in users:
+            hierarchy.filter_visible(user, objects)
+
+        with self.assertNumQueries(0):
+            for user in users:
+                hierarchy.filter_visible(user, objects)
+                hierarchy.visible_ids(user, Class)
+
+    def test_rebuilt_on_new_version(self):
+        self.assertTrue(hierarchy.can_view(self.admin, self.course))
+        class_ = Class.objects.create(name='new', program=self.course.class_id.program)
+        # the version is bumped once the change is committed
+        self.assertFalse(hierarchy.can_view(self.admin, class_))
+
+        hierarchy.bump_versions([self.institution.pk])
+        self.assertTrue(hierarchy.can_view(self.admin, class_))
+
+    def test_permission(self):
+        request = types.SimpleNamespace(user=self.student)
+
+        self.assertTrue(CanViewObject().has_object_permission(request, None, self.course))
+        self.assertFalse(CanViewObject().has_object_permission(request, None, self.other))
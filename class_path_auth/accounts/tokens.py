@@ -0,0 +1,184 @@
+"""
+Signed access and refresh tokens.
+
+Tokens are compact JWTs signed with Ed25519 (`EdDSA`), so any service holding
+the public key published on `/login/keys/` can verify them offline.
+"""
+import base64
+import functools
+import hashlib
+import json
+import time
+import uuid
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.crypto import constant_time_compare
+
+
+ALGORITHM = 'EdDSA'
+ACCESS = 'access'
+REFRESH = 'refresh'
+
+
+class TokenError(Exception):
+    pass
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def _b64decode(data):
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+@functools.lru_cache()
+def get_signing_key():
+    pem = settings.SIGNED_TOKEN_PRIVATE_KEY
+    if pem:
+        return serialization.load_pem_private_key(
+            pem.encode(), password=None, backend=default_backend()
+        )
+
+    # without an explicit key every worker derives the same one from SECRET_KEY
+    seed = hashlib.sha256(('signed-token' + settings.SECRET_KEY).encode()).digest()
+    return Ed25519PrivateKey.from_private_bytes(seed)
+
+
+@functools.lru_cache()
+def get_verifying_key():
+    return get_signing_key().public_key()
+
+
+def _public_key_bytes():
+    return get_verifying_key().public_bytes(
+        serialization.Encoding.Raw,
+        serialization.PublicFormat.Raw,
+    )
+
+
+@functools.lru_cache()
+def get_key_id():
+    return hashlib.sha256(_public_key_bytes()).hexdigest()[:16]
+
+
+def get_public_jwk():
+    return {
+        'kty': 'OKP',
+        'crv': 'Ed25519',
+        'alg': ALGORITHM,
+        'use': 'sig',
+        'kid': get_key_id(),
+        'x': _b64encode(_public_key_bytes()),
+    }
+
+
+def encode(claims):
+    header = {'alg': ALGORITHM, 'typ': 'JWT', 'kid': get_key_id()}
+    signing_input = '.'.join(
+        _b64encode(json.dumps(part, separators=(',', ':')).encode())
+        for part in (header, claims)
+    )
+    signature = get_signing_key().sign(signing_input.encode())
+    return signing_input + '.' + _b64encode(signature)
+
+
+def decode(token, token_type=ACCESS):
+    """
+    Verify the token signature and expiration and return its claims.
+    """
+    try:
+        header_segment, claims_segment, signature_segment = token.split('.')
+        header = json.loads(_b64decode(header_segment))
+        claims = json.loads(_b64decode(claims_segment))
+        signature = _b64decode(signature_segment)
+    except (ValueError, TypeError):
+        raise TokenError('Malformed token.')
+
+    if not isinstance(header, dict) or not isinstance(claims, dict):
+        raise TokenError('Malformed token.')
+
+    if header.get('alg') != ALGORITHM or header.get('kid') != get_key_id():
+        raise TokenError('Unknown signing key.')
+
+    try:
+        signing_input = (header_segment + '.' + claims_segment).encode()
+        get_verifying_key().verify(signature, signing_input)
+    except InvalidSignature:
+        raise TokenError('Invalid token signature.')
+
+    if claims.get('type') != token_type:
+        raise TokenError('Invalid token type.')
+    if claims.get('iss') != settings.SIGNED_TOKEN_ISSUER:
+        raise TokenError('Invalid token issuer.')
+    if claims.get('exp', 0) <= time.time():
+        raise TokenError('Token has expired.')
+
+    return claims
+
+
+def get_refresh_hash(user):
+    # changing the password invalidates every refresh token issued before
+    return user.get_session_auth_hash()[:32]
+
+
+def issue_tokens(user):
+    now = int(time.time())
+    common = {
+        'iss': settings.SIGNED_TOKEN_ISSUER,
+        'sub': str(user.pk),
+        'iat': now,
+    }
+
+    access = encode(dict(
+        common,
+        type=ACCESS,
+        exp=now + settings.SIGNED_TOKEN_ACCESS_TTL,
+        is_teacher=user.is_teacher,
+        is_student=user.is_student,
+        is_admin=user.is_admin,
+        institution_id=user.get_institution_id(),
+    ))
+    refresh = encode(dict(
+        common,
+        type=REFRESH,
+        exp=now + settings.SIGNED_TOKEN_REFRESH_TTL,
+        jti=uuid.uuid4().hex,
+        hash=get_refresh_hash(user),
+    ))
+
+    return {
+        'token_type': 'Bearer',
+        'access': access,
+        'refresh': refresh,
+        'expires_in': settings.SIGNED_TOKEN_ACCESS_TTL,
+    }
+
+
+def check_refresh_claims(user, claims):
+    return constant_time_compare(claims.get('hash', ''), get_refresh_hash(user))
+
+
+def _redeemed_key(jti):
+    return 'refresh-token:%s:redeemed' % jti
+
+
+def redeem_refresh_token(claims):
+    """
+    Mark the refresh token of `claims` as used until it expires. Returns
+    False when it was already redeemed.
+    """
+    jti = claims.get('jti')
+    if not jti:
+        return False
+
+    timeout = max(int(claims['exp'] - time.time()), 1)
+    # add is atomic, of two concurrent redemptions only one succeeds
+    return caches[settings.SIGNED_TOKEN_CACHE_ALIAS].add(_redeemed_key(jti), True, timeout)
+
@@ -0,0 +1,41 @@
+"""
+Version counters of the models without a `modified_at` column.
+
+User, Token, Group and Permission rows do not record when they change, so
+their signals bump a counter per model in the cache shared by every process.
+Validators read the counter instead of the rows.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+def get_cache():
+    return caches[settings.MODEL_VERSION_CACHE_ALIAS]
+
+
+def _version_key(model):
+    return 'model-version:%s' % model._meta.label_lower
+
+
+def get_versions(models):
+    cache = get_cache()
+    keys = {model: _version_key(model) for model in models}
+
+    versions = cache.get_many(keys.values())
+    for model, key in keys.items():
+        if key not in versions:
+            # start from the clock so a lost version never reuses an old one
+            cache.add(key, int(time.time() * 1000000), None)
+            versions[key] = cache.get(key)
+
+    return {model: versions[key] for model, key in keys.items()}
+
+
+def bump_version(model):
+    cache = get_cache()
+    try:
+        cache.incr(_version_key(model))
+    except ValueError:
+        cache.set(_version_key(model), int(time.time() * 1000000), None)
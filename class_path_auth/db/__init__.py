@@ -0,0 +1,47 @@
+"""
+Database connection pooling.
+
+The pooled backends keep the connections of each worker process in a pool
+instead of opening one per request: Django closes its connection at the
+end of every request (CONN_MAX_AGE is 0), which hands it back to the pool,
+and the next request of any thread checks out an open one.
+
+Pooling is configured with a POOL dict in the database settings, see
+`pooled`.
+"""
+
+ENGINES = {
+    'django.db.backends.postgresql': 'class_path_auth.db.backends.postgresql',
+    'django.db.backends.postgresql_psycopg2': 'class_path_auth.db.backends.postgresql',
+    'django.db.backends.sqlite3': 'class_path_auth.db.backends.sqlite3',
+}
+
+POOL_DEFAULTS = {
+    # connections opened on the first checkout, and kept open
+    'MIN_SIZE': 1,
+    # connections open at once, further checkouts wait for one to be returned
+    'MAX_SIZE': 10,
+    # seconds before a connection is closed instead of being reused
+    'MAX_LIFETIME': 3600,
+    # seconds a checkout waits for a connection before failing
+    'TIMEOUT': 10,
+    # connections idle for longer are checked with a query on checkout
+    'HEALTH_CHECK_DELAY': 30,
+}
+
+
+def pooled(settings_dict, **options):
+    """
+    Return a copy of the database `settings_dict` using the pooled backend
+    of its engine, with the given POOL options.
+    """
+    engine = settings_dict['ENGINE']
+    if engine not in ENGINES:
+        raise ValueError('Connection pooling is not available for %s.' % engine)
+
+    pool = dict(POOL_DEFAULTS)
+    pool.update((name.upper(), value) for name, value in options.items())
+    if not 0 <= pool['MIN_SIZE'] <= pool['MAX_SIZE'] or pool['MAX_SIZE'] < 1:
+        raise ValueError('The pool needs 0 <= MIN_SIZE <= MAX_SIZE and MAX_SIZE >= 1.')
+
+    return dict(settings_dict, ENGINE=ENGINES[engine], CONN_MAX_AGE=0, POOL=pool)
@@ -0,0 +1,27 @@
+from django.db.backends.postgresql import base
+
+from psycopg2 import extensions
+
+from ...pool import PooledDatabaseWrapperMixin
+
+
+class DatabaseWrapper(PooledDatabaseWrapperMixin, base.DatabaseWrapper):
+
+    def get_new_connection(self, conn_params):
+        connection = super().get_new_connection(conn_params)
+        # set by the base backend only when it opens the connection itself
+        self.isolation_level = connection.isolation_level
+        return connection
+
+    def check_pooled_connection(self, connection):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        if connection.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+            connection.rollback()
+
+    def reset_pooled_connection(self, connection):
+        if connection.closed:
+            return False
+        if connection.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+            connection.rollback()
+        return True
@@ -0,0 +1,19 @@
+from django.db.backends.sqlite3 import base
+
+from ...pool import PooledDatabaseWrapperMixin
+
+
+class DatabaseWrapper(PooledDatabaseWrapperMixin, base.DatabaseWrapper):
+
+    @property
+    def pool_enabled(self):
+        # in-memory databases live and die with their only connection
+        return super().pool_enabled and not self.is_in_memory_db()
+
+    def check_pooled_connection(self, connection):
+        connection.execute('SELECT 1').close()
+
+    def reset_pooled_connection(self, connection):
+        if connection.in_transaction:
+            connection.rollback()
+        return True
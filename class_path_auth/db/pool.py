@@ -0,0 +1,300 @@
+import functools
+import os
+import threading
+import time
+
+from collections import deque
+
+from django.db.utils import OperationalError
+
+
+class PoolTimeout(OperationalError):
+    pass
+
+
+class ConnectionPool:
+    """
+    Thread safe pool of DB-API connections, bounded to `max_size` open at
+    once.
+
+    Idle connections are reused last in, first out, so a quiet worker keeps
+    reusing the same warm ones. Connections older than `max_lifetime` are
+    closed when returned or found idle, and those idle for longer than
+    `health_check_delay` are checked before being handed out.
+    """
+
+    def __init__(self, name, min_size=1, max_size=10, max_lifetime=3600, timeout=10,
+                 health_check_delay=30, timer=time.monotonic):
+        self.name = name
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_lifetime = max_lifetime
+        self.timeout = timeout
+        self.health_check_delay = health_check_delay
+        self.timer = timer
+        # connections are not shared with forked workers
+        self.pid = os.getpid()
+
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.timeouts = 0
+        self.created = 0
+        self.closed = 0
+        self.failed_checks = 0
+        self.peak_in_use = 0
+
+        # (connection, created at, returned at)
+        self._idle = deque()
+        self._in_use = {}
+        self._size = 0
+        self._condition = threading.Condition()
+
+    def __len__(self):
+        return self._size
+
+    def _expired(self, created_at, now):
+        return self.max_lifetime is not None and now - created_at >= self.max_lifetime
+
+    def _close(self, connection):
+        self.closed += 1
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def _discard(self, connection):
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+        self._close(connection)
+
+    def _take(self, deadline, waited):
+        """
+        Return an idle connection, True when a new one may be opened, or
+        wait for one to be returned. Called holding the lock.
+        """
+        expired = []
+        try:
+            while True:
+                now = self.timer()
+                while self._idle:
+                    entry = self._idle.pop()
+                    if not self._expired(entry[1], now):
+                        return entry, waited
+                    self._size -= 1
+                    expired.append(entry[0])
+
+                if self._size < self.max_size:
+                    self._size += 1
+                    return True, waited
+
+                remaining = deadline - now
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise PoolTimeout(
+                        'No connection of the %s pool was returned within %ss, '
+                        'all %d are in use.' % (self.name, self.timeout, self.max_size)
+                    )
+                waited = True
+                self._condition.wait(remaining)
+        finally:
+            for connection in expired:
+                self._close(connection)
+
+    def checkout(self, connect, check):
+        """
+        Return an open connection, opened with `connect` when none is idle.
+        `check` raises if an idle connection can no longer be used.
+        """
+        started = self.timer()
+        deadline = started + self.timeout
+        waited = False
+
+        while True:
+            with self._condition:
+                entry, waited = self._take(deadline, waited)
+
+            if entry is True:
+                try:
+                    connection = connect()
+                except Exception:
+                    with self._condition:
+                        self._size -= 1
+                        self._condition.notify()
+                    raise
+                created_at = self.timer()
+                self.created += 1
+                break
+
+            connection, created_at, returned_at = entry
+            if self.timer() - returned_at < self.health_check_delay:
+                break
+            try:
+                check(connection)
+                break
+            except Exception:
+                self.failed_checks += 1
+                self._discard(connection)
+
+        with self._condition:
+            self._in_use[id(connection)] = created_at
+            self.checkouts += 1
+            self.peak_in_use = max(self.peak_in_use, len(self._in_use))
+            if waited:
+                self.waits += 1
+                self.wait_time += self.timer() - started
+
+        return connection
+
+    def checkin(self, connection, reset):
+        """
+        Return a connection to the pool. `reset` rolls back what the
+        connection left behind, returning False if it can't be reused.
+        """
+        with self._condition:
+            created_at = self._in_use.pop(id(connection), None)
+        if created_at is None:
+            # opened before the pool was, or by another process
+            self._close(connection)
+            return
+
+        try:
+            reusable = (
+                self.pid == os.getpid()
+                and not self._expired(created_at, self.timer())
+                and reset(connection)
+            )
+        except Exception:
+            reusable = False
+
+        if not reusable:
+            self._discard(connection)
+            return
+
+        with self._condition:
+            self._idle.append((connection, created_at, self.timer()))
+            self._condition.notify()
+
+    def fill(self, connect):
+        """
+        Open connections until the pool holds `min_size` of them.
+        """
+        while True:
+            with self._condition:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                connection = connect()
+            except Exception:
+                with self._condition:
+                    self._size -= 1
+                raise
+            self.created += 1
+            with self._condition:
+                self._idle.appendleft((connection, self.timer(), self.timer()))
+                self._condition.notify()
+
+    def close(self):
+        """
+        Close the idle connections, the ones in use are closed when returned.
+        """
+        with self._condition:
+            idle, self._idle = self._idle, deque()
+            # connections in use are no longer known, so closed when returned
+            self._size -= len(idle) + len(self._in_use)
+            self._in_use.clear()
+            self._condition.notify_all()
+        for connection, _, _ in idle:
+            self._close(connection)
+
+    def stats(self):
+        with self._condition:
+            in_use, idle, size = len(self._in_use), len(self._idle), self._size
+        return {
+            'size': size,
+            'idle': idle,
+            'in_use': in_use,
+            'min_size': self.min_size,
+            'max_size': self.max_size,
+            'saturation': in_use / self.max_size,
+            'peak_in_use': self.peak_in_use,
+            'checkouts': self.checkouts,
+            'waits': self.waits,
+            'mean_wait_ms': self.wait_time / self.waits * 1000 if self.waits else 0.0,
+            'timeouts': self.timeouts,
+            'created': self.created,
+            'closed': self.closed,
+            'failed_checks': self.failed_checks,
+        }
+
+
+# pools of this process by database, see get_pool
+pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias, settings_dict):
+    key = (
+        alias, settings_dict['NAME'], settings_dict.get('HOST'),
+        settings_dict.get('PORT'), settings_dict.get('USER'),
+    )
+    with _pools_lock:
+        pool = pools.get(key)
+        if pool is None or pool.pid != os.getpid():
+            options = {name.lower(): value for name, value in settings_dict['POOL'].items()}
+            pool = pools[key] = ConnectionPool(alias, **options)
+    return pool
+
+
+def get_stats():
+    return {
+        pool.name: pool.stats() for pool in list(pools.values()) if pool.pid == os.getpid()
+    }
+
+
+def close_all():
+    for pool in list(pools.values()):
+        pool.close()
+
+
+class PooledDatabaseWrapperMixin:
+    """
+    Check connections out of the pool of the database instead of opening
+    them, and hand them back when Django closes them.
+
+    Backends implement `check_pooled_connection` and
+    `reset_pooled_connection`.
+    """
+
+    @property
+    def pool_enabled(self):
+        return bool(self.settings_dict.get('POOL'))
+
+    def get_pool(self):
+        return get_pool(self.alias, self.settings_dict)
+
+    def get_new_connection(self, conn_params):
+        if not self.pool_enabled:
+            return super().get_new_connection(conn_params)
+
+        pool = self.get_pool()
+        connect = functools.partial(super().get_new_connection, conn_params)
+        connection = pool.checkout(connect, self.check_pooled_connection)
+        if len(pool) < pool.min_size:
+            pool.fill(connect)
+        return connection
+
+    def _close(self):
+        if self.connection is None or not self.pool_enabled:
+            return super()._close()
+
+        with self.wrap_database_errors:
+            self.get_pool().checkin(self.connection, self.reset_pooled_connection)
+
+    def check_pooled_connection(self, connection):
+        raise NotImplementedError
+
+    def reset_pooled_connection(self, connection):
+        raise NotImplementedError
@@ -0,0 +1,197 @@
+"""
+Read replicas.
+
+ReplicaMiddleware lets the safe (GET, HEAD, OPTIONS) requests of
+authenticated users read from one of the DATABASE_REPLICAS, picked once per
+request, while ReplicaRouter keeps every write on the primary. Until the
+request is authenticated reads stay on the primary too: a token or password
+that was just changed may not have reached the replicas yet, and most
+authentications are served from the caches anyway.
+
+Users are pinned to the primary for REPLICA_PIN_SECONDS after each
+successful unsafe request, so they read their own writes (e.g. a
+/my-account/ update or a new institution) while the replicas catch up. Pins
+live in the REPLICA_PIN_CACHE_ALIAS cache, which must be shared by the
+workers for them to see each other's pins.
+
+A replica that can't be connected to is skipped for REPLICA_RETRY_AFTER
+seconds, reads fall back to the other replicas and then to the primary.
+
+Data cached under versions bumped on primary commits must be rendered
+inside `read_from_primary`: a lagging replica would store stale rows under
+the new version.
+"""
+import contextlib
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from django.utils.functional import LazyObject
+
+from rest_framework.permissions import SAFE_METHODS
+
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+# replica alias -> time it may be tried again
+_unavailable = {}
+
+
+def _pin_key(user_id):
+    return 'replica-pin:%s' % user_id
+
+
+def pin_to_primary(user):
+    """
+    Read `user`'s requests from the primary for REPLICA_PIN_SECONDS.
+    """
+    caches[settings.REPLICA_PIN_CACHE_ALIAS].set(
+        _pin_key(user.pk), True, settings.REPLICA_PIN_SECONDS
+    )
+
+
+def is_pinned(user):
+    return bool(caches[settings.REPLICA_PIN_CACHE_ALIAS].get(_pin_key(user.pk)))
+
+
+def get_authenticated_user(request):
+    # rest framework sets the user once the request is authenticated, until
+    # then it's the lazy session user of AuthenticationMiddleware
+    user = request.__dict__.get('user')
+    if user is None or isinstance(user, LazyObject) or not user.is_authenticated:
+        return None
+    return user
+
+
+def get_available_replica(timer=time.monotonic):
+    """
+    Return the alias of a replica accepting connections, or None.
+    """
+    now = timer()
+    replicas = [
+        alias for alias in settings.DATABASE_REPLICAS
+        if _unavailable.get(alias, 0) <= now
+    ]
+    random.shuffle(replicas)
+
+    for alias in replicas:
+        try:
+            connections[alias].ensure_connection()
+        except DatabaseError as exc:
+            _unavailable[alias] = now + settings.REPLICA_RETRY_AFTER
+            logger.warning(
+                'Replica %s is unavailable, skipped for %ss: %s',
+                alias, settings.REPLICA_RETRY_AFTER, exc
+            )
+            continue
+        _unavailable.pop(alias, None)
+        return alias
+
+    return None
+
+
+class RequestState:
+
+    def __init__(self, request):
+        self.request = request
+        # replica read by the request, False once it's known to read the primary
+        self.replica = None
+
+    def get_read_alias(self):
+        if self.replica is None:
+            user = get_authenticated_user(self.request)
+            if user is None:
+                return None
+            self.replica = not is_pinned(user) and get_available_replica() or False
+
+        # reads inside a transaction see its writes
+        if not self.replica or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return None
+        return self.replica
+
+
+def get_state():
+    return getattr(_local, 'state', None)
+
+
+@contextlib.contextmanager
+def read_from_primary():
+    """
+    Read from the primary inside the block, whatever the request reads.
+    """
+    state = get_state()
+    _local.state = None
+    try:
+        yield
+    finally:
+        _local.state = state
+
+
+class ReplicaRouter:
+    """
+    Route the reads of safe requests to a replica, see ReplicaMiddleware.
+    Writes, and reads outside of them, are left to the primary.
+    """
+
+    def _is_replica(self, alias):
+        return alias in settings.DATABASE_REPLICAS
+
+    def db_for_read(self, model, **hints):
+        state = get_state()
+        return state.get_read_alias() if state is not None else None
+
+    def db_for_write(self, model, **hints):
+        instance = hints.get('instance')
+        if instance is not None and self._is_replica(instance._state.db):
+            return DEFAULT_DB_ALIAS
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {obj1._state.db, obj2._state.db}
+        if all(db == DEFAULT_DB_ALIAS or self._is_replica(db) for db in databases):
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if self._is_replica(db):
+            return False
+        return None
+
+
+class ReplicaMiddleware:
+
+    def __init__(self, get_response):
+        if not settings.DATABASE_REPLICAS:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        _local.state = RequestState(request) if request.method in SAFE_METHODS else None
+        try:
+            response = self.get_response(request)
+        except Exception:
+            _local.state = None
+            raise
+
+        if response.streaming:
+            # streamed content is read after the middleware returns
+            response._closable_objects.append(self)
+        else:
+            self.close()
+
+        if request.method not in SAFE_METHODS and response.status_code < 400:
+            user = get_authenticated_user(request)
+            if user is not None:
+                pin_to_primary(user)
+
+        return response
+
+    def close(self):
+        _local.state = None
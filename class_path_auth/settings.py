@@ -1,9 +1,11 @@
 import os
 
-from decouple import config
+from decouple import Csv, config
 from dj_database_url import parse as dburl
 from dj_database_url import config as djb_config
 
+from .db import pooled
+
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
@@ -32,10 +34,13 @@ INSTALLED_APPS = [
     'django.contrib.staticfiles',
     'rest_framework',
     'rest_framework.authtoken',
-    'class_path_auth.accounts'
+    'class_path_auth.accounts.apps.AccountsConfig',
 ]
 
 MIDDLEWARE = [
+    'class_path_auth.accounts.instrumentation.InstrumentationMiddleware',
+    'class_path_auth.db.replicas.ReplicaMiddleware',
+    'class_path_auth.accounts.sharding.ShardMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -71,6 +76,68 @@ DATABASES = {
     'default': config('DATABASE_URL', default=default_dburl, cast=dburl),
 }
 
+# Per worker connection pool, connections are handed back to it at the end
+# of each request instead of being closed. See class_path_auth.db.
+DATABASE_POOL_ENABLED = config('DATABASE_POOL_ENABLED', default=True, cast=bool)
+DATABASE_POOL_OPTIONS = {
+    'min_size': config('DATABASE_POOL_MIN_SIZE', default=1, cast=int),
+    'max_size': config('DATABASE_POOL_MAX_SIZE', default=10, cast=int),
+    'max_lifetime': config('DATABASE_POOL_MAX_LIFETIME', default=3600, cast=int),
+    'timeout': config('DATABASE_POOL_TIMEOUT', default=10, cast=float),
+    'health_check_delay': config('DATABASE_POOL_HEALTH_CHECK_DELAY', default=30, cast=int),
+}
+if DATABASE_POOL_ENABLED:
+    DATABASES['default'] = pooled(DATABASES['default'], **DATABASE_POOL_OPTIONS)
+
+# Read replicas of the default database, as comma separated URLs. The safe
+# requests of authenticated users read from them, see class_path_auth.db.replicas.
+DATABASE_REPLICAS = []
+for number, replica_url in enumerate(config('DATABASE_REPLICA_URLS', default='', cast=Csv()), 1):
+    replica = dict(dburl(replica_url), TEST={'MIRROR': 'default'})
+    if DATABASE_POOL_ENABLED:
+        replica = pooled(replica, **DATABASE_POOL_OPTIONS)
+    DATABASES['replica_%d' % number] = replica
+    DATABASE_REPLICAS.append('replica_%d' % number)
+
+# Institution shards, as comma separated URLs. Institutions live in the
+# default database until moved to a shard by the move_institution command,
+# see class_path_auth.accounts.sharding.
+DATABASE_SHARDS = []
+for number, shard_url in enumerate(config('DATABASE_SHARD_URLS', default='', cast=Csv()), 1):
+    shard = dict(dburl(shard_url), TEST={'MIRROR': 'default'})
+    if DATABASE_POOL_ENABLED:
+        shard = pooled(shard, **DATABASE_POOL_OPTIONS)
+    DATABASES['shard_%d' % number] = shard
+    DATABASE_SHARDS.append('shard_%d' % number)
+
+DATABASE_ROUTERS = [
+    'class_path_auth.accounts.sharding.InstitutionShardRouter',
+    'class_path_auth.db.replicas.ReplicaRouter',
+]
+
+# Cached lookups of the shard of institutions and users
+SHARD_DIRECTORY_CACHE_SIZE = config('SHARD_DIRECTORY_CACHE_SIZE', default=10000, cast=int)
+SHARD_DIRECTORY_TTL = config('SHARD_DIRECTORY_TTL', default=60, cast=int)
+
+# Seconds users read from the primary after a write, so they see it while
+# the replicas catch up. Pins must be kept in a cache shared by the workers.
+REPLICA_PIN_SECONDS = config('REPLICA_PIN_SECONDS', default=5, cast=int)
+REPLICA_PIN_CACHE_ALIAS = config('REPLICA_PIN_CACHE_ALIAS', default='default')
+
+# Seconds a replica that refused a connection is skipped
+REPLICA_RETRY_AFTER = config('REPLICA_RETRY_AFTER', default=30, cast=int)
+
+# Cache
+CACHES = {
+    'default': {
+        'BACKEND': config(
+            'CACHE_BACKEND',
+            default='django.core.cache.backends.locmem.LocMemCache'
+        ),
+        'LOCATION': config('CACHE_LOCATION', default=''),
+    }
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
 
@@ -112,17 +179,156 @@ STATIC_URL = '/static/'
 AUTH_USER_MODEL = 'accounts.User'
 
 AUTHENTICATION_BACKENDS = (
-    # Uncomment the following to make Django tests pass:
-    'django.contrib.auth.backends.ModelBackend',
+    'class_path_auth.accounts.backends.RolePermissionBackend',
 )
 
 # Django REST settings
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.BasicAuthentication',
-        'rest_framework.authentication.TokenAuthentication',
+        'class_path_auth.accounts.authentication.CachedBasicAuthentication',
+        'class_path_auth.accounts.authentication.CachedTokenAuthentication',
+        'class_path_auth.accounts.authentication.SignedTokenAuthentication',
     ],
     'DEFAULT_RENDERER_CLASSES': (
         'rest_framework.renderers.JSONRenderer',
-    )
+    ),
+    'DEFAULT_PAGINATION_CLASS': 'class_path_auth.accounts.api.pagination.KeysetPagination',
+    'PAGE_SIZE': config('API_PAGE_SIZE', default=50, cast=int),
+}
+
+API_MAX_PAGE_SIZE = config('API_MAX_PAGE_SIZE', default=200, cast=int)
+
+# Token authentication cache: in-process LRU plus an optional shared tier,
+# set TOKEN_CACHE_ALIAS to one of the CACHES aliases to enable it.
+TOKEN_CACHE_SIZE = config('TOKEN_CACHE_SIZE', default=10000, cast=int)
+TOKEN_CACHE_TTL = config('TOKEN_CACHE_TTL', default=300, cast=int)
+TOKEN_CACHE_ALIAS = config('TOKEN_CACHE_ALIAS', default=None)
+
+# Versions of the users' cached tokens, bumped when a token or its user
+# changes. Must be a cache shared by the workers for them to see revocations.
+TOKEN_REVOCATION_CACHE_ALIAS = config('TOKEN_REVOCATION_CACHE_ALIAS', default='default')
+
+# Verified Basic authentication credentials cache
+BASIC_AUTH_CACHE_SIZE = config('BASIC_AUTH_CACHE_SIZE', default=10000, cast=int)
+BASIC_AUTH_CACHE_TTL = config('BASIC_AUTH_CACHE_TTL', default=60, cast=int)
+
+# Login token mode: 'opaque' issues the database backed API token, 'signed'
+# issues short lived signed access tokens plus a refresh token.
+LOGIN_TOKEN_MODE = config('LOGIN_TOKEN_MODE', default='opaque')
+SIGNED_TOKEN_ISSUER = config('SIGNED_TOKEN_ISSUER', default='class-path-auth')
+SIGNED_TOKEN_PRIVATE_KEY = config(
+    'SIGNED_TOKEN_PRIVATE_KEY',
+    default='',
+    cast=lambda value: value.replace('\\n', '\n')
+)
+SIGNED_TOKEN_ACCESS_TTL = config('SIGNED_TOKEN_ACCESS_TTL', default=300, cast=int)
+SIGNED_TOKEN_REFRESH_TTL = config('SIGNED_TOKEN_REFRESH_TTL', default=604800, cast=int)
+
+# Redeemed refresh tokens, kept until they expire so they can't be reused.
+# Must be a cache shared by the workers.
+SIGNED_TOKEN_CACHE_ALIAS = config('SIGNED_TOKEN_CACHE_ALIAS', default='default')
+
+# Cached /my-institution/ documents
+INSTITUTION_TREE_CACHE_ALIAS = config('INSTITUTION_TREE_CACHE_ALIAS', default='default')
+INSTITUTION_TREE_TTL = config('INSTITUTION_TREE_TTL', default=86400, cast=int)
+INSTITUTION_TREE_LOCK_TIMEOUT = config('INSTITUTION_TREE_LOCK_TIMEOUT', default=10, cast=int)
+
+# Per-process institution hierarchy graphs of the object permissions, with
+# their versions in HIERARCHY_CACHE_ALIAS
+HIERARCHY_CACHE_ALIAS = config('HIERARCHY_CACHE_ALIAS', default='default')
+HIERARCHY_CACHE_SIZE = config('HIERARCHY_CACHE_SIZE', default=1000, cast=int)
+HIERARCHY_USER_CACHE_SIZE = config('HIERARCHY_USER_CACHE_SIZE', default=10000, cast=int)
+HIERARCHY_TTL = config('HIERARCHY_TTL', default=300, cast=int)
+
+# Per-user cache of the my-* responses, a TTL of 0 disables it
+RESPONSE_CACHE_ALIAS = config('RESPONSE_CACHE_ALIAS', default='default')
+RESPONSE_CACHE_TTL = config('RESPONSE_CACHE_TTL', default=3600, cast=int)
+
+# Versions of the models without modified_at, read by the conditional GETs
+MODEL_VERSION_CACHE_ALIAS = config('MODEL_VERSION_CACHE_ALIAS', default='default')
+
+# Bulk enrollment
+ENROLLMENT_MAX_ROWS = config('ENROLLMENT_MAX_ROWS', default=10000, cast=int)
+
+# Bulk password hashing, 0 workers means one per available core
+PASSWORD_HASHING_WORKERS = config('PASSWORD_HASHING_WORKERS', default=0, cast=int)
+PASSWORD_HASHING_PARALLEL_THRESHOLD = config(
+    'PASSWORD_HASHING_PARALLEL_THRESHOLD',
+    default=50,
+    cast=int
+)
+
+# Per-user permission cache used by RolePermissionBackend
+PERMISSION_CACHE_SIZE = config('PERMISSION_CACHE_SIZE', default=10000, cast=int)
+PERMISSION_CACHE_TTL = config('PERMISSION_CACHE_TTL', default=300, cast=int)
+
+# Rows fetched and encoded per chunk by the streaming exports
+EXPORT_CHUNK_SIZE = config('EXPORT_CHUNK_SIZE', default=2000, cast=int)
+
+# List endpoints render with compiled serializers reading values() rows
+COMPILED_SERIALIZERS = config('COMPILED_SERIALIZERS', default=True, cast=bool)
+
+# Final score needed to pass a course in the gradebooks
+GRADEBOOK_PASSING_SCORE = config('GRADEBOOK_PASSING_SCORE', default=6.0, cast=float)
+
+# Bulk score upserts
+SCORES_MAX_ROWS = config('SCORES_MAX_ROWS', default=5000, cast=int)
+SCORES_BATCH_SIZE = config('SCORES_BATCH_SIZE', default=500, cast=int)
+
+# Per-request query counts and timings, sent in the Server-Timing header
+# and logged by class_path_auth.requests
+INSTRUMENTATION_ENABLED = config('INSTRUMENTATION_ENABLED', default=True, cast=bool)
+
+# Most queries each route may run, by URL name. Going over is logged, or
+# raises QueryBudgetExceeded when QUERY_BUDGET_MODE is 'raise'. Budgets are
+# checked by accounts.tests.QueryCountTests, including the queries streamed
+# after the middleware returns.
+QUERY_BUDGET_MODE = config('QUERY_BUDGET_MODE', default='warn')
+QUERY_BUDGETS = {
+    'login': 3,
+    'login-refresh': 3,
+    'login-keys': 0,
+    'User-list': 9,
+    'User-detail': 9,
+    'Student-list': 9,
+    'Student-detail': 9,
+    'Teacher-list': 6,
+    'Teacher-detail': 6,
+    'Class-list': 4,
+    'Class-detail': 4,
+    'Course-list': 6,
+    'Course-detail': 6,
+    'Program-list': 6,
+    'Program-detail': 6,
+    'MyClass-list': 3,
+    'MyClass-detail': 3,
+    'MyCourse-list': 7,
+    'MyCourse-detail': 6,
+    'MyCourse-gradebook': 5,
+    'MyProgram-list': 5,
+    'MyProgram-detail': 5,
+    'my-account': 11,
+    'my-profile': 9,
+    'my-class': 8,
+    'my-institution': 5,
+    'cache-metrics': 1,
+    'pool-metrics': 1,
+    'exports': 3,
+}
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'class_path_auth.requests': {
+            'handlers': ['console'],
+            'level': config('REQUEST_LOG_LEVEL', default='INFO'),
+            'propagate': False,
+        },
+    },
 }
+
+TEST_RUNNER = 'class_path_auth.test_runner.UnmanagedModelTestRunner'
@@ -0,0 +1,58 @@
+import logging
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connections
+from django.test.runner import DiscoverRunner
+
+
+class UnmanagedModelTestRunner(DiscoverRunner):
+    """
+    Create the tables of the unmanaged accounts models in the test database.
+
+    The accounts schema is owned by another service, so its migrations never
+    create tables. While testing the models are flagged as managed and the
+    app is synced from the models instead of its migrations.
+
+    Query budgets are enforced, failing the requests that go over them.
+    Connections are not pooled, idle ones would keep the test databases
+    from being dropped, and queries are not routed to the replicas and
+    shards, which mirror the default test database.
+    """
+
+    def setup_test_environment(self, *args, **kwargs):
+        self.pools = {
+            alias: connections.databases[alias].pop('POOL', None) for alias in connections
+        }
+
+        self.database_replicas = settings.DATABASE_REPLICAS
+        self.database_shards = settings.DATABASE_SHARDS
+        settings.DATABASE_REPLICAS = settings.DATABASE_SHARDS = []
+
+        self.unmanaged_models = [
+            model for model in apps.get_models() if not model._meta.managed
+        ]
+        for model in self.unmanaged_models:
+            model._meta.managed = True
+
+        self.migration_modules = settings.MIGRATION_MODULES
+        settings.MIGRATION_MODULES = dict(self.migration_modules, accounts=None)
+
+        self.query_budget_mode = settings.QUERY_BUDGET_MODE
+        settings.QUERY_BUDGET_MODE = 'raise'
+        logging.getLogger('class_path_auth.requests').setLevel(logging.WARNING)
+
+        super().setup_test_environment(*args, **kwargs)
+
+    def teardown_test_environment(self, *args, **kwargs):
+        super().teardown_test_environment(*args, **kwargs)
+
+        settings.MIGRATION_MODULES = self.migration_modules
+        for alias, pool in self.pools.items():
+            if pool:
+                connections.databases[alias]['POOL'] = pool
+        settings.DATABASE_REPLICAS = self.database_replicas
+        settings.DATABASE_SHARDS = self.database_shards
+        settings.QUERY_BUDGET_MODE = self.query_budget_mode
+        for model in self.unmanaged_models:
+            model._meta.managed = False